@@ -18,7 +18,11 @@ For each file, we compute the following information:
          - sha
 """
 
-import json, os, subprocess, sys, uuid
+import json, marshal, os, subprocess, sys, tempfile, uuid
+
+# File in the .git directory holding the index of the most recent commit that changed each
+# file in the repository; it is updated incrementally from the commits since the HEAD it is for.
+GIT_INDEX_FILE = 'smc-git-ls-index'
 
 def getmtime(name):
     try:
@@ -34,6 +38,76 @@ def getsize(name):
     except:
         return 0
 
+def git(args):
+    p = subprocess.Popen(['git'] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return p.returncode, out
+
+def git_log(args):
+    """
+    Return list of pairs (commit, paths) for the commits output by git log with the
+    given args, newest first, where commit = (author, date, message, sha).
+    """
+    format = "--pretty=format:!%H|%an <%ae>|%ad|%s|"
+    field_sep = str(uuid.uuid4())
+    commit_sep = str(uuid.uuid4())
+    format = format.replace('|',field_sep).replace("!",commit_sep)
+    # -z gives the paths unquoted and NUL separated, as status, path, status, path, ...
+    e, log = git(['log', '-z', '--no-renames', '--date=raw', '--name-status', format] + args)
+    if e:
+        raise RuntimeError("git log %s failed"%' '.join(args))
+    v = []
+    for entry in log.split(commit_sep):
+        if len(entry.strip()) == 0 : continue
+        sha, author, date, message, modified_files = entry.split(field_sep)
+        date = int(date.split()[0])
+        modified_files = [x for x in modified_files.lstrip('\n').split('\0') if x]
+        v.append(((author, date, message, sha), modified_files[1::2]))
+    return v
+
+def git_index():
+    """
+    Return (prefix, files), where prefix is the path of the current directory in its git
+    repository and files maps each path in the repository to the most recent commit that
+    changed it, as (author, date, message, sha).  Returns ('', {}) if not in a repository
+    with commits.
+
+    The map is saved in the repository as GIT_INDEX_FILE, so usually this is a lookup;
+    when HEAD moves forward, only the new commits are read.
+    """
+    e, out = git(['rev-parse', '--show-prefix', '--git-dir', 'HEAD'])
+    if e:
+        return '', {}
+    prefix, git_dir, head = out.split('\n')[:3]
+    index_file = os.path.join(git_dir, GIT_INDEX_FILE)
+    try:
+        index = marshal.load(open(index_file, 'rb'))
+        if index['head'] == head:
+            return prefix, index['files']
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
+        index = None
+    if index is not None and git(['merge-base', '--is-ancestor', index['head'], head])[0] == 0:
+        files = index['files']
+        log = git_log(['%s..%s'%(index['head'], head)])
+    else:
+        # no index yet, or history was rewritten (e.g., rebase or reset)
+        files = {}
+        log = git_log([head])
+    new = {}
+    for commit, paths in log:
+        for path in paths:
+            if path not in new:
+                new[path] = commit
+    files.update(new)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=git_dir)
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump({'head':head, 'files':files}, f)
+        os.rename(tmp, index_file)
+    except (IOError, OSError):
+        pass  # e.g., read-only repository -- the index is only an optimization
+    return prefix, files
+
 def gitls(path, time, start, limit, hidden, directories_first, git_aware=True):
     if not os.path.exists(path):
         sys.stderr.write("error: no such path '%s'"%path)
@@ -95,31 +169,12 @@ def gitls(path, time, start, limit, hidden, directories_first, git_aware=True):
 
     # Fill in git-related information about each file
     if git_aware:
-        # First, obtain git history about files
-        format = "--pretty=format:!%H|%an <%ae>|%ad|%s|"
-        field_sep = str(uuid.uuid4())
-        commit_sep = str(uuid.uuid4())
-        format = format.replace('|',field_sep).replace("!",commit_sep)
-        # Why 200 below: in tests, if there are tons of files, passing
-        # them all on the command line ends up taking longer than just
-        # getting info about everything in this tree
-        if len(files) > 200:
-            git_path = ['.']
-        else:
-            git_path = [name for name, info in files.iteritems() if not info.get('isdir',False)]
-        log = subprocess.Popen(['git', 'log', '--date=raw', '--name-status', format] + git_path,
-                               stdin=subprocess.PIPE, stdout = subprocess.PIPE,
-                               stderr=subprocess.PIPE).stdout.read()
-        v = {}
-        for entry in log.split(commit_sep):
-            if len(entry.strip()) == 0 : continue
-            sha, author, date, message, modified_files= entry.split(field_sep)
-            date = int(date.split()[0])
-            # modified_files = set of filenames
-            modified_files = [os.path.split(str(x[2:]).replace('\\\\"','"').replace('\\"',''))[-1] for x in modified_files.splitlines() if x]
-            for name in modified_files:
-                if name in files and 'commit' not in files[name]:
-                    files[name]['commit'] =  {'author':author, 'date':date, 'message':message, 'sha':sha}
+        prefix, index = git_index()
+        for name, info in files.iteritems():
+            commit = index.get(prefix + name) if not info.get('isdir', False) else None
+            if commit is not None:
+                author, date, message, sha = commit
+                info['commit'] = {'author':author, 'date':date, 'message':message, 'sha':sha}
 
     # Make ordered list of files, with directories first.
     if directories_first:
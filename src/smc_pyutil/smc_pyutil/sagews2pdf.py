@@ -119,6 +119,7 @@ COMMON = r"""
 \usepackage{graphicx}
 \usepackage{etoolbox}
 \usepackage{url}
+\csname endofdump\endcsname
 \usepackage{hyperref}
 
 \usepackage{textcomp}
@@ -187,8 +188,27 @@ COMMON += ur"""
 # TODO: this needs to use salvus.project_info() or an environment variable or something!
 site = 'https://cloud.sagemath.com'
 
-import argparse, base64, cPickle, json, os, shutil, sys, textwrap, HTMLParser, tempfile, urllib
-from uuid import uuid4
+import argparse, base64, cPickle, errno, fcntl, json, os, shutil, sys, textwrap, HTMLParser, tempfile, time, urllib
+from hashlib import sha1
+from multiprocessing import cpu_count
+
+# Downloaded images and svg's converted to pdf are kept here, named by the sha1 of their url
+# (resp. of the svg), so exporting a worksheet again doesn't fetch or convert them again.
+ASSET_CACHE = os.path.join(os.environ.get('SMC', os.path.expanduser('~/.smc')), 'sagews2pdf-cache')
+ASSET_CACHE_MAX_AGE = 30*24*3600   # delete cached files that haven't been used for this long
+
+# For incremental exports, the LaTeX build directory of each worksheet is kept here, with the
+# .aux/.toc files and the precompiled preamble, until it hasn't been used for ASSET_CACHE_MAX_AGE.
+BUILD_CACHE = os.path.join(os.environ.get('SMC', os.path.expanduser('~/.smc')), 'sagews2pdf-build')
+
+# Everything in the preamble before this (in COMMON, right before hyperref, which can't be
+# dumped) is the same for all worksheets with the same style, so it can be precompiled into a
+# format file; mylatexformat skips it when the format is used, and without the format this
+# does nothing.
+ENDOFDUMP = "\\csname endofdump\\endcsname\n"
+
+# pdflatex is run until the .aux/.toc/.out files it writes don't change, but at most this often
+MAX_LATEX_RUNS = 4
 
 def escape_path(s):
     # see http://stackoverflow.com/questions/946170/equivalent-javascript-functions-for-pythons-urllib-quote-and-urllib-unquote
@@ -224,7 +244,7 @@ def thread_map(callable, inputs, nb_threads = 2):
     If an exception is raised by any thread, a RuntimeError exception
     is instead raised.
     """
-    print "Doing the following in parallel:\n%s"%('\n'.join(inputs))
+    print "Doing the following in parallel:\n%s"%('\n'.join([str(x) for x in inputs]))
     from multiprocessing.pool import ThreadPool
     tp = ThreadPool(nb_threads)
     exceptions = []
@@ -239,13 +259,110 @@ def thread_map(callable, inputs, nb_threads = 2):
     return results
 
 
+def _make_file(path, make):
+    """
+    Call make(path), which returns whether it succeeded, and return whether it
+    created a nonempty file path; if not, path is removed.
+    """
+    if not make(path) or not os.path.exists(path) or os.path.getsize(path) == 0:
+        if os.path.exists(path):
+            os.unlink(path)
+        return False
+    return True
+
+def _cache_file(name, make):
+    """
+    Return the path of name in ASSET_CACHE, first calling make(tmp) to create it
+    in tmp if it isn't there; make returns whether it succeeded.  Returns None
+    if make fails, so a failed download or conversion is never cached.
+    """
+    path = os.path.join(ASSET_CACHE, name)
+    if os.path.exists(path):
+        os.utime(path, None)  # mark as used
+        return path
+    import thread
+    tmp = '%s.%s-%s.tmp'%(path, os.getpid(), thread.get_ident())
+    if not _make_file(tmp, make):
+        return None
+    os.rename(tmp, path)
+    return path
+
+def is_blob_url(url):
+    """
+    Whether url is that of a blob of this site, which never changes.
+    """
+    return url.startswith(site + '/blobs/') and '?uuid=' in url
+
+def fetch_asset(asset):
+    """
+    Put the file at url into the current directory as filename, where
+    asset = (url, ext, filename) and ext is the extension of the url.  An svg
+    is converted to the pdf filename.  Downloads of blobs (other urls may change)
+    and conversions are cached in ASSET_CACHE, so only the ones that changed since
+    a previous export are done.
+    """
+    url, ext, filename = asset
+    def download(tmp):
+        return os.system("wget '%s' --output-document='%s'"%(url, tmp)) == 0
+    downloaded = None
+    if is_blob_url(url):
+        path = _cache_file('url-' + sha1(url).hexdigest() + ext, download)
+    else:
+        path = downloaded = filename + '.download' + ext
+        if not _make_file(path, download):
+            path = None
+    if path is None:
+        print "Unable to download '%s'"%url
+        return
+    try:
+        if ext == '.svg':
+            def convert(tmp):
+                return os.system("inkscape --without-gui --export-pdf='%s' '%s'"%(tmp, svg)) == 0
+            svg = path
+            path = _cache_file('svg-' + sha1(open(svg).read()).hexdigest() + '.pdf', convert)
+            if path is None:
+                print "Unable to convert '%s' to pdf"%url
+                return
+        if os.path.exists(filename):
+            os.unlink(filename)
+        try:
+            os.link(path, filename)
+        except OSError:
+            shutil.copyfile(path, filename)
+    finally:
+        if downloaded is not None and os.path.exists(downloaded):
+            os.unlink(downloaded)
+
+def fetch_assets(assets):
+    """
+    Fetch the given assets (see fetch_asset) using a thread per core, since
+    most of the time is spent waiting for wget and inkscape.
+    """
+    if not os.path.exists(ASSET_CACHE):
+        os.makedirs(ASSET_CACHE)
+    else:
+        now = time.time()
+        for name in os.listdir(ASSET_CACHE):
+            path = os.path.join(ASSET_CACHE, name)
+            try:
+                if now - os.path.getmtime(path) > ASSET_CACHE_MAX_AGE:
+                    os.unlink(path)
+            except OSError as err:
+                # another export may have deleted it meanwhile
+                if err.errno != errno.ENOENT:
+                    raise
+    # the same image often occurs several times
+    assets = sorted(set(assets))
+    thread_map(fetch_asset, assets, nb_threads=cpu_count())
+
+
 # create a subclass and override the handler methods
 
 class Parser(HTMLParser.HTMLParser):
-    def __init__(self, cmds):
+    def __init__(self, assets):
         HTMLParser.HTMLParser.__init__(self)
         self.result = ''
-        self._commands = cmds
+        self._assets = assets
 
     def handle_starttag(self, tag, attrs):
         if tag == 'h1':
@@ -284,16 +401,12 @@ class Parser(HTMLParser.HTMLParser):
                 _, ext = os.path.splitext(href)
                 ext = ext.lower()
                 # create a deterministic filename based on the href
-                from hashlib import sha1
                 base = sha1(href).hexdigest()
                 filename = base + ext
-
-                c = "rm -f '%s'; wget '%s' --output-document='%s'"%(filename, href, filename)
                 if ext == '.svg':
-                    # convert to pdf
-                    c += " && rm -f '%s'; inkscape --without-gui --export-pdf='%s' '%s'" % (base+'.pdf',base+'.pdf',filename)
+                    # converted to pdf
                     filename = base+'.pdf'
-                self._commands.append(c)
+                self._assets.append((href, ext, filename))
                 # the choice of 120 is "informed" but also arbitrary
                 self.result += '\\includegraphics[resolution=120]{%s}\n'%filename
             else:
@@ -352,10 +465,10 @@ def texifyHTML(s):
         s = s.replace(*rep)
     return s
 
-def html2tex(doc, cmds):
+def html2tex(doc, assets):
     doc = texifyHTML(doc)
     tmp = sanitize_math_input(doc)
-    parser = Parser(cmds)
+    parser = Parser(assets)
     # The number of (unescaped) dollars or double-dollars found so far. An even
     # number is assumed to indicate that we're outside of math and thus need to
     # escape.
@@ -372,12 +485,12 @@ def md2html(s):
     markedDownText = markdown(tmp[-1][0][0], extras=extras)
     return reconstruct_math(markedDownText, tmp)
 
-def md2tex(doc, cmds):
+def md2tex(doc, assets):
     x = md2html(doc)
     #print "-" * 100
     #print "md2html:", x
     #print "-" * 100
-    y = html2tex(x, cmds)
+    y = html2tex(x, assets)
     #print "html2tex:", y
     #print "-" * 100
     return y
@@ -404,7 +517,9 @@ class Cell(object):
             for x in w[1:]:
                 if x:
                     try:
-                        self.output.append(json.loads(x))
+                        mesg = json.loads(x)
+                        # several outputs may have been sent as the parts of one message
+                        self.output.extend(mesg.get('parts', [mesg]))
                     except ValueError:
                         try:
                             print "**WARNING:** Unable to de-json '%s'"%x
@@ -416,12 +531,12 @@ class Cell(object):
 
     def latex(self):
         """
-        Returns the latex represenation of this cell along with a list of commands
-        that should be executed in the shell in order to obtain remote data files,
-        etc., to render this cell.
+        Returns the latex represenation of this cell along with a list of assets
+        (see fetch_asset) that have to be fetched in order to obtain remote data
+        files, etc., to render this cell.
         """
-        self._commands = []
-        return self.latex_input() + self.latex_output(), self._commands
+        self._assets = []
+        return self.latex_input() + self.latex_output(), self._assets
 
     def latex_input(self):
         if 'i' in self.input_codes:   # hide input
@@ -444,9 +559,9 @@ class Cell(object):
                 # TODO: for now ignoring that not all code is Python...
                 s += "\\begin{lstlisting}" + x['code']['source'] + "\\end{lstlisting}"
             if 'html' in x:
-                s += html2tex(x['html'], self._commands)
+                s += html2tex(x['html'], self._assets)
             if 'md' in x:
-                s += md2tex(x['md'], self._commands)
+                s += md2tex(x['md'], self._assets)
             if 'interact' in x:
                 pass
             if 'tex' in x:
@@ -479,19 +594,13 @@ class Cell(object):
                         img = filename
                     else:
                         # Get the file from remote server
-                        c = "rm -f '%s'; wget '%s' --output-document='%s'"%(filename, target, filename)
-                        # If we succeeded, convert it to a png, which is what we can easily embed
-                        # in a latex document (svg's don't work...)
-                        self._commands.append(c)
                         if ext == 'svg':
                             # hack for svg files; in perfect world someday might do something with vector graphics,
                             # see http://tex.stackexchange.com/questions/2099/how-to-include-svg-diagrams-in-latex
                             # Now we live in a perfect world, and proudly introduce inkscape as a dependency for SMC :-)
-                            #c += ' && rm -f "%s"; convert -antialias -density 150 "%s" "%s"'%(base+'.png',filename,base+'.png')
-                            # converts the svg file into pdf
-                            c += " && rm -f '%s'; inkscape --without-gui --export-pdf='%s' '%s'" % (base+'.pdf',base+'.pdf',filename)
-                            self._commands.append(c)
+                            # fetch_asset converts the svg file into pdf
                             filename = base+'.pdf'
+                        self._assets.append((target, '.'+ext, filename))
                         img = filename
                     s += '\\includegraphics[width=\\textwidth]{%s}\n'%img
                 elif ext == 'sage3d' and 'sage3d' in extra_data and 'uuid' in val:
@@ -512,7 +621,8 @@ class Cell(object):
                             image_ext  = data_url[i+1:j]
                             image_data = data_url[k+1:]
                             assert data_url[j+1:k] == 'base64'
-                            filename = str(uuid4()) + "." + image_ext
+                            # named by content, so the tex is the same if the image is
+                            filename = sha1(image_data).hexdigest() + "." + image_ext
                             open(filename, 'w').write(base64.b64decode(image_data))
                             s += '\\includegraphics[width=%s\\textwidth]{%s}\n'%(width, filename)
 
@@ -572,15 +682,14 @@ class Worksheet(object):
     def latex(self, title='', author='', date='', style='modern', contents=True):
         if not title:
             title = self._default_title
-        commands = []
+        assets = []
         tex = []
         for c in self._cells:
-            t, cmd = c.latex()
+            t, a = c.latex()
             tex.append(t)
-            if cmd:
-                commands.extend(cmd)
-        if commands:
-            thread_map(os.system, commands)
+            assets.extend(a)
+        if assets:
+            fetch_assets(assets)
         return self.latex_preamble(title=title,
                                    author=author,
                                    date=date,
@@ -590,7 +699,95 @@ class Worksheet(object):
                + r"\end{document}"
 
 
-def sagews_to_pdf(filename, title='', author='', date='', outfile='', contents=True, remove_tmpdir=True, work_dir=None, style='modern'):
+def pdflatex(fmt=None):
+    os.system('pdflatex %s-interact=nonstopmode tmp.tex'%('-fmt=%s '%fmt if fmt else ''))
+
+def latex_state():
+    """
+    Hash of the files through which a run of pdflatex on tmp.tex affects the next one.
+    """
+    h = sha1()
+    for ext in ['.aux', '.toc', '.out']:
+        if os.path.exists('tmp' + ext):
+            h.update(ext + open('tmp' + ext).read())
+    return h.hexdigest()
+
+def make_format(preamble):
+    """
+    Precompile preamble (the part of tmp.tex before ENDOFDUMP) into preamble.fmt using
+    mylatexformat, unless it is already there for this preamble and pdflatex.  Returns
+    the name of the format, or None if it couldn't be made.
+    """
+    version = os.popen('pdflatex --version').readline()
+    key = sha1(version + preamble.encode('utf8')).hexdigest()
+    if os.path.exists('preamble.key') and open('preamble.key').read() == key:
+        # made before, or failed before, in which case trying again won't help
+        return 'preamble' if os.path.exists('preamble.fmt') else None
+    for ext in ['.fmt', '.key']:
+        if os.path.exists('preamble' + ext):
+            os.unlink('preamble' + ext)
+    from codecs import open as codecs_open
+    codecs_open('preamble.tex', 'w', 'utf8').write(preamble + ENDOFDUMP + "\\begin{document}\n\\end{document}\n")
+    os.system('pdflatex -ini -interact=nonstopmode -jobname=preamble "&pdflatex" mylatexformat.ltx preamble.tex')
+    open('preamble.key', 'w').write(key)
+    if not os.path.exists('preamble.fmt'):
+        print "Unable to precompile the preamble; not using a format file"
+        return None
+    return 'preamble'
+
+def lock_build_dir(work_dir):
+    """
+    Create work_dir if necessary and return an open file holding an exclusive lock on it, so
+    concurrent incremental exports of the same worksheet don't write over each other's files.
+    """
+    path = os.path.join(work_dir, '.lock')
+    while True:
+        try:
+            os.makedirs(work_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        try:
+            lock = open(path, 'a')
+        except IOError as err:
+            if err.errno == errno.ENOENT:
+                continue   # pruned in between
+            raise
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(path).st_ino:
+                return lock
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        lock.close()   # the directory was pruned while we waited for the lock
+
+def prune_build_cache():
+    now = time.time()
+    for name in os.listdir(BUILD_CACHE):
+        path = os.path.join(BUILD_CACHE, name)
+        try:
+            if now - os.path.getmtime(path) <= ASSET_CACHE_MAX_AGE:
+                continue
+            lock = open(os.path.join(path, '.lock'), 'a')
+        except (IOError, OSError):
+            continue
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            pass   # an export is using it right now
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            lock.close()
+
+def sagews_to_pdf(filename, title='', author='', date='', outfile='', contents=True, remove_tmpdir=True, work_dir=None, style='modern', incremental=False):
+    """
+    If incremental is True, the build directory (by default, one in BUILD_CACHE for this
+    worksheet) is kept, the fixed part of the preamble is precompiled into a format, and
+    pdflatex is only run again when the .aux/.toc/.out files changed, so exporting a
+    worksheet again usually takes a single pdflatex run with the format.
+    """
     base = os.path.splitext(filename)[0]
     if not outfile:
         pdf = base + ".pdf"
@@ -598,9 +795,20 @@ def sagews_to_pdf(filename, title='', author='', date='', outfile='', contents=T
         pdf = outfile
     print "converting: %s --> %s"%(filename, pdf)
     W = Worksheet(filename)
+    if incremental:
+        remove_tmpdir = False
+        if work_dir is None:
+            if not os.path.exists(BUILD_CACHE):
+                os.makedirs(BUILD_CACHE)
+            else:
+                prune_build_cache()
+            work_dir = os.path.join(BUILD_CACHE, sha1(os.path.abspath(filename)).hexdigest())
+    lock = None
     try:
         if work_dir is None:
             work_dir = tempfile.mkdtemp()
+        elif incremental:
+            lock = lock_build_dir(work_dir)
         else:
             if not os.path.exists(work_dir):
                 os.makedirs(work_dir)
@@ -608,21 +816,32 @@ def sagews_to_pdf(filename, title='', author='', date='', outfile='', contents=T
             print "Temporary directory retained: %s" % work_dir
         cur = os.path.abspath('.')
         os.chdir(work_dir)
+        if incremental:
+            os.utime(work_dir, None)  # mark as used
         from codecs import open
-        open('tmp.tex', 'w', 'utf8').write(
-            W.latex(title=title,
-                    author=author,
-                    date=date,
-                    contents=contents,
-                    style=style)
-        )#.encode('utf8'))
-        os.system('pdflatex -interact=nonstopmode tmp.tex')
-        if contents:
-            os.system('pdflatex -interact=nonstopmode tmp.tex')
+        tex = W.latex(title=title,
+                      author=author,
+                      date=date,
+                      contents=contents,
+                      style=style)
+        open('tmp.tex', 'w', 'utf8').write(tex)#.encode('utf8'))
+        if incremental:
+            fmt = make_format(tex[:tex.index(ENDOFDUMP)])
+            for i in range(MAX_LATEX_RUNS):
+                state = latex_state()
+                pdflatex(fmt)
+                if latex_state() == state:
+                    break
+        else:
+            pdflatex()
+            if contents:
+                pdflatex()
         if os.path.exists('tmp.pdf'):
             shutil.move('tmp.pdf',os.path.join(cur, pdf))
             print "Created", os.path.join(cur, pdf)
     finally:
+        if lock is not None:
+            lock.close()
         if work_dir and remove_tmpdir:
             shutil.rmtree(work_dir)
         else:
@@ -643,11 +862,13 @@ def main():
     parser.add_argument('--subdir', dest="subdir", help="if set, the work_dir will be set (or overwritten) to be pointing to a subdirectory named after the file to be converted.", default='false')
     parser.add_argument("--extra_data_file", dest="extra_data_file", help="JSON format file that contains extra data useful in printing this worksheet, e.g., 3d plots", type=str, default='')
     parser.add_argument("--style", dest="style", help="Styling of the LaTeX document", type=str, choices=['classic', 'modern'], default="modern")
+    parser.add_argument("--incremental", dest="incremental", help="if 'true', keep the LaTeX build directory between exports, precompile the preamble and only rerun pdflatex if needed (default: 'false')", type=str, default='false')
 
     args = parser.parse_args()
     args.contents = args.contents == 'true'
     args.remove_tmpdir = args.remove_tmpdir == 'true'
     args.subdir = args.subdir == 'true'
+    args.incremental = args.incremental == 'true'
 
     if args.extra_data_file:
         import json
@@ -674,7 +895,8 @@ def main():
                   contents=args.contents,
                   remove_tmpdir=remove_tmpdir,
                   work_dir=work_dir,
-                  style=args.style
+                  style=args.style,
+                  incremental=args.incremental
                  )
 
 if __name__ == "__main__":
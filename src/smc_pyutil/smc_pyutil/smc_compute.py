@@ -40,11 +40,43 @@ import errno, hashlib, json, math, os, platform, re, shutil, signal, socket, sta
 
 from subprocess import Popen, PIPE
 
+try:
+    # backport of os.scandir, which uses d_type so telling directories apart needs no stat
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 TIMESTAMP_FORMAT = "%Y-%m-%d-%H%M%S"
 USER_SWAP_MB     = 1000  # amount of swap users get in addition to how much RAM they have.
 PLATFORM         = platform.system().lower()
 PROJECTS         = '/projects'
 
+# Listings of directories with at least this many entries (names and whether each is a
+# directory) are cached on disk, keyed by the directory's mtime, so a page of a big
+# directory only has to lstat the entries on that page.  The cache directory is only
+# used if it belongs to the user running this script (root) and nobody else can access it.
+LISTING_CACHE_MIN_ENTRIES = 2000
+LISTING_CACHE_PATH        = '/var/cache/smc-compute/listings'
+LISTING_CACHE_MAX_AGE     = 24*3600   # cache files older than this are deleted
+
+def listing_cache_path(create=False):
+    """
+    Return LISTING_CACHE_PATH, creating it if create is True, or None if it is
+    missing or could be written by another user than the one running this script.
+    """
+    try:
+        st = os.lstat(LISTING_CACHE_PATH)
+    except OSError:
+        if not create:
+            return None
+        os.makedirs(LISTING_CACHE_PATH, 0700)
+        st = os.lstat(LISTING_CACHE_PATH)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0077:
+        log("not using listing cache %s -- it must be a directory with owner %s and mode 700",
+            LISTING_CACHE_PATH, os.getuid())
+        return None
+    return LISTING_CACHE_PATH
+
 def quota_to_int(x):
     return int(math.ceil(x))
 
@@ -142,6 +174,120 @@ def thread_map(callable, inputs):
     if e: raise RuntimeError(e)
     return [f.result for f in results]
 
+# Size of the chunks in which files are read and written when streaming them.
+STREAM_CHUNK_SIZE = 1 << 16
+
+class ZipStream(object):
+    """
+    Write a deflate-compressed zip archive to the file-like object out
+    while it is being built, reading each file in chunks.  Since out
+    need not be seekable (e.g., stdout or a socket), the CRC and sizes
+    of each file are written in a data descriptor after its data.  Memory
+    use doesn't depend on the size of the files.
+
+    If maxsize is given, a RuntimeError is raised as soon as the total
+    (uncompressed) size of the files exceeds it.
+    """
+    def __init__(self, out, maxsize=None):
+        import zlib
+        self._zlib    = zlib
+        self._out     = out
+        self._offset  = 0
+        self._entries = []
+        self.maxsize  = maxsize
+        self.size     = 0
+
+    def _write(self, data):
+        self._out.write(data)
+        self._offset += len(data)
+
+    def _check_size(self, n):
+        self.size += n
+        if self.maxsize is not None and self.size > self.maxsize:
+            raise RuntimeError("archive must be at most %s bytes, but it is at least %s bytes"%(self.maxsize, self.size))
+
+    def _header(self, arcname, mtime, flags, method):
+        import struct
+        t = time.localtime(mtime)
+        if t[0] < 1980:
+            t = (1980, 1, 1, 0, 0, 0)
+        dosdate = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+        dostime = t[3] << 11 | t[4] << 5 | (t[5] // 2)
+        if isinstance(arcname, unicode):
+            arcname = arcname.encode('utf-8')
+        try:
+            arcname.decode('ascii')
+        except UnicodeDecodeError:
+            flags |= 0x800   # filename is utf-8
+        entry = {'name':arcname, 'flags':flags, 'method':method, 'time':dostime, 'date':dosdate,
+                 'offset':self._offset, 'crc':0, 'csize':0, 'usize':0}
+        self._write(struct.pack("<4s2B4HL2L2H", "PK\003\004", 20, 0, flags, method,
+                                dostime, dosdate, 0, 0, 0, len(arcname), 0) + arcname)
+        return entry
+
+    def add_dir(self, path, arcname):
+        """
+        Add an entry for the directory path (needed for empty directories).
+        """
+        st = os.lstat(path)
+        entry = self._header(arcname.rstrip('/') + '/', st.st_mtime, 0, 0)
+        entry['attr'] = (st.st_mode << 16) | 0x10   # MS-DOS directory flag
+        self._entries.append(entry)
+
+    def add_file(self, path, arcname):
+        """
+        Add the regular file path, compressing it as it is read.
+        """
+        import struct
+        zlib = self._zlib
+        st = os.lstat(path)
+        if self.maxsize is not None and self.size + st.st_size > self.maxsize:
+            raise RuntimeError("archive must be at most %s bytes, but it is at least %s bytes"%(self.maxsize, self.size + st.st_size))
+        entry = self._header(arcname, st.st_mtime, 0x08, 8)
+        entry['attr'] = st.st_mode << 16
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc = usize = csize = 0
+        f = open(path, 'rb')
+        try:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._check_size(len(chunk))
+                usize += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                data = compressor.compress(chunk)
+                if data:
+                    csize += len(data)
+                    self._write(data)
+        finally:
+            f.close()
+        data = compressor.flush()
+        csize += len(data)
+        self._write(data)
+        if usize > 0xffffffff or self._offset > 0xffffffff:
+            raise RuntimeError("archive is too big (zip64 is not supported)")
+        crc &= 0xffffffff
+        self._write(struct.pack("<4s3L", "PK\007\010", crc, csize, usize))
+        entry.update(crc=crc, csize=csize, usize=usize)
+        self._entries.append(entry)
+
+    def close(self):
+        """
+        Write the central directory, which finishes the archive.
+        """
+        import struct
+        start = self._offset
+        for e in self._entries:
+            # create_system=0 marks the files as having been created on Windows
+            # so that Unix permissions are not inferred as 0000.
+            self._write(struct.pack("<4s4B4HL2L5H2L", "PK\001\002", 20, 0, 20, 0, e['flags'], e['method'],
+                                    e['time'], e['date'], e['crc'], e['csize'], e['usize'], len(e['name']),
+                                    0, 0, 0, 0, e['attr'] & 0xffffffff, e['offset']) + e['name'])
+        n = len(self._entries)
+        self._write(struct.pack("<4s4H2LH", "PK\005\006", 0, 0, n, n, self._offset - start, start, 0))
+        self._out.flush()
+
 class Project(object):
     def __init__(self,
                  project_id,          # v4 uuid string
@@ -578,79 +724,114 @@ class Project(object):
         abspath = os.path.abspath(os.path.join(self.project_path, path))
         if not abspath.startswith(self.project_path):
             raise RuntimeError("path (=%s) must be contained in project path %s"%(path, self.project_path))
-        def get_file_mtime(name):
+        entries = self._listdir(abspath)
+        if not hidden:
+            entries = [x for x in entries if not x[0].startswith('.')]
+
+        def get_file_stat(name):
             try:
                 # use lstat instead of stat or getmtime so this works on broken symlinks!
-                return int(round(os.lstat(os.path.join(abspath, name)).st_mtime))
-            except:
+                return os.lstat(os.path.join(abspath, name))
+            except OSError:
                 # ?? This should never happen, but maybe if race condition. ??
-                return 0
-
-        def get_file_size(name):
-            try:
-                # same as above; use instead of os.path....
-                return os.lstat(os.path.join(abspath, name)).st_size
-            except:
-                return -1
+                return None
 
+        # entries are already sorted by name; sorting by time needs every mtime
+        stats = {}
+        if time:
+            for name, isdir in entries:
+                stats[name] = get_file_stat(name)
+            def key(x):
+                st = stats[x[0]]
+                # bigger times first, then by filename in normal order
+                return (-int(round(st.st_mtime)) if st else 0, x[0])
+            entries.sort(key=key)
 
-        listdir = os.listdir(abspath)
         result = {}
-        if not hidden:
-            listdir = [x for x in listdir if not x.startswith('.')]
+        entries = entries[start:]
+        if limit > 0 and len(entries) > limit:
+            result['more'] = True
+            entries = entries[:limit]
+
+        files = []
+        for name, isdir in entries:
+            st = stats[name] if time else get_file_stat(name)
+            info = {'name':name, 'mtime':int(round(st.st_mtime)) if st else 0}
+            if isdir:
+                info['isdir'] = True
+            else:
+                info['size'] = st.st_size if st else -1
+            files.append(info)
+        result['files'] = files
+        return result
+
+    def _listdir(self, abspath):
+        """
+        List of (name, isdir) pairs for the entries of the directory abspath, sorted
+        by name.  Big listings are cached in LISTING_CACHE_PATH until the directory changes.
+        """
+        # stat before listing, so a change made while listing invalidates the cache
+        st  = os.stat(abspath)
+        key = [st.st_dev, st.st_ino, st.st_mtime, st.st_ctime]
+        cache_name = hashlib.sha1(abspath).hexdigest()
+        path = listing_cache_path()
+        if path is not None:
+            try:
+                with open(os.path.join(path, cache_name)) as f:
+                    cached = json.load(f)
+                if cached['key'] == key:
+                    # names were UTF-8 strings before being JSON'd
+                    return [(name.encode('utf-8'), isdir) for name, isdir in cached['entries']]
+            except (IOError, ValueError, TypeError, KeyError):
+                pass
+
+        if scandir is not None:
+            # is_dir follows symlinks, like os.path.isdir, but only stats for symlinks
+            entries = [(x.name, x.is_dir()) for x in scandir(abspath)]
+        else:
+            entries = [(name, os.path.isdir(os.path.join(abspath, name))) for name in os.listdir(abspath)]
 
         # Just as in git_ls.py, we make sure that all filenames can be encoded via JSON.
         # Users sometimes make some really crazy filenames that can't be so encoded.
         # It's better to just not show them, than to show a horendous error.
         try:
-            json.dumps(listdir)
+            json.dumps(entries)
         except:
             # Throw away filenames that can't be json'd, since they can't be JSON'd below,
             # which would totally lock user out of their listings.
-            listdir = []
-            for x in os.listdir('.'):
+            def f(name):
                 try:
-                    json.dumps(x)
-                    listdir.append(x)
+                    json.dumps(name)
+                    return True
                 except:
-                    pass
-
-
-        # Get list of (name, timestamp) pairs
-        all = [(name, get_file_mtime(name)) for name in listdir]
+                    return False
+            entries = [x for x in entries if f(x[0])]
 
-        if time:
-            # sort by time first with bigger times first, then by filename in normal order
-            def f(a,b):
-                if a[1] > b[1]:
-                    return -1
-                elif a[1] < b[1]:
-                    return 0
-                else:
-                    return cmp(a[0], b[0])
-            all.sort(f)
-        else:
-            all.sort()  # usual sort is fine
-
-        # Limit and convert to objects
-        all = all[start:]
-        if limit > 0 and len(all) > limit:
-            result['more'] = True
-            all = all[:limit]
-
-        files = dict([(name, {'name':name, 'mtime':mtime}) for name, mtime in all])
-        sorted_names = [x[0] for x in all]
-
-        # Fill in other OS information about each file
-        #for obj in result:
-        for name, info in files.iteritems():
-            if os.path.isdir(os.path.join(abspath, name)):
-                info['isdir'] = True
-            else:
-                info['size'] = get_file_size(name)
+        entries.sort()
+        if len(entries) >= LISTING_CACHE_MIN_ENTRIES:
+            self._write_listing_cache(cache_name, {'key':key, 'entries':entries})
+        return entries
 
-        result['files'] = [files[name] for name in sorted_names]
-        return result
+    def _write_listing_cache(self, cache_name, obj):
+        try:
+            path = listing_cache_path(create=True)
+            if path is None:
+                return
+            now = time.time()
+            for name in os.listdir(path):
+                filename = os.path.join(path, name)
+                try:
+                    if now - os.lstat(filename).st_mtime > LISTING_CACHE_MAX_AGE:
+                        os.unlink(filename)
+                except OSError:
+                    pass   # deleted by another smc_compute.py meanwhile
+            fd, tmp = tempfile.mkstemp(dir=path)
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(obj, f)
+            os.rename(tmp, os.path.join(path, cache_name))
+        except (IOError, OSError), mesg:
+            # the cache is only an optimization
+            log("unable to write listing cache %s -- %s", cache_name, mesg)
 
     def read_file(self, path, maxsize):
         """
@@ -667,21 +848,10 @@ class Project(object):
             {'base64':'... contents ...'}
 
         or {'error':"error message..."} in case of an error.
-        """
-        abspath = os.path.abspath(os.path.join(self.project_path, path))
-        base, ext = os.path.splitext(abspath)
-        if not abspath.startswith(self.project_path):
-            raise RuntimeError("path (=%s) must be contained in project path %s"%(path, self.project_path))
-        if not os.path.exists(abspath):
-            if ext != '.zip':
-                raise RuntimeError("path (=%s) does not exist"%path)
-            else:
-                if os.path.exists(base) and os.path.isdir(base):
-                    abspath = os.path.splitext(abspath)[0]
-                else:
-                    raise RuntimeError("path (=%s) does not exist and neither does %s"%(path, base))
 
-        filename = os.path.split(abspath)[-1]
+        Use stream_file to get big files or directories without holding them in memory.
+        """
+        abspath = self._read_path(path)
         if os.path.isfile(abspath):
             # a regular file
             # TODO: compress the file before base64 encoding (and corresponding decompress
@@ -692,37 +862,77 @@ class Project(object):
             content = open(abspath).read()
         else:
             # a zip file in memory from a directory tree
-            # REFERENCES:
-            #   - http://stackoverflow.com/questions/1855095/how-to-create-a-zip-archive-of-a-directory
-            #   - https://support.google.com/accounts/answer/6135882
-            import zipfile
             from cStringIO import StringIO
-            output  = StringIO()
-            relroot = os.path.abspath(os.path.join(abspath, os.pardir))
-
-            size = 0
-            zip = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, False)
-            for root, dirs, files in os.walk(abspath):
-                # add directory (needed for empty dirs)
-                zip.write(root, os.path.relpath(root, relroot))
-                for file in files:
-                    filename = os.path.join(root, file)
-                    if os.path.isfile(filename): # regular files only
-                        size += os.lstat(filename).st_size
-                        if size > maxsize:
-                            raise RuntimeError("path (=%s) must be at most %s bytes, but it is at least %s bytes"%(path, maxsize, size))
-                        arcname = os.path.join(os.path.relpath(root, relroot), file)
-                        zip.write(filename, arcname)
-
-            # Mark the files as having been created on Windows so that
-            # Unix permissions are not inferred as 0000.
-            for zfile in zip.filelist:
-                zfile.create_system = 0
-            zip.close()
+            output = StringIO()
+            self._write_zip(abspath, maxsize, output)
             content = output.getvalue()
         import base64
         return {'base64':base64.b64encode(content)}
 
+    def stream_file(self, path, maxsize, out=None):
+        """
+        Like read_file, but write the file (or the deflated zip archive of a
+        directory, if path is directory.zip) to the file-like object out
+        (default: stdout) in chunks as it is read, so memory use is constant.
+
+        The size limit is enforced while streaming, so if it is exceeded a
+        RuntimeError is raised after some of the output has been written.
+        """
+        if out is None:
+            out = sys.stdout
+        abspath = self._read_path(path)
+        if os.path.isfile(abspath):
+            size = 0
+            f = open(abspath, 'rb')
+            try:
+                while True:
+                    chunk = f.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > maxsize:
+                        raise RuntimeError("path (=%s) must be at most %s bytes, but it is at least %s bytes"%(path, maxsize, size))
+                    out.write(chunk)
+            finally:
+                f.close()
+            out.flush()
+        else:
+            self._write_zip(abspath, maxsize, out)
+
+    def _write_zip(self, abspath, maxsize, out):
+        # REFERENCES:
+        #   - http://stackoverflow.com/questions/1855095/how-to-create-a-zip-archive-of-a-directory
+        #   - https://support.google.com/accounts/answer/6135882
+        relroot = os.path.abspath(os.path.join(abspath, os.pardir))
+        zip = ZipStream(out, maxsize)
+        for root, dirs, files in os.walk(abspath):
+            # add directory (needed for empty dirs)
+            zip.add_dir(root, os.path.relpath(root, relroot))
+            for file in files:
+                filename = os.path.join(root, file)
+                if os.path.isfile(filename): # regular files only
+                    zip.add_file(filename, os.path.join(os.path.relpath(root, relroot), file))
+        zip.close()
+
+    def _read_path(self, path):
+        """
+        Absolute path of the file or directory that read_file(path) reads;
+        path.zip refers to the directory path if there is no such file.
+        """
+        abspath = os.path.abspath(os.path.join(self.project_path, path))
+        base, ext = os.path.splitext(abspath)
+        if not abspath.startswith(self.project_path):
+            raise RuntimeError("path (=%s) must be contained in project path %s"%(path, self.project_path))
+        if not os.path.exists(abspath):
+            if ext != '.zip':
+                raise RuntimeError("path (=%s) does not exist"%path)
+            else:
+                if os.path.exists(base) and os.path.isdir(base):
+                    abspath = os.path.splitext(abspath)[0]
+                else:
+                    raise RuntimeError("path (=%s) does not exist and neither does %s"%(path, base))
+        return abspath
+
     def makedirs(self, path, chown=True):
         log = self._log('makedirs')
         if os.path.exists(path) and not os.path.isdir(path):
@@ -998,6 +1208,32 @@ def main():
                                    dest="maxsize", default=3000000, type=int)
     f(parser_read_file)
 
+    # stream_file writes raw bytes (not json) to stdout or a socket, so it doesn't use f.
+    def stream_file(args):
+        out = sys.stdout
+        if args.output != '-':
+            host, port = args.output.rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)))
+            out = sock.makefile('wb')
+        try:
+            Project(project_id=args.project_id, dev=args.dev, projects=args.projects,
+                    single=args.single).stream_file(args.path, args.maxsize, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+                sock.close()
+
+    parser_stream_file = subparsers.add_parser('stream_file',
+         help="write a file/directory in chunks to stdout or a socket; use directory.zip to get directory/ as a compressed zip")
+    parser_stream_file.add_argument("path", help="relative path of a file/directory in project (required)", type=str)
+    parser_stream_file.add_argument("--maxsize", help="maximum file size in bytes to read (bigger causes error)",
+                                   dest="maxsize", default=3000000, type=int)
+    parser_stream_file.add_argument("--output", help="'-' for stdout (default) or host:port of a socket to write to",
+                                   dest="output", default='-', type=str)
+    # last, like the project_id of the other commands; see f
+    parser_stream_file.add_argument("project_id", help="UUID of project", type=str)
+    parser_stream_file.set_defaults(func=stream_file)
+
     parser_copy_path = subparsers.add_parser('copy_path', help='copy a path from one project to another')
     parser_copy_path.add_argument("--target_hostname", help="hostname of target machine for copy (default: localhost)",
                                   dest="target_hostname", default='localhost', type=str)
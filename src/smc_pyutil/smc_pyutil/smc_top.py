@@ -36,6 +36,11 @@ Datapoints include:
 
 The output is JSON encoded data, which is used by the SMC UI, or text.
 
+With `--resident`, it keeps running and samples every `--interval` seconds,
+keeping state about each process between samples, and writes each sample to a
+snapshot file. While that snapshot is fresh, a normal invocation returns it
+instantly instead of sampling for `--interval` seconds.
+
 Notes:
 * Assumption, that this is run with cgroups accounting,
   where the group is the username.
@@ -44,13 +49,14 @@ Notes:
 * Some values have human readable string counterparts, they are `*_h`.
 '''
 import os
-from os.path import join
+import time
+from os.path import join, expanduser
 from json import load
 from pytz import utc
 from datetime import datetime
 import psutil as ps
 from dateutil.parser import parse as date_parser
-from collections import OrderedDict, Counter, defaultdict
+from collections import OrderedDict, Counter, defaultdict, deque
 
 # byte -> ki(lo/bi)byte; see IEC 80000-13:2008
 KBMB = 1024.
@@ -58,6 +64,12 @@ KBMB = 1024.
 # cgroup stats accounts cpu usage in "USER_HZ" units - usually 1/100th second.
 USER_HZ = float(os.sysconf(os.sysconf_names['SC_CLK_TCK']))
 
+# pids of all processes in the cgroup of the user
+CGROUP_PROCS = "/sys/fs/cgroup/cpu,cpuacct/%s/cgroup.procs"
+
+# written by a resident smc-top after each sample, and read by the others
+SNAPSHOT = join(os.environ.get("SMC", expanduser("~/.smc")), "smc-top-%s.json")
+
 try:
     SMC_INFO = load(open(join(os.environ["SMC"], "info.json"), 'r'))
     PROJECT_ID = SMC_INFO.get("project_id")
@@ -164,19 +176,23 @@ def classify_proc(proc):
 class SmcTop(object):
     """
     Usage: class-instantiation → call `<obj>.json()` for a serialization of it.
-    Expected runtime is ~4 seconds, because it has to sample the CPU usage.
+    Expected runtime is ~4 seconds, because it has to sample the CPU usage,
+    unless a fresh snapshot of a resident smc-top is available or `start()`
+    was called, in which case the latest sample is returned instantly.
     """
 
     def __init__(self,
                  userid=None,
                  sample_interval=3.0,
                  tree=False,
-                 summarize=False):
+                 summarize=False,
+                 history=20):
         from os import getuid
         from pwd import getpwuid
         self.summarize = summarize
         if userid is None:
-            self.userid = getpwuid(getuid()).pw_name
+            userid = getpwuid(getuid()).pw_name
+        self.userid = userid
 
         # used for measuring % cpu usage, in seconds
         self.sample_interval = sample_interval
@@ -187,6 +203,12 @@ class SmcTop(object):
         self._procs = None
         self._tree = None
         self._totals = None
+        self._data = None
+        self._sampler = None
+        # pid → process and its static information, kept between samples
+        self._cache = {}
+        # ring buffer of (timestamp, cpu seconds, memory) readings of the cgroup
+        self._history = deque(maxlen=max(2, history))
 
     def totals(self):
         """
@@ -273,8 +295,29 @@ class SmcTop(object):
             "mem": memory(),
             "cpu": cpu()
         }
+        self._add_history()
         return self._totals
 
+    def _add_history(self):
+        '''
+        Record the current totals in the ring buffer and add the cpu usage
+        and memory change over the time span it covers to the totals.
+        '''
+        cpu, mem = self._totals["cpu"], self._totals["mem"]
+        now = time.time()
+        self._history.append((now, cpu.get("total"), mem.get("total")))
+        t0, cpu0, mem0 = self._history[0]
+        if now - t0 <= 0:
+            return
+        if cpu0 is not None and "total" in cpu:
+            # in percent of one core
+            cpu["percent"] = 100. * (cpu["total"] - cpu0) / (now - t0)
+            cpu["window"] = now - t0
+        if mem0 is not None and "total" in mem:
+            mem["total_change"] = mem["total"] - mem0
+            mem["total_change_h"] = mb2human(mem["total_change"])
+            mem["window"] = now - t0
+
     def user_processes(self):
         '''
         Returns an iterator over all processes of the given user.
@@ -284,25 +327,65 @@ class SmcTop(object):
                 continue
             yield p
 
+    def _user_pids(self):
+        '''
+        The pids of the processes of the user, from its cgroup if possible,
+        which is a lot cheaper than looking at every process.
+        '''
+        try:
+            return set(int(pid) for pid in read(CGROUP_PROCS % self.userid).split())
+        except IOError:
+            return set(p.pid for p in self.user_processes())
+
+    def _scan(self):
+        '''
+        Update the cache of processes: information that doesn't change
+        (name, command line, …) is read only once for every new process,
+        and vanished processes are dropped.
+        '''
+        def check(fn):
+            try:
+                return fn()
+            except ps.AccessDenied:
+                return None
+
+        pids = self._user_pids()
+        for pid in list(self._cache):
+            if pid not in pids or not self._cache[pid]["proc"].is_running():
+                del self._cache[pid]
+        for pid in pids - set(self._cache):
+            try:
+                p = ps.Process(pid)
+                self._cache[pid] = {
+                    "proc": p,
+                    "name": p.name(),
+                    "path": check(p.exe),
+                    "command_line": p.cmdline(),
+                    "category": classify_proc(p),
+                    "ppid": p.ppid(),
+                    "start": datetime.fromtimestamp(p.create_time()).replace(tzinfo=utc),
+                }
+                # the first call sets the reference point for cpu_percent
+                p.cpu_percent()
+            except ps.NoSuchProcess:
+                pass
+
     def capture(self):
         """
         The current state of all processes of a given user.
         By default, the current user is taken and analyzed.
+
+        CPU percentages are relative to the previous capture; on the first
+        one, they are measured over `sample_interval` seconds.
         """
-        if self._totals is None:
-            self.totals()
-        if self._totals is None:
-            return {"error": "no totals available"}
+        if self._procs is None:
+            self._scan()
+            time.sleep(self.sample_interval)
 
-        from time import sleep
+        self.totals()
 
         self.now = now = datetime.utcnow().replace(tzinfo=utc)
-        cpu_pct_sum = 0.0
-        cpu_time_sum = 0.0
 
-        if self._calc_tree:
-            # used to build the process tree
-            par_ch = defaultdict(list)
         procs = []
         # sum up process categories
         proc_stats = defaultdict(lambda: defaultdict(lambda: 0.0))
@@ -310,27 +393,28 @@ class SmcTop(object):
         for proc_class in CATEGORY:
             proc_stats[proc_class]["instances"] = 0
 
-        # cpu_percent needs to be called twice for meaningful values
-        for p in self.user_processes():
-            p.cpu_percent()
-        sleep(self.sample_interval)
-
         def check(fn):
             try:
                 return fn()
             except ps.AccessDenied:
                 return None
 
-        for p in self.user_processes():
-            io = check(p.io_counters)
-            mem = p.memory_info_ex()
-
-            # relative cpu time usage
-            cpu_times = p.cpu_times()
+        self._scan()
+        for pid, info in sorted(self._cache.items()):
+            p = info["proc"]
+            try:
+                io = check(p.io_counters)
+                mem = p.memory_info_ex()
+                cpu_percent = p.cpu_percent()
+                # relative cpu time usage
+                cpu_times = p.cpu_times()
+                open_files = check(p.num_fds)
+            except ps.NoSuchProcess:
+                continue
             time_rel = cpu_times.user + cpu_times.system
 
             # absolute cpu time usage
-            start = datetime.fromtimestamp(p.create_time()).replace(tzinfo=utc)
+            start = info["start"]
             time_abs = (now - start).total_seconds()
 
             # memory in pct of cgroup limit, exclucing swap.
@@ -340,29 +424,25 @@ class SmcTop(object):
             else:
                 mem_pct = 0.
 
-            proc_class = classify_proc(p)
+            proc_class = info["category"]
             proc_stats[proc_class]["instances"] += 1
-            proc_stats[proc_class]["cpu"] += p.cpu_percent()
+            proc_stats[proc_class]["cpu"] += cpu_percent
             proc_stats[proc_class]["mem"] += mem_pct
             proc_stats[proc_class]["time"] += time_rel
 
-            if self._calc_tree:
-                for chpid in [ch.pid for ch in p.children()]:
-                    par_ch[p.pid].append(chpid)
-
             procs.append({
-                "pid": p.pid,
+                "pid": pid,
                 # funny thing: name, path and cmdline can be uneqal
-                "name": p.name(),
+                "name": info["name"],
                 # The process executable as an absolute path.
-                "path": check(p.exe),
+                "path": info["path"],
                 "category": proc_class,
-                "command_line": p.cmdline(),
-                "open_files": check(p.num_fds),
+                "command_line": info["command_line"],
+                "open_files": open_files,
                 #"threads": p.threads(),
                 "read": io.read_bytes if io else 0,
                 "write": io.write_bytes if io else 0,
-                "cpu_percent": p.cpu_percent(),
+                "cpu_percent": cpu_percent,
                 "time": {
                     "started": datetime.isoformat(start),
                     "absolute": time_abs,
@@ -380,6 +460,13 @@ class SmcTop(object):
             })
 
         if self._calc_tree:
+            # used to build the process tree
+            par_ch = defaultdict(list)
+            for p in procs:
+                ppid = self._cache[p["pid"]]["ppid"]
+                if ppid in self._cache:
+                    par_ch[ppid].append(p["pid"])
+
             tree = defaultdict(dict)
             for par, chlds in par_ch.items():
                 for ch in chlds:
@@ -401,6 +488,14 @@ class SmcTop(object):
         '''
         stitch together the gathered data
         '''
+        if self._sampler is not None and self._data is not None:
+            return self._data
+        data = self._read_snapshot()
+        if data is not None:
+            return data
+        return self._sample()
+
+    def _sample(self):
         from datetime import datetime
 
         self.capture()
@@ -422,6 +517,55 @@ class SmcTop(object):
 
         return data
 
+    def _read_snapshot(self):
+        '''
+        The latest sample of a resident smc-top for this user, if it is fresh.
+        '''
+        try:
+            data = load(open(SNAPSHOT % self.userid, 'r'))
+            age = time.time() - data.pop("sampled")
+            if age > 2 * data.pop("interval") + 1:
+                return None
+        except (IOError, ValueError, KeyError):
+            return None
+        if self._calc_tree:
+            if "tree" not in data:
+                return None
+        else:
+            data.pop("tree", None)
+        self.now = date_parser(data["timestamp"])
+        return data
+
+    def start(self):
+        '''
+        Sample every `sample_interval` seconds in a background thread;
+        afterwards `data()` returns the latest sample instantly.
+        '''
+        from threading import Thread
+        if self._sampler is None:
+            self._data = self._sample()
+            self._sampler = Thread(target=self.run)
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def run(self, snapshot=None):
+        '''
+        Sample every `sample_interval` seconds forever. If `snapshot` is
+        given, each sample is also written to it, for other invocations.
+        '''
+        import json
+        while True:
+            t0 = time.time()
+            data = self._sample()
+            self._data = data
+            if snapshot is not None:
+                data = dict(data, sampled=t0, interval=self.sample_interval)
+                tmp = "%s.%d" % (snapshot, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(data, f)
+                os.rename(tmp, snapshot)
+            time.sleep(max(0, self.sample_interval - (time.time() - t0)))
+
     def json(self, indent=None):
         '''
         Generates a JSON datastructure of the gathered information.
@@ -551,6 +695,20 @@ def parse_arguments():
         type=float,
         help="sampling interval in seconds")
 
+    paa("--history",
+        default=20,
+        metavar="N",
+        type=int,
+        help="number of samples of cgroup cpu and memory usage\
+        used to compute their rates of change")
+
+    paa("--resident",
+        default=False,
+        action="store_true",
+        help="keep sampling every --interval seconds and write\
+        each sample to the snapshot file, which other invocations\
+        return instantly while it is fresh")
+
     paa("--summarize",
         default=False,
         action="store_true",
@@ -572,7 +730,12 @@ def main():
     format = args.__dict__.pop("format")
     sortby = args.__dict__.pop("sortby")
     indent = args.__dict__.pop("indent")
+    resident = args.__dict__.pop("resident")
     top = SmcTop(**args.__dict__)
+    if resident:
+        # the tree is always included, since readers may ask for it
+        top._calc_tree = True
+        top.run(snapshot=SNAPSHOT % top.userid)
     if format == "json":
         return top.json(indent=indent)
     elif format == "text":
@@ -22,7 +22,10 @@
 
 MARKERS = {'cell':u"\uFE20", 'output':u"\uFE21"}
 
-import cPickle, json, os, sys
+import cPickle, errno, json, os, shutil, sys
+
+# sws files are read in a single sequential pass in blocks of this size
+STREAM_BUFSIZE = 1 << 16
 
 from uuid import uuid4
 def uuid():
@@ -91,8 +94,12 @@ def migrate_input(s):
     return s
 
 def sws_body_to_sagews(body):
+    return u''.join(sws_body_cells(body))
 
-    out = u""
+def sws_body_cells(body):
+    """
+    Generator of the sagews cells (unicode strings) for the worksheet.html body of an sws file.
+    """
     i = 0
     while i!=-1 and i <len(body):
         j = body.find("{{{", i)
@@ -129,11 +136,11 @@ def sws_body_to_sagews(body):
 
 
         if html:
-            out += MARKERS['cell'] + uuid() + 'i' + MARKERS['cell'] + u'\n'
-            out += '%html\n'
-            out += html + u'\n'
-            out += (u'\n' + MARKERS['output'] + uuid() + MARKERS['output'] +
-                    json.dumps({'html':html}) + MARKERS['output']) + u'\n'
+            yield (MARKERS['cell'] + uuid() + 'i' + MARKERS['cell'] + u'\n' +
+                   '%html\n' +
+                   html + u'\n' +
+                   u'\n' + MARKERS['output'] + uuid() + MARKERS['output'] +
+                   json.dumps({'html':html}) + MARKERS['output'] + u'\n')
 
         if input or output:
             modes = ''
@@ -143,12 +150,10 @@ def sws_body_to_sagews(body):
                 modes += 'i'
             if '%hideall' in input:
                 modes += 'o'
-            out += MARKERS['cell'] + uuid() + modes + MARKERS['cell'] + u'\n'
-            out += input
-            out += (u'\n' + MARKERS['output'] + uuid() + MARKERS['output'] +
-                    output_messages(output) + MARKERS['output']) + u'\n'
-
-    return out
+            yield (MARKERS['cell'] + uuid() + modes + MARKERS['cell'] + u'\n' +
+                   input +
+                   u'\n' + MARKERS['output'] + uuid() + MARKERS['output'] +
+                   output_messages(output) + MARKERS['output'] + u'\n')
 
 def extra_modes(meta):
     s = ''
@@ -161,72 +166,167 @@ def extra_modes(meta):
     # The 'a' means "auto".
     return MARKERS['cell'] + uuid() + 'a' + MARKERS['cell'] + u'\n%auto\n' + s
 
-def write_data_files(t):
-    prefix = 'sage_worksheet/data/'
-    data = [p.path for p in t if p.path.startswith(prefix)]
-    out = []
-    target = "foo.data"
-    if data:
-        if not os.path.exists(target):
-            os.makedirs(target)
-        for p in data:
-            dest = os.path.join(target, p[len(prefix):])
-            out.append(dest)
-            open(dest,'wb').write(t.extractfile(p).read())
-    return out, target
+def makedirs(path):
+    # several conversions may run at once
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
 
 def sws_to_sagews(filename):
     """
     Convert a Sage Notebook sws file to a SageMath Cloud sagews file.
 
+    The sws file is read in one sequential pass: data files are copied to disk
+    and cells are written as they are converted, so memory use doesn't depend
+    on the size of the worksheet or its data.
+
     INPUT:
     - ``filename`` -- the name of an sws file, say foo.sws
 
     OUTPUT:
-    - creates a file foo[-n].sagews  and returns the name of the output file
+    - creates a file foo.sagews and returns its name, or None if it already exists;
+      the data files of the worksheet are put in the directory foo.data next to it
     """
-    out = ''
-
-    import os, tarfile
-    t = tarfile.open(name=filename, mode='r:bz2', bufsize=10240)
-    body = t.extractfile('sage_worksheet/worksheet.html').read()
-
-    data_files, data_path = write_data_files(t)
-    if data_files:
-        out += MARKERS['cell'] + uuid() + 'ai' + MARKERS['cell'] + u'\n%%hide\n%%auto\nDATA="%s/"\n'%data_path
-
-    meta = cPickle.loads(t.extractfile('sage_worksheet/worksheet_conf.pickle').read())
-
-    out += sws_body_to_sagews(body)
-    out = extra_modes(meta) + out
+    import tarfile, tempfile
 
     base = os.path.splitext(filename)[0]
-    i = 0
     outfile = base + '.sagews'
     if os.path.exists(outfile):
         sys.stderr.write("%s: Warning --Sagemath cloud worksheet '%s' already exists.  Not overwriting.\n"%(sys.argv[0], outfile))
         sys.stderr.flush()
-    else:
+        return None
+
+    prefix = 'sage_worksheet/data/'
+    target = base + '.data'
+    tmp = outfile + '.tmp'
+    meta = None
+    data_files = []
+    # the cells, which have to come after the cells made from the metadata and data files
+    body = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(outfile)))
+    # the data files are written here, and the directory is renamed to target with the worksheet
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)),
+                              prefix='.' + os.path.basename(target) + '.')
+    try:
+        t = tarfile.open(name=filename, mode='r|bz2', bufsize=STREAM_BUFSIZE)
+        try:
+            for member in t:
+                if not member.isfile():
+                    continue
+                if member.name == 'sage_worksheet/worksheet.html':
+                    for cell in sws_body_cells(t.extractfile(member).read()):
+                        body.write(cell.encode('utf8'))
+                elif member.name == 'sage_worksheet/worksheet_conf.pickle':
+                    meta = cPickle.loads(t.extractfile(member).read())
+                elif member.name.startswith(prefix):
+                    dest = os.path.join(tmpdir, member.name[len(prefix):])
+                    makedirs(os.path.dirname(dest))
+                    with open(dest, 'wb') as f:
+                        shutil.copyfileobj(t.extractfile(member), f)
+                    data_files.append(dest)
+        finally:
+            t.close()
+        if meta is None:
+            raise ValueError("%s is not an sws file -- it has no worksheet_conf.pickle"%filename)
+        if data_files and os.path.exists(target):
+            raise ValueError("the data directory '%s' already exists"%target)
+
+        out = extra_modes(meta)
+        if data_files:
+            out += MARKERS['cell'] + uuid() + 'ai' + MARKERS['cell'] + u'\n%%hide\n%%auto\nDATA="%s/"\n'%os.path.basename(target)
+
         sys.stdout.write("%s: Creating Sagemath cloud worksheet '%s'\n"%(sys.argv[0], outfile))
         sys.stdout.flush()
-        open(outfile,'w').write(out.encode('utf8'))
+        with open(tmp, 'wb') as f:
+            f.write(out.encode('utf8'))
+            body.seek(0)
+            shutil.copyfileobj(body, f)
+        if data_files:
+            os.rename(tmpdir, target)
+        try:
+            os.rename(tmp, outfile)
+        except OSError:
+            if data_files:
+                shutil.rmtree(target, ignore_errors=True)
+            raise
+    finally:
+        body.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return outfile
+
+def sws_files(paths):
+    """
+    The given sws files, and the sws files in the given directories (recursively),
+    each only once.
+    """
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files = []
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.sws'))
+        else:
+            files = [path]
+        for filename in files:
+            key = os.path.realpath(filename)
+            if key not in seen:
+                seen.add(key)
+                yield filename
+
+def _convert(path):
+    try:
+        sws_to_sagews(path)
+        return path, None
+    except Exception, mesg:
+        return path, str(mesg)
 
+def convert_all(paths, processes=None):
+    """
+    Convert the given sws files and the sws files in the given directories, in
+    parallel using ``processes`` worker processes (default: one per core).
+
+    Returns the list of pairs (path, error message) for the files that failed.
+    """
+    from multiprocessing import Pool, cpu_count
+    files = list(sws_files(paths))
+    if processes is None:
+        processes = cpu_count()
+    if len(files) <= 1 or processes <= 1:
+        results = [_convert(path) for path in files]
+    else:
+        pool = Pool(min(processes, len(files)))
+        try:
+            results = list(pool.imap_unordered(_convert, files))
+        finally:
+            pool.close()
+            pool.join()
+    errors = [(path, mesg) for path, mesg in results if mesg is not None]
+    for path, mesg in errors:
+        sys.stderr.write("%s: Error converting '%s' -- %s\n"%(sys.argv[0], path, mesg))
+    sys.stderr.flush()
+    return errors
 
 def main():
     if len(sys.argv) == 1:
         sys.stderr.write("""
 Convert a Sage Notebook sws file to a SageMath Cloud sagews file.
 
-    Usage: %s path/to/filename.sws [path/to/filename2.sws] ...
+    Usage: %s path/to/filename.sws [path/to/filename2.sws | path/to/directory] ...
 
 Creates corresponding file path/to/filename.sagews, if it doesn't exist.
-Also, a data/ directory may be created in the current directory, which contains
-the contents of the data path in filename.sws.
+All sws files in a given directory are converted; several files are converted
+in parallel, using one process per core.
+Also, a directory path/to/filename.data may be created, which contains the
+contents of the data path in filename.sws.
 """%sys.argv[0])
         sys.exit(1)
 
-    for path in sys.argv[1:]:
-        sws_to_sagews(path)
+    if convert_all(sys.argv[1:]):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
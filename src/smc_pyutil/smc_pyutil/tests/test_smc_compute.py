@@ -0,0 +1,95 @@
+import os, random, shutil, tempfile, zipfile
+from cStringIO import StringIO
+from unittest import TestCase
+
+from smc_pyutil import smc_compute
+
+PROJECT_ID = '4b7e3b5c-1a2d-4e8f-9a0b-1c2d3e4f5a6b'
+
+class TestZipStream(TestCase):
+    def setUp(self):
+        self.projects = tempfile.mkdtemp()
+        self.project = smc_compute.Project(PROJECT_ID, dev=True, projects=self.projects)
+        path = os.path.join(self.project.project_path, 'd')
+        os.makedirs(os.path.join(path, 'sub'))
+        os.makedirs(os.path.join(path, 'empty'))
+        self.files = {
+            'd/a.txt'        : 'hello\n' * 1000,
+            'd/sub/b.bin'    : ''.join(chr(random.randrange(256)) for i in range(3*smc_compute.STREAM_CHUNK_SIZE + 17)),
+            'd/sub/empty.txt': '',
+            u'd/\xe9t\xe9.txt'.encode('utf-8') : 'unicode name',
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.project.project_path, name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.projects)
+
+    def test_stream_directory(self):
+        out = StringIO()
+        self.project.stream_file('d.zip', 10**8, out)
+        z = zipfile.ZipFile(StringIO(out.getvalue()))
+        self.assertEqual(z.testzip(), None)
+        names = [name.encode('utf-8') if isinstance(name, unicode) else name for name in z.namelist()]
+        self.assertEqual(sorted(name for name in names if not name.endswith('/')), sorted(self.files))
+        self.assertTrue('d/empty/' in names)
+        for info in z.infolist():
+            name = info.filename.encode('utf-8') if isinstance(info.filename, unicode) else info.filename
+            if name in self.files:
+                self.assertEqual(z.read(info), self.files[name])
+
+    def test_read_file_is_the_same_zip(self):
+        import base64
+        content = base64.b64decode(self.project.read_file('d.zip', 10**8)['base64'])
+        self.assertEqual(zipfile.ZipFile(StringIO(content)).testzip(), None)
+
+    def test_stream_file(self):
+        out = StringIO()
+        self.project.stream_file('d/sub/b.bin', 10**8, out)
+        self.assertEqual(out.getvalue(), self.files['d/sub/b.bin'])
+
+    def test_maxsize(self):
+        self.assertRaises(RuntimeError, self.project.stream_file, 'd.zip', 1000, StringIO())
+        self.assertRaises(RuntimeError, self.project.stream_file, 'd/sub/b.bin', 1000, StringIO())
+
+    def test_outside_project(self):
+        self.assertRaises(RuntimeError, self.project.stream_file, '../x', 10**8, StringIO())
+
+class TestListingCache(TestCase):
+    def setUp(self):
+        self.projects = tempfile.mkdtemp()
+        self.project = smc_compute.Project(PROJECT_ID, dev=True, projects=self.projects)
+        self.path = os.path.join(self.project.project_path, 'big')
+        os.makedirs(self.path)
+        for i in range(smc_compute.LISTING_CACHE_MIN_ENTRIES):
+            open(os.path.join(self.path, 'f%s'%i), 'w').close()
+        os.mkdir(os.path.join(self.path, '\xc3\xa9'))
+        self.cache_path = smc_compute.LISTING_CACHE_PATH
+        smc_compute.LISTING_CACHE_PATH = os.path.join(self.projects, 'cache')
+
+    def tearDown(self):
+        smc_compute.LISTING_CACHE_PATH = self.cache_path
+        shutil.rmtree(self.projects)
+
+    def cache_files(self):
+        return os.listdir(smc_compute.LISTING_CACHE_PATH)
+
+    def test_cached_listing_is_the_same(self):
+        listing = self.project.directory_listing('big')
+        self.assertEqual(len(self.cache_files()), 1)
+        self.assertEqual(os.stat(smc_compute.LISTING_CACHE_PATH).st_mode & 0777, 0700)
+        self.assertEqual(self.project.directory_listing('big'), listing)
+        self.assertEqual(self.project.directory_listing('big', time=False, start=10, limit=5)['files'],
+                         sorted(listing['files'], key=lambda x: x['name'])[10:15])
+
+    def test_change_invalidates_cache(self):
+        n = len(self.project.directory_listing('big')['files'])
+        os.unlink(os.path.join(self.path, 'f0'))
+        self.assertEqual(len(self.project.directory_listing('big')['files']), n - 1)
+
+    def test_cache_writable_by_others_is_not_used(self):
+        os.makedirs(smc_compute.LISTING_CACHE_PATH, 0777)
+        os.chmod(smc_compute.LISTING_CACHE_PATH, 0777)
+        self.project.directory_listing('big')
+        self.assertEqual(self.cache_files(), [])
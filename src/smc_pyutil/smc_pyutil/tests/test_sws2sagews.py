@@ -0,0 +1,71 @@
+import cPickle, os, shutil, tarfile, tempfile
+from cStringIO import StringIO
+from unittest import TestCase
+
+from smc_pyutil import sws2sagews
+
+def make_sws(filename, files):
+    t = tarfile.open(filename, 'w:bz2')
+    for name, content in sorted(files.items()):
+        info = tarfile.TarInfo('sage_worksheet/' + name)
+        info.size = len(content)
+        t.addfile(info, StringIO(content))
+    t.close()
+
+def worksheet(data):
+    files = {
+        'worksheet.html'        : '{{{id=1|\n2+2\n///\n4\n}}}\n',
+        'worksheet_conf.pickle' : cPickle.dumps({'pretty_print':False, 'system':'sage'}),
+    }
+    for name, content in data.items():
+        files['data/' + name] = content
+    return files
+
+class TestConvert(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def join(self, *names):
+        return os.path.join(self.path, *names)
+
+    def read(self, *names):
+        with open(self.join(*names)) as f:
+            return f.read()
+
+    def test_data_files_do_not_clash(self):
+        names = ['a', 'b', 'c', 'd']
+        for name in names:
+            make_sws(self.join(name + '.sws'), worksheet({'plot.png': 'plot of ' + name, 'sub/x.txt': name}))
+        self.assertEqual(sws2sagews.convert_all([self.path], processes=len(names)), [])
+        for name in names:
+            self.assertEqual(self.read(name + '.data', 'plot.png'), 'plot of ' + name)
+            self.assertEqual(self.read(name + '.data', 'sub', 'x.txt'), name)
+            self.assertTrue('DATA="%s.data/"'%name in self.read(name + '.sagews').decode('utf8'))
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         sorted(name + ext for name in names for ext in ['.sws', '.sagews', '.data']))
+
+    def test_files_are_converted_once(self):
+        make_sws(self.join('a.sws'), worksheet({'plot.png': 'plot'}))
+        os.symlink('a.sws', self.join('b.sws'))
+        paths = [self.path, self.join('a.sws'), self.join('.', 'a.sws'), self.join('b.sws')]
+        self.assertEqual(list(sws2sagews.sws_files(paths)), [self.join('a.sws')])
+        self.assertEqual(sws2sagews.convert_all(paths), [])
+
+    def test_nothing_left_on_failure(self):
+        files = worksheet({'plot.png': 'plot'})
+        del files['worksheet_conf.pickle']
+        make_sws(self.join('a.sws'), files)
+        errors = sws2sagews.convert_all([self.join('a.sws')])
+        self.assertEqual([path for path, mesg in errors], [self.join('a.sws')])
+        self.assertEqual(os.listdir(self.path), ['a.sws'])
+
+    def test_existing_worksheet_is_kept(self):
+        make_sws(self.join('a.sws'), worksheet({'plot.png': 'plot'}))
+        with open(self.join('a.sagews'), 'w') as f:
+            f.write('mine')
+        self.assertEqual(sws2sagews.sws_to_sagews(self.join('a.sws')), None)
+        self.assertEqual(self.read('a.sagews'), 'mine')
+        self.assertFalse(os.path.exists(self.join('a.data')))
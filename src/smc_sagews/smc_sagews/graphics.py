@@ -19,7 +19,7 @@
 #
 ###############################################################################
 
-import json, math
+import hashlib, json, math
 import sage_salvus
 
 from uuid import uuid4
@@ -96,7 +96,8 @@ class ThreeJS(object):
                                      'spin'            : spin,
                                      'aspect_ratio'    : aspect_ratio
                                      })
-        self._graphics = []
+        self._objects = {}   # id --> state of an object added to the scene; see add
+        self._last_frame = None
         self._call('init()')
 
     def _call(self, s, obj=None):
@@ -105,17 +106,11 @@ class ThreeJS(object):
         self._salvus.execute_javascript(cmd, obj=obj)
 
     def bounding_box(self):
-        if not self._graphics:
+        boxes = [x['bbox'] for x in self._objects.itervalues() if x['bbox'] is not None]
+        if not boxes:
             return -1,1,-1,1,-1,1
-        b = self._graphics[0].bounding_box()
-        xmin, xmax, ymin, ymax, zmin, zmax = b[0][0], b[1][0], b[0][1], b[1][1], b[0][2], b[1][2]
-        for g in self._graphics[1:]:
-            b = g.bounding_box()
-            xmin, xmax, ymin, ymax, zmin, zmax = (
-                  min(xmin,b[0][0]), max(b[1][0],xmax),
-                  min(b[0][1],ymin), max(b[1][1],ymax),
-                  min(b[0][2],zmin), max(b[1][2],zmax))
-        v = xmin, xmax, ymin, ymax, zmin, zmax
+        lo, hi = _box_union(boxes)
+        v = lo[0], hi[0], lo[1], hi[1], lo[2], hi[2]
         return [json_float(x) for x in v]
 
     def frame_options(self):
@@ -123,13 +118,87 @@ class ThreeJS(object):
         return {'xmin':xmin, 'xmax':xmax, 'ymin':ymin, 'ymax':ymax, 'zmin':zmin, 'zmax':zmax,
                 'draw' : self._frame}
 
-    def add(self, graphics3d, **kwds):
+    def add(self, graphics3d, id=None, lod=True, **kwds):
+        """
+        Add graphics3d to the scene and return its id.
+
+        If the scene already has an object with the given id, it is replaced
+        by graphics3d and only what changed is sent to the browser: the
+        transformation, if graphics3d is the same object translated, rotated,
+        etc. differently; the colors of surfaces and lines whose shape is the
+        same; and the pieces that really changed.
+
+        If lod is True, surfaces with at least LOD_MIN_FACES faces are sent
+        as decimated versions first (see decimate_mesh), which are kept for
+        when the camera is far away, and then at full resolution.
+        """
         kwds = graphics3d._process_viewing_options(kwds)
-        self._graphics.append(graphics3d)
-        obj = {'obj'       : graphics3d_to_jsonable(graphics3d),
-               'wireframe' : jsonable(kwds.get('wireframe')),
-               'set_frame' : self.frame_options()}
-        self._call('add_3dgraphics_obj(obj)', obj=obj)
+        wireframe = jsonable(kwds.get('wireframe'))
+        if isinstance(graphics3d, sage.plot.plot3d.base.TransformGroup):
+            # the transformation is applied by the browser, so moving an object
+            # around only sends the new matrix.
+            matrix = [json_float(x) for x in graphics3d.get_transformation().get_matrix().list()]
+            box = _box_union([g.bounding_box() for g in graphics3d.all])
+        else:
+            matrix = None
+            box = graphics3d.bounding_box()
+        pieces = graphics3d_to_jsonable(graphics3d, transform=matrix is None)
+        keys = [_piece_keys(piece, wireframe) for piece in pieces]
+
+        if id is None:
+            id = uuid()
+        old = self._objects.get(id)
+        self._objects[id] = {'keys':keys, 'matrix':matrix, 'bbox':_transform_box(box, matrix)}
+        frame = self.frame_options()
+
+        refine = []
+        def send(i, piece):
+            levels = _lod_levels(piece) if lod else []
+            if not levels:
+                return piece
+            for rank, level in enumerate(levels[1:]):
+                refine.append((rank, i, level))
+            return dict(piece, vertex_geometry=[], face_geometry=[], lod=levels[:1],
+                        lod_center=[json_float(x) for x in _box_center(box)])
+
+        if old is None:
+            obj = {'id'        : id,
+                   'obj'       : [send(i, piece) for i, piece in enumerate(pieces)],
+                   'wireframe' : wireframe,
+                   'matrix'    : matrix,
+                   'set_frame' : frame}
+            self._call('add_3dgraphics_obj(obj)', obj=obj)
+        else:
+            changes = []
+            for i, piece in enumerate(pieces):
+                shape, style = keys[i]
+                if i < len(old['keys']) and old['keys'][i][0] == shape:
+                    if style != old['keys'][i][1]:
+                        changes.append([i, {'style':style}])
+                else:
+                    changes.append([i, {'obj':send(i, piece)}])
+            obj = {'id':id, 'changes':changes, 'length':len(pieces), 'wireframe':wireframe}
+            if matrix != old['matrix']:
+                obj['matrix'] = IDENTITY_MATRIX if matrix is None else matrix
+            if frame != self._last_frame:
+                obj['set_frame'] = frame
+            if changes or len(pieces) != len(old['keys']) or 'matrix' in obj or 'set_frame' in obj:
+                self._call('update_3dgraphics_obj(obj)', obj=obj)
+        self._last_frame = frame
+
+        # refine the decimated surfaces, all of them a level at a time
+        refine.sort(key=lambda x: x[0])
+        for _, i, level in refine:
+            self._call('refine_3dgraphics_obj(obj)', obj={'id':id, 'index':i, 'level':level})
+        return id
+
+    def remove(self, id):
+        """
+        Remove the object with the given id (see add) from the scene.
+        """
+        del self._objects[id]
+        self._last_frame = frame = self.frame_options()
+        self._call('remove_3dgraphics_obj(obj)', obj={'id':id, 'set_frame':frame})
 
     def render_scene(self, force=True):
         self._call('render_scene(obj)', obj={'force':force})
@@ -159,6 +228,7 @@ def show_3d_plot_using_threejs(g, **kwds):
     t.init_done()
 
 import sage.plot.plot3d.index_face_set
+import sage.plot.plot3d.parametric_surface
 import sage.plot.plot3d.shapes
 import sage.plot.plot3d.base
 import sage.plot.plot3d.shapes2
@@ -169,7 +239,201 @@ def jsonable(x):
         return json_float(x)
     return x
 
-def graphics3d_to_jsonable(p):
+# IndexFaceSets with at least this many faces are sent as a binary blob (see
+# mesh_to_binary), when graphics3d_to_jsonable is given a way to send blobs;
+# smaller ones are sent as JSON lists.
+BINARY_MESH_MIN_FACES = 1000
+
+def mesh_triangles(faces):
+    """
+    Return the triangles of the given polygonal faces (lists of vertex indices),
+    as an n x 3 numpy array; each polygon is split into a fan of triangles,
+    as 3d.coffee does when rendering.
+    """
+    import numpy
+    by_length = {}
+    for f in faces:
+        by_length.setdefault(len(f), []).append(f)
+    v = []
+    for n, fs in by_length.iteritems():
+        if n < 3:
+            continue
+        a = numpy.array(fs, dtype=numpy.uint32)
+        for k in range(1, n-1):
+            v.append(a[:, [0, k, k+1]])
+    if not v:
+        return numpy.zeros((0, 3), dtype=numpy.uint32)
+    return numpy.concatenate(v)
+
+def mesh_faces(p):
+    """
+    Return the faces of the IndexFaceSet p as lists of vertex indices,
+    without changing p.  A ParametricSurface computes its mesh when it is
+    triangulated, but triangulating any other IndexFaceSet would split the
+    faces of the user's object in place; mesh_triangles splits them instead.
+    """
+    if isinstance(p, sage.plot.plot3d.parametric_surface.ParametricSurface):
+        p.triangulate()
+    return p.index_faces()
+
+def mesh_to_binary(vertices, triangles, quantize=False, dedup=True):
+    """
+    Pack a triangle mesh into a little-endian binary string: the vertex
+    coordinates as float32 triples (uint16 triples if quantize is True), padded
+    to a multiple of 4 bytes, followed by the uint32 vertex indices of the
+    triangles.  If dedup is True, vertices with the same (packed) coordinates
+    are merged.
+
+    Returns (data, info), where info is the JSON-able description of the layout
+    that 3d.coffee needs to read data.
+    """
+    import numpy
+    v = numpy.array(vertices, dtype=numpy.float64).reshape(-1, 3)
+    v[~numpy.isfinite(v)] = 0
+    t = numpy.asarray(triangles, dtype=numpy.uint32).reshape(-1, 3)
+    info = {'vertex_type':'float32'}
+    if quantize:
+        lo = v.min(axis=0) if len(v) else numpy.zeros(3)
+        scale = ((v.max(axis=0) if len(v) else lo) - lo) / 65535.0
+        scale[scale == 0] = 1
+        v = numpy.rint((v - lo) / scale).astype('<u2')
+        info = {'vertex_type':'uint16', 'offset':lo.tolist(), 'scale':scale.tolist()}
+    else:
+        v = v.astype('<f4')
+    if dedup and len(v):
+        rows = numpy.ascontiguousarray(v).view(numpy.dtype((numpy.void, v.dtype.itemsize * 3)))
+        _, first, inverse = numpy.unique(rows.ravel(), return_index=True, return_inverse=True)
+        v = v[first]
+        t = inverse.astype(numpy.uint32)[t]
+    vdata = v.tobytes()
+    vdata += '\0' * (-len(vdata) % 4)
+    info.update({'vertices':len(v), 'triangles':len(t), 'index_offset':len(vdata)})
+    return vdata + t.astype('<u4').tobytes(), info
+
+# Surfaces with at least this many triangles that are added to a ThreeJS scene
+# also get decimated versions, which are shown while the camera is far away.
+LOD_MIN_FACES = 20000
+
+# (grid resolution, camera distance in units of the size of the surface) of
+# each decimated version; see decimate_mesh.
+LOD_LEVELS = [(24, 8.0), (64, 4.0)]
+
+IDENTITY_MATRIX = [1.0, 0.0, 0.0, 0.0,  0.0, 1.0, 0.0, 0.0,  0.0, 0.0, 1.0, 0.0,  0.0, 0.0, 0.0, 1.0]
+
+def decimate_mesh(vertices, triangles, resolution):
+    """
+    Simplify a triangle mesh by vertex clustering: snap the vertices to a grid
+    with resolution cells along the longest side of the bounding box, replace
+    the vertices in each cell by their average, and drop the triangles that
+    collapse or become duplicates.
+
+    Returns (vertices, triangles) as numpy arrays.
+    """
+    import numpy
+    v = numpy.array(vertices, dtype=numpy.float64).reshape(-1, 3)
+    v[~numpy.isfinite(v)] = 0
+    t = numpy.asarray(triangles, dtype=numpy.int64).reshape(-1, 3)
+    if not len(v):
+        return v, t
+    lo = v.min(axis=0)
+    size = (v.max(axis=0) - lo).max() / resolution
+    if size == 0:
+        return v, t
+    cell = numpy.floor((v - lo) / size).astype(numpy.int64)
+    key = (cell[:,0] * (resolution + 1) + cell[:,1]) * (resolution + 1) + cell[:,2]
+    _, inverse = numpy.unique(key, return_inverse=True)
+    n = inverse.max() + 1
+    count = numpy.bincount(inverse, minlength=n).astype(numpy.float64)
+    v = numpy.column_stack([numpy.bincount(inverse, weights=v[:,k], minlength=n) for k in range(3)]) / count[:,None]
+    t = inverse[t]
+    t = t[(t[:,0] != t[:,1]) & (t[:,1] != t[:,2]) & (t[:,0] != t[:,2])]
+    if len(t):
+        rows = numpy.ascontiguousarray(numpy.sort(t, axis=1)).view(numpy.dtype((numpy.void, t.dtype.itemsize * 3)))
+        _, first = numpy.unique(rows.ravel(), return_index=True)
+        t = t[numpy.sort(first)]
+    return v, t
+
+def _lod_levels(piece):
+    """
+    Return the levels of detail of the JSON-able piece of a scene, coarsest
+    first and the piece itself last, or [] if it is too small for them.
+    """
+    if piece.get('type') != 'index_face_set' or len(piece.get('face_geometry', ())) != 1:
+        return []
+    faces = piece['face_geometry'][0]['faces']
+    n = sum(len(f) - 2 for f in faces)
+    if n < LOD_MIN_FACES:
+        return []
+    import numpy
+    v = numpy.array(piece['vertex_geometry'], dtype=numpy.float64).reshape(-1, 3)
+    v[~numpy.isfinite(v)] = 0
+    size = (v.max(axis=0) - v.min(axis=0)).max() if len(v) else 0
+    if size == 0:
+        return []
+    t = mesh_triangles(faces).astype(numpy.int64) - 1
+    name = piece['face_geometry'][0]['material_name']
+    levels = [{'distance'        : 0,
+               'vertex_geometry' : piece['vertex_geometry'],
+               'face_geometry'   : piece['face_geometry']}]
+    for resolution, distance in reversed(LOD_LEVELS):
+        v2, t2 = decimate_mesh(v, t, resolution)
+        if len(t2) > n // 2:
+            continue  # not worth it
+        n = len(t2)
+        levels.append({'distance'        : json_float(distance * size),
+                       'vertex_geometry' : v2.ravel().tolist(),
+                       'face_geometry'   : [{'material_name':name, 'faces':(t2 + 1).tolist()}]})
+    return levels[::-1] if len(levels) > 1 else []
+
+# The parts of the JSON-able pieces of a scene that 3d.coffee can change
+# without rebuilding the piece.
+STYLE_KEYS = {'index_face_set':('material',), 'line':('color',)}
+
+def _piece_keys(piece, wireframe):
+    """
+    Return (shape, style) for the JSON-able piece of a scene: a hash of
+    everything but its style, and the style, or None if changing the style
+    requires rebuilding the piece.
+    """
+    keys = STYLE_KEYS.get(piece.get('type'), ())
+    if wireframe or piece.get('wireframe') or piece.get('mesh'):
+        keys = ()
+    shape = dict((k, v) for k, v in piece.iteritems() if k not in keys)
+    shape = hashlib.sha1(json.dumps([shape, wireframe], sort_keys=True, separators=(',', ':'))).digest()
+    style = dict((k, piece[k]) for k in keys if k in piece) if keys else None
+    return shape, style
+
+def _box_union(boxes):
+    boxes = [b for b in boxes if b is not None]
+    if not boxes:
+        return None
+    return (tuple(min(b[0][i] for b in boxes) for i in range(3)),
+            tuple(max(b[1][i] for b in boxes) for i in range(3)))
+
+def _box_center(box):
+    return [(box[0][i] + box[1][i]) / 2.0 for i in range(3)]
+
+def _transform_box(box, matrix):
+    """
+    Return the bounding box of box transformed by the 4x4 matrix, which is
+    given as a list of 16 floats by rows.
+    """
+    if box is None or matrix is None:
+        return box
+    corners = [[box[(k >> i) & 1][i] for i in range(3)] for k in range(8)]
+    points = [[sum(matrix[4*i + j] * c[j] for j in range(3)) + matrix[4*i + 3] for i in range(3)] for c in corners]
+    return (tuple(min(p[i] for p in points) for i in range(3)),
+            tuple(max(p[i] for p in points) for i in range(3)))
+
+def graphics3d_to_jsonable(p, send_blob=None, quantize=False, transform=True):
+    """
+    Convert the Sage 3d graphics object p to a JSON-able list of objects for
+    3d.coffee.  If send_blob is given, it is called with the binary data of
+    each large mesh and must return the uuid of the blob it sent; the object
+    then refers to that blob instead of listing the vertices and faces.  If
+    transform is False and p is a TransformGroup, its own transformation is
+    not applied.
+    """
     obj_list = []
 
     def parse_obj(obj):
@@ -317,8 +581,8 @@ def graphics3d_to_jsonable(p):
     def convert_index_face_set_test(p, T, extra_kwds):
         if T is not None:
             p = p.transform(T=T)
-        p.triangulate()
-        face_geometry = [{"material_name": p.texture.id, "faces": [[int(v) for v in f] for f in p.index_faces()]}]
+        faces = mesh_triangles(mesh_faces(p))
+        face_geometry = [{"material_name": p.texture.id, "faces": [[int(v) for v in f] for f in faces]}]
         vertex_geometry = [json_float(t) for v in p.vertices() for t in v]
         material = parse_mtl(p)
         myobj = {"face_geometry"   : face_geometry,
@@ -332,7 +596,34 @@ def graphics3d_to_jsonable(p):
                     myobj[e] = jsonable(v)
         obj_list.append(myobj)
 
+    def convert_index_face_set_binary(p, T, extra_kwds):
+        import numpy
+        faces = mesh_faces(p)
+        if len(faces) < BINARY_MESH_MIN_FACES:
+            return False
+        v = numpy.array(list(p.vertices()), dtype=numpy.float64).reshape(-1, 3)
+        if T is not None:
+            M = numpy.array(T.get_matrix(), dtype=numpy.float64)
+            v = v.dot(M[:3,:3].T) + M[:3,3]
+        data, info = mesh_to_binary(v, mesh_triangles(faces), quantize=quantize)
+        info['uuid'] = send_blob(data)
+        myobj = {"face_geometry"   : [{"material_name": p.texture.id, "faces": []}],
+                 "type"            : 'index_face_set',
+                 "vertex_geometry" : [],
+                 "buffer"          : info,
+                 "material"        : parse_mtl(p)}
+        for e in ['wireframe', 'mesh']:
+            if p._extra_kwds is not None:
+                v = p._extra_kwds.get(e, None)
+                if v is not None:
+                    myobj[e] = jsonable(v)
+        obj_list.append(myobj)
+        return True
+
     def convert_index_face_set(p, T, extra_kwds):
+        if (send_blob is not None and isinstance(p, sage.plot.plot3d.index_face_set.IndexFaceSet)
+                and convert_index_face_set_binary(p, T, extra_kwds)):
+            return
         if T is not None:
             p = p.transform(T=T)
         face_geometry = parse_obj(p.obj())
@@ -419,7 +710,10 @@ def graphics3d_to_jsonable(p):
 
 
     # start it going -- this modifies obj_list
-    handler(p)(p, None, None)
+    if not transform and isinstance(p, sage.plot.plot3d.base.TransformGroup):
+        convert_combination(p, None, None)
+    else:
+        handler(p)(p, None, None)
 
     # now obj_list is full of the objects
     return obj_list
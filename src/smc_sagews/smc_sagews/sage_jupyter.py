@@ -22,6 +22,7 @@ import string
 import textwrap
 
 salvus = None  # set externally
+report_to_server = None  # set externally; sends a report to the sage server process
 
 # jupyter kernel
 
@@ -88,8 +89,217 @@ jupyter = JUPYTER()
 import jupyter_client
 from Queue import Empty
 from ansi2html import Ansi2HTMLConverter
-import tempfile, sys, re
+import sys, re
 import base64
+import glob, hashlib, time, urllib, uuid
+import zmq
+
+# Jupyter kernels take seconds to start, so the sage server process keeps this many
+# kernels running for each kernelspec that the worksheets of the project used recently.
+KERNEL_POOL_SIZE = 1
+# Kernels are no longer kept ready for a kernelspec that nobody asked for in this many seconds.
+KERNEL_POOL_IDLE_TIMEOUT = 30*60
+# Seconds a worksheet waits for a kernel it took from the pool to respond.
+KERNEL_READY_TIMEOUT = 60
+# While waiting for the output of a kernel, check that it is still alive every this many seconds.
+KERNEL_HEARTBEAT_INTERVAL = 5
+KERNEL_POOL_DIR = os.path.join(os.environ.get('SMC', os.path.expanduser('~/.smc')), 'jupyter_kernels')
+
+def _environment_key():
+    return hashlib.sha1(repr(sorted(os.environ.items()))).hexdigest()
+
+def _pool_path(kernel_name, cwd, env_key):
+    """
+    Directory of the connection files of the kernels that are ready for
+    kernel_name, running in the directory cwd with the environment env_key.
+    """
+    return os.path.join(KERNEL_POOL_DIR, kernel_name, hashlib.sha1(cwd + '\0' + env_key).hexdigest())
+
+class KernelPool(object):
+    """
+    Jupyter kernels that the sage server process starts ahead of time, so that
+    worksheets don't wait for them to start.  Kernels are kept ready per
+    kernelspec and working directory, and a worksheet only takes one that
+    runs in its own directory with its own environment (see _pool_path).
+    A kernel that is ready is listed by its connection file; a worksheet
+    process takes it by renaming that file (see _claim_kernel) and reports
+    this to the server, which starts another one, and shuts the kernel down
+    when that worksheet process terminates.
+    """
+    def __init__(self, size=KERNEL_POOL_SIZE, idle_timeout=KERNEL_POOL_IDLE_TIMEOUT, log=None):
+        self.size         = size
+        self.idle_timeout = idle_timeout
+        self.log          = log
+        self.wanted = {}   # (kernel name, cwd) --> time a worksheet last asked for one
+        self.ready  = {}   # (kernel name, cwd) --> list of managers of the kernels not taken yet
+        self.owned  = {}   # pid of a worksheet process --> list of managers of the kernels it took
+        self.hits   = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "kernel pool: ready=%s, hits=%s, misses=%s"%(
+            dict((k, len(v)) for k, v in self.ready.iteritems()), self.hits, self.misses)
+
+    def _log(self, *args):
+        if self.log is not None:
+            self.log(*args)
+
+    def want(self, kernel_name, cwd, env_key):
+        """
+        A worksheet running in cwd with the environment env_key started a
+        kernel for kernel_name itself, since none was ready.
+        """
+        self.misses += 1
+        if env_key != _environment_key():
+            # the worksheet changed its environment, so it can't use our kernels
+            return
+        self.wanted[(kernel_name, cwd)] = time.time()
+        self.refill()
+
+    def taken(self, kernel_name, cwd, connection_file, pid):
+        """
+        The worksheet process pid took the kernel with the given connection file.
+        """
+        key = (kernel_name, cwd)
+        self.wanted[key] = time.time()
+        for km in self.ready.get(key, []):
+            if km.connection_file == connection_file:
+                self.ready[key].remove(km)
+                self.owned.setdefault(pid, []).append(km)
+                self.hits += 1
+                break
+        self.refill()
+
+    def refill(self):
+        for key in list(self.wanted):
+            ready = self.ready.setdefault(key, [])
+            while len(ready) < self.size:
+                try:
+                    ready.append(self._start(*key))
+                except Exception as err:
+                    # e.g., no such kernel, or cwd was deleted; the worksheet gets the error when it starts one itself
+                    self._log("unable to start a jupyter kernel %s in %s: %s"%(key[0], key[1], err))
+                    del self.wanted[key]
+                    break
+
+    def _start(self, kernel_name, cwd):
+        path = _pool_path(kernel_name, cwd, _environment_key())
+        if not os.path.exists(path):
+            os.makedirs(path)
+        connection_file = os.path.join(path, 'kernel-%s.json'%uuid.uuid4())
+        km = jupyter_client.KernelManager(kernel_name=kernel_name, connection_file=connection_file)
+        km.start_kernel(cwd=cwd)
+        self._log("started jupyter kernel %s in %s with pid %s; %r"%(kernel_name, cwd, km.kernel.pid, self))
+        return km
+
+    def _shutdown(self, km, dead=False):
+        if dead:
+            # already reaped, so its pid may belong to another process by now
+            km.kernel = None
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception as err:
+            self._log("error shutting down jupyter kernel: %s"%err)
+        # also remove the connection file renamed by the worksheet that took it
+        for path in glob.glob(km.connection_file + '*'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        try:
+            # the directory of the pool for this kernelspec and cwd, once empty
+            os.rmdir(os.path.dirname(km.connection_file))
+        except OSError:
+            pass
+
+    def reaped(self, pids):
+        """
+        Call this with the pids of the children of the server that terminated.
+        """
+        # first the kernels that terminated, so we never signal a reaped pid
+        for kms in self.ready.values() + self.owned.values():
+            for km in list(kms):
+                if km.kernel is not None and km.kernel.pid in pids:
+                    self._log("jupyter kernel with pid %s terminated"%km.kernel.pid)
+                    kms.remove(km)
+                    self._shutdown(km, dead=True)
+        # then the kernels of worksheets that terminated
+        for pid in pids:
+            for km in self.owned.pop(pid, []):
+                self._shutdown(km)
+        self.refill()
+
+    def recycle(self):
+        """
+        Shut down the ready kernels for kernelspecs that nobody asked for in the
+        last idle_timeout seconds.  Returns the number of seconds until this should
+        be called again, or None if there is no need to.
+        """
+        now = time.time()
+        wait = None
+        for key, t in self.wanted.items():
+            if now - t < self.idle_timeout:
+                wait = min(wait, t + self.idle_timeout - now) if wait is not None else t + self.idle_timeout - now
+                continue
+            del self.wanted[key]
+            for km in self.ready.pop(key, []):
+                try:
+                    # so no worksheet can take it anymore
+                    os.rename(km.connection_file, km.connection_file + '.recycled')
+                except OSError:
+                    # a worksheet just took it, so it is named connection_file.pid
+                    claimed = glob.glob(km.connection_file + '.*')
+                    if claimed:
+                        self.owned.setdefault(int(claimed[0].split('.')[-1]), []).append(km)
+                        continue
+                self._shutdown(km)
+            self._log("recycled jupyter kernels %s in %s; %r"%(key[0], key[1], self))
+        return wait
+
+    def shutdown(self):
+        for kms in self.ready.values() + self.owned.values():
+            for km in kms:
+                self._shutdown(km)
+        self.ready = {}
+        self.owned = {}
+
+def _claim_kernel(kernel_name):
+    """
+    Take a kernel for kernel_name that the sage server started ahead of time
+    (see KernelPool) and return a client for it, or None if none is ready
+    in the current directory with the current environment.
+    """
+    cwd = os.getcwd()
+    env_key = _environment_key()
+    path = _pool_path(kernel_name, cwd, env_key)
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        names = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        connection_file = os.path.join(path, name)
+        claimed = '%s.%s'%(connection_file, os.getpid())
+        try:
+            os.rename(connection_file, claimed)
+        except OSError:
+            # another worksheet took it first
+            continue
+        if report_to_server is not None:
+            report_to_server('kernel_taken', kernel_name, urllib.quote(cwd), connection_file, os.getpid())
+        kc = jupyter_client.BlockingKernelClient(connection_file=claimed)
+        kc.load_connection_file()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=KERNEL_READY_TIMEOUT)
+        except RuntimeError:
+            kc.stop_channels()
+            continue
+        return kc
+    if report_to_server is not None:
+        report_to_server('kernel_wanted', kernel_name, urllib.quote(cwd), env_key)
+    return None
 
 def _jkmagic(kernel_name, **kwargs):
     r"""
@@ -105,7 +315,10 @@ def _jkmagic(kernel_name, **kwargs):
     -  ``debug`` - optional, set true to view jupyter messages
 
     """
-    km, kc = jupyter_client.manager.start_new_kernel(kernel_name = kernel_name)
+    kc = _claim_kernel(kernel_name)
+    if kc is None:
+        # none is ready; the sage server keeps one ready for the next time
+        km, kc = jupyter_client.manager.start_new_kernel(kernel_name = kernel_name)
 
     kn = kernel_name
     i_am_a_jupyter_client = True
@@ -142,6 +355,137 @@ def _jkmagic(kernel_name, **kwargs):
             h2 = '<div style="max-height:320px;width:80%;overflow:auto;">' + h2 + '</div>'
         salvus.html(h2)
 
+    def display_mime(msg_data):
+        '''
+        jupyter server does send data dictionaries, that do contain mime-type:data mappings
+        depending on the type, handle them in the salvus API
+        '''
+        for mime, data in msg_data.iteritems():
+            p('mime',mime)
+            # when there is latex, it takes precedence over the text representation
+            if mime == 'text/html' or mime == 'text/latex':
+                salvus.html(data)
+            elif mime == 'text/markdown':
+                salvus.md(data)
+            # this test is super cheap, we should be explicit of the mime types here
+            elif any(_ in mime for _ in ['png', 'jpeg', 'svg']):
+                # below is handling of images, etc.
+                attr = mime.split('/')[-1].lower()
+                # fix svg+html, plain
+                #attr = attr.replace('+xml', '').replace('plain', 'text')
+                p("attr",attr)
+                if len(data) > 200:
+                    p(data[:100]+'...'+data[-100:])
+                else:
+                    p(data)
+                # https://en.wikipedia.org/wiki/Data_scheme#Examples
+                # <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEU
+                # <img src='data:image/svg+xml;utf8,<svg ... > ... </svg>'>
+                # the data is sent as a blob straight away; no need for a temporary file
+                if 'svg' in mime:
+                    fname = kn + ".svg"
+                    if isinstance(data, unicode):
+                        data = data.encode('utf8')
+                else:
+                    data = base64.standard_b64decode(data)
+                    fname = kn + "." + attr
+                p(fname)
+                salvus.file(fname, data=data)
+                # ir kernel sends png then svg+xml; don't display both
+                break
+
+            elif mime == 'text/plain':
+                continue
+
+    def handle_iopub(msg):
+        r"""
+        Show the output in the iopub message msg; return True once the kernel is idle.
+        """
+        msg_type = msg['msg_type']
+        content = msg['content']
+
+        if msg_type == 'status' and content['execution_state'] == 'idle':
+            return True
+
+        # trace jupyter protocol if debug enabled
+        p('iopub', msg_type, str(content)[:300])
+
+        # dispatch control or display calls depending on the message type
+        if msg_type == 'execute_result':
+            if not 'data' in content:
+                return False
+            p('execute_result data keys: ',content['data'].keys())
+            out_prefix = ""
+            if 'execution_count' in content:
+                out_data = "Out [%d]: "%content['execution_count']
+                # don't want line break after this
+                sys.stdout.write(out_data)
+            if 'text/latex' in content['data']:
+                ldata = content['data']['text/latex']
+                if re.match('\W*begin{tabular}',ldata):
+                    # sagemath R emits latex tabular output, not supported by MathJAX
+                    import sage.misc.latex
+                    sage.misc.latex.latex.eval(ldata)
+                else:
+                    # convert display to inline for execution output
+                    # this matches jupyter notebook behavior
+                    ldata = re.sub("^\$\$(.*)\$\$$", "$\\1$", ldata)
+                    salvus.html(ldata)
+            elif 'image/png' in content['data']:
+                display_mime(content['data'])
+            elif 'text/markdown' in content['data']:
+                display_mime(content['data'])
+            elif 'text/html' in content['data']:
+                display_mime(content['data'])
+            elif 'text/plain' in content['data']:
+                # don't show text/plain if there is latex content
+                # display_mime(content['data'])
+                sys.stdout.write(content['data']['text/plain'])
+
+        elif msg_type == 'display_data':
+            if 'data' in content:
+                display_mime(content['data'])
+
+        elif msg_type == 'clear_output':
+            salvus.clear()
+
+        elif msg_type == 'stream':
+            if 'text' in content:
+                if 'name' in content and content['name'] == 'stderr':
+                    sys.stderr.write(content['text'])
+                    sys.stderr.flush()
+                else:
+                    hout(content['text'],block = False)
+
+        elif msg_type == 'error':
+            # XXX look for ename and evalue too?
+            if 'traceback' in content:
+                tr = content['traceback']
+                if isinstance(tr, list):
+                    for tr in content['traceback']:
+                        hout(tr)
+                else:
+                    hout(tr)
+        return False
+
+    def handle_shell(msg):
+        r"""
+        Show the payload of the execute_reply msg.
+        """
+        msg_type = msg['msg_type']
+        content = msg['content']
+        p('shell', msg_type, len(str(content)), str(content)[:300])
+        if msg_type == 'execute_reply':
+            if content['status'] == 'ok':
+                if 'payload' in content:
+                    payload = content['payload']
+                    if len(payload) > 0:
+                        if 'data' in payload[0]:
+                            data = payload[0]['data']
+                            if 'text/plain' in data:
+                                text = data['text/plain']
+                                hout(text, scroll = True)
+
     def run_code(code):
 
         # these are used by the worksheet process
@@ -154,161 +498,31 @@ def _jkmagic(kernel_name, **kwargs):
         # get responses
         shell = kc.shell_channel
         iopub = kc.iopub_channel
-        stdinj = kc.stdin_channel
 
-        # handle iopub messages
-        while True:
-            try:
-                msg = iopub.get_msg()
-                msg_type = msg['msg_type']
-                content = msg['content']
-
-            except Empty:
-                # shouldn't happen
-                p("iopub channel empty")
-                break
-
-            if msg['parent_header'].get('msg_id') != msg_id:
-                continue
-
-            if msg_type == 'status' and content['execution_state'] == 'idle':
-                break
-
-            # trace jupyter protocol if debug enabled
-            p('iopub', msg_type, str(content)[:300])
-
-            def display_mime(msg_data):
-                '''
-                jupyter server does send data dictionaries, that do contain mime-type:data mappings
-                depending on the type, handle them in the salvus API
-                '''
-                for mime, data in msg_data.iteritems():
-                    p('mime',mime)
-                    # when there is latex, it takes precedence over the text representation
-                    if mime == 'text/html' or mime == 'text/latex':
-                        salvus.html(data)
-                    elif mime == 'text/markdown':
-                        salvus.md(data)
-                    # this test is super cheap, we should be explicit of the mime types here
-                    elif any(_ in mime for _ in ['png', 'jpeg', 'svg']):
-                        # below is handling of images, etc.
-                        attr = mime.split('/')[-1].lower()
-                        # fix svg+html, plain
-                        #attr = attr.replace('+xml', '').replace('plain', 'text')
-                        p("attr",attr)
-                        if len(data) > 200:
-                            p(data[:100]+'...'+data[-100:])
-                        else:
-                            p(data)
-                        # https://en.wikipedia.org/wiki/Data_scheme#Examples
-                        # <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEU
-                        # <img src='data:image/svg+xml;utf8,<svg ... > ... </svg>'>
-                        if 'svg' in mime:
-                            fname = tempfile.mkstemp(suffix=".svg")[1]
-                        else:
-                            data = base64.standard_b64decode(data)
-                            fname = tempfile.mkstemp(suffix="." + attr)[1]
-                        with open(fname,'w') as fo:
-                            fo.write(data)
-                        p(fname)
-                        salvus.file(fname)
-                        os.unlink(fname)
-                        # ir kernel sends png then svg+xml; don't display both
-                        break
-
-                    elif mime == 'text/plain':
-                        continue
-
-            # dispatch control or display calls depending on the message type
-            if msg_type == 'execute_result':
-                if not 'data' in content:
-                    continue
-                p('execute_result data keys: ',content['data'].keys())
-                out_prefix = ""
-                if 'execution_count' in content:
-                    out_data = "Out [%d]: "%content['execution_count']
-                    # don't want line break after this
-                    sys.stdout.write(out_data)
-                if 'text/latex' in content['data']:
-                    ldata = content['data']['text/latex']
-                    if re.match('\W*begin{tabular}',ldata):
-                        # sagemath R emits latex tabular output, not supported by MathJAX
-                        import sage.misc.latex
-                        sage.misc.latex.latex.eval(ldata)
-                    else:
-                        # convert display to inline for execution output
-                        # this matches jupyter notebook behavior
-                        ldata = re.sub("^\$\$(.*)\$\$$", "$\\1$", ldata)
-                        salvus.html(ldata)
-                elif 'image/png' in content['data']:
-                    display_mime(content['data'])
-                elif 'text/markdown' in content['data']:
-                    display_mime(content['data'])
-                elif 'text/html' in content['data']:
-                    display_mime(content['data'])
-                elif 'text/plain' in content['data']:
-                    # don't show text/plain if there is latex content
-                    # display_mime(content['data'])
-                    sys.stdout.write(content['data']['text/plain'])
-
-            elif msg_type == 'display_data':
-                if 'data' in content:
-                    display_mime(content['data'])
-
-            elif msg_type == 'status':
-                if content['execution_state'] == 'idle':
-                    # when idle, kernel has executed all input
+        # Handle the messages on both channels as soon as they arrive, until the
+        # kernel is idle and has replied to the execute request.
+        poller = zmq.Poller()
+        poller.register(iopub.socket, zmq.POLLIN)
+        poller.register(shell.socket, zmq.POLLIN)
+        idle = replied = False
+        while not (idle and replied):
+            events = dict(poller.poll(1000*KERNEL_HEARTBEAT_INTERVAL))
+            if not events:
+                if not kc.is_alive():
+                    hout("jupyter kernel %s died"%kn)
                     break
-                else:
-                    continue
-
-            elif msg_type == 'clear_output':
-                salvus.clear()
-
-            elif msg_type == 'stream':
-                if 'text' in content:
-                    if 'name' in content and content['name'] == 'stderr':
-                        sys.stderr.write(content['text'])
-                        sys.stderr.flush()
-                    else:
-                        hout(content['text'],block = False)
-
-            elif msg_type == 'error':
-                # XXX look for ename and evalue too?
-                if 'traceback' in content:
-                    tr = content['traceback']
-                    if isinstance(tr, list):
-                        for tr in content['traceback']:
-                            hout(tr)
-                    else:
-                        hout(tr)
-
-        # handle shell messages
-        while True:
-            try:
-                msg = shell.get_msg(timeout = 0.2)
-                msg_type = msg['msg_type']
-                content = msg['content']
-            except Empty:
-                # shouldn't happen
-                p("shell channel empty")
-                break
-            if msg['parent_header'].get('msg_id') == msg_id:
-                p('shell', msg_type, len(str(content)), str(content)[:300])
-                if msg_type == 'execute_reply':
-                    if content['status'] == 'ok':
-                        if 'payload' in content:
-                            payload = content['payload']
-                            if len(payload) > 0:
-                                if 'data' in payload[0]:
-                                    data = payload[0]['data']
-                                    if 'text/plain' in data:
-                                        text = data['text/plain']
-                                        hout(text, scroll = True)
-                    break
-            else:
-                # not our reply
                 continue
+            # all iopub output is sent before the kernel goes idle, so read it first
+            while iopub.socket in events and iopub.msg_ready():
+                msg = iopub.get_msg()
+                if msg['parent_header'].get('msg_id') == msg_id and handle_iopub(msg):
+                    idle = True
+            while shell.socket in events and shell.msg_ready():
+                msg = shell.get_msg()
+                if msg['parent_header'].get('msg_id') == msg_id:
+                    handle_shell(msg)
+                    if msg['msg_type'] == 'execute_reply':
+                        replied = True
         return
 
     return run_code
@@ -12,8 +12,12 @@ Code for parsing Sage code blocks sensibly.
 #                  http://www.gnu.org/licenses/                                         #
 #########################################################################################
 
+import bisect
+import collections
+import hashlib
 import string
 import traceback
+import types
 
 def get_input(prompt):
     try:
@@ -49,9 +53,63 @@ def get_input(prompt):
 #    code = ('\n'.join(code2))%literals
 #    return code
 
+class LRUCache(object):
+    """
+    A small least-recently-used cache, mapping keys to values.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._d = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._d.pop(key)
+        except KeyError:
+            return None
+        self._d[key] = value
+        return value
+
+    def set(self, key, value):
+        self._d.pop(key, None)
+        self._d[key] = value
+        if len(self._d) > self.size:
+            self._d.popitem(last=False)
+
+    def clear(self):
+        self._d.clear()
+
+    def __len__(self):
+        return len(self._d)
+
+def code_key(code):
+    """
+    Key identifying a piece of code in the parse caches.
+    """
+    if isinstance(code, unicode):
+        return 'u' + hashlib.sha1(code.encode('utf8')).digest()
+    return hashlib.sha1(code).digest()
+
+# Number of cells and blocks whose parse results are kept around;
+# re-running a cell (or an unchanged part of it) then skips parsing.
+PARSE_CACHE_SIZE = 128
+PREPARSE_CACHE_SIZE = 1024
+
+_blocks_cache = LRUCache(PARSE_CACHE_SIZE)
+_preparse_cache = LRUCache(PREPARSE_CACHE_SIZE)
+
+def _preparser_state():
+    # settings of the Sage preparser that change its output
+    import sage.misc.preparser
+    return getattr(sage.misc.preparser, 'implicit_mul_level', None)
+
 def preparse_code(code):
     import sage.all_cmdline
-    return sage.all_cmdline.preparse(code, ignore_prompts=True)
+    key = (code_key(code), _preparser_state())
+    result = _preparse_cache.get(key)
+    if result is None:
+        result = sage.all_cmdline.preparse(code, ignore_prompts=True)
+        _preparse_cache.set(key, result)
+    return result
 
 def strip_string_literals(code, state=None):
     new_code = []
@@ -63,10 +121,18 @@ def strip_string_literals(code, state=None):
         raw = False
     else:
         in_quote, raw = state
+    # positions of the next quote and comment characters; each is only
+    # searched for again once the scan has moved past it.
+    sig_q = code.find("'")
+    dbl_q = code.find('"')
+    hash_q = code.find('#')
     while True:
-        sig_q = code.find("'", q)
-        dbl_q = code.find('"', q)
-        hash_q = code.find('#', q)
+        if -1 < sig_q < q:
+            sig_q = code.find("'", q)
+        if -1 < dbl_q < q:
+            dbl_q = code.find('"', q)
+        if -1 < hash_q < q:
+            hash_q = code.find('#', q)
         q = min(sig_q, dbl_q)
         if q == -1: q = max(sig_q, dbl_q)
         if not in_quote and hash_q != -1 and (q == -1 or hash_q < q):
@@ -144,17 +210,71 @@ def end_of_expr(s):
         i += 1
     return i
 
-# NOTE: The dec_args dict will leak memory over time.  However, it only
-# contains code that was entered, so it should never get big.  It
-# seems impossible to know for sure whether a bit of code will be
-# eventually needed later, so this leakiness seems necessary.
+# dec_args holds the arguments of the code decorator lines at the top
+# level of the code being executed.  Those lines run at most once, while
+# that code executes, so their entries are put in the arena of the
+# execution and freed when it finishes; see free_dec_args.  Indented
+# lines may be in a function body that gets called at any later time, so
+# their arguments are written into the line itself as literals instead,
+# and live exactly as long as the code that refers to them.
 dec_counter = 0
 dec_args = {}
 
-# Divide the input code (a string) into blocks of code.
-def divide_into_blocks(code):
-    global dec_counter
+def free_dec_args(arena):
+    """
+    Free the dec_args entries whose indexes are in the list arena.
+    """
+    for n in arena:
+        dec_args.pop(n, None)
+    del arena[:]
+
+def live_dec_args():
+    """
+    Return the number of dec_args entries currently allocated.
+    """
+    return len(dec_args)
+
+# Placeholder for the decorator arguments in cached blocks; replaced by
+# a freshly registered dec_args entry or a literal each time the blocks
+# are handed out.
+DEC_MARKER = '\x00%s\x00'
 
+# Divide the input code (a string) into blocks of code.  The dec_args
+# indexes to free once the code has run are appended to arena.
+def divide_into_blocks(code, arena=None):
+    global dec_counter
+    key = code_key(code)
+    cached = _blocks_cache.get(key)
+    if cached is None:
+        cached = _divide_into_blocks(code)
+        _blocks_cache.set(key, cached)
+    blocks, decorators = cached
+    if not decorators:
+        return [list(b) for b in blocks]
+    indexes = {}
+    for k, (args, top_level) in enumerate(decorators):
+        if top_level:
+            dec_args[dec_counter] = args
+            if arena is not None:
+                arena.append(dec_counter)
+            indexes[DEC_MARKER%k] = '_salvus_parsing.dec_args[%s]'%dec_counter
+            dec_counter += 1
+        else:
+            indexes[DEC_MARKER%k] = repr(args)
+    v = []
+    for start, stop, block in blocks:
+        if '\x00' in block:
+            for marker, n in indexes.iteritems():
+                block = block.replace(marker, n)
+        v.append([start, stop, block])
+    return v
+
+def _divide_into_blocks(code):
+    """
+    Parse code into blocks, returning (blocks, decorators), where the
+    code decorator lines in blocks refer to entries of decorators via
+    DEC_MARKER.  Each entry of decorators is (args, top_level).
+    """
     # strip string literals from the input, so that we can parse it without having to worry about strings
     code, literals, state = strip_string_literals(code)
 
@@ -163,6 +283,7 @@ def divide_into_blocks(code):
 
     # Compute the line-level code decorators.
     c = list(code)
+    decorators = []
     try:
         v = []
         for line in code:
@@ -181,16 +302,16 @@ def divide_into_blocks(code):
                 # Special case -- if % starts line *and* expr is empty (or a comment),
                 # then code decorators impacts the rest of the code.
                 sexpr = expr.strip()
+                marker = DEC_MARKER%len(decorators)
                 if i == 0 and (len(sexpr) == 0 or sexpr.startswith('#')):
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])'%(line[:i], dec_counter)
+                    new_line = '%ssalvus.execute_with_code_decorators(*%s)'%(line[:i], marker)
                     expr = ('\n'.join(code[len(v)+1:]))%literals
                     done = True
                 else:
                     # Expr is nonempty -- code decorator only impacts this line
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])'%(line[:i], dec_counter)
+                    new_line = '%ssalvus.execute_with_code_decorators(*%s)'%(line[:i], marker)
 
-                dec_args[dec_counter] = ([line[i+2:j]%literals], expr)
-                dec_counter += 1
+                decorators.append((([line[i+2:j]%literals], expr), i == 0))
             else:
                 new_line = line
             v.append(new_line)
@@ -199,6 +320,7 @@ def divide_into_blocks(code):
         code = v
     except Exception, mesg:
         code = c
+        decorators = []
 
     ## Tested this: Completely disable block parsing:
     ## but it requires the caller to do "exec compile(block+'\n', '', 'exec') in namespace, locals", which means no display hook,
@@ -209,31 +331,39 @@ def divide_into_blocks(code):
     # take only non-empty lines now for Python code.
     code = [x for x in code if x.strip()]
 
-    # Compute the blocks
-    i = len(code)-1
+    # remove comments
+    # comments now removed in strip_string_literals() but leaving this in place
+    for k, v in literals.iteritems():
+        if v.startswith('#'):
+            literals[k] = ''
+
+    # bracket depth change of each line
+    paren = [x.count('(') - x.count(')') for x in code]
+    brack = [x.count('[') - x.count(']') for x in code]
+    curly = [x.count('{') - x.count('}') for x in code]
+
+    # Compute the blocks, from the last line up; code[:n] is what remains.
+    n = len(code)
+    i = n-1
     blocks = []
     while i >= 0:
         stop = i
-        paren_depth = code[i].count('(') - code[i].count(')')
-        brack_depth = code[i].count('[') - code[i].count(']')
-        curly_depth = code[i].count('{') - code[i].count('}')
+        paren_depth = paren[i]
+        brack_depth = brack[i]
+        curly_depth = curly[i]
         while i>=0 and ((len(code[i]) > 0 and (code[i][0] in string.whitespace)) or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
             i -= 1
             if i >= 0:
-                paren_depth += code[i].count('(') - code[i].count(')')
-                brack_depth += code[i].count('[') - code[i].count(']')
-                curly_depth += code[i].count('{') - code[i].count('}')
-        # remove comments
-        # comments now removed in strip_string_literals() but leaving this in place
-        for k, v in literals.iteritems():
-            if v.startswith('#'):
-                literals[k] = ''
-        block = ('\n'.join(code[i:]))%literals
+                paren_depth += paren[i]
+                brack_depth += brack[i]
+                curly_depth += curly[i]
+        block = ('\n'.join(code[i if i >= 0 else n-1:n]))%literals
         bs = block.strip()
         if bs: # has to not be only whitespace
-            blocks.insert(0, [i, stop, bs])
-        code = code[:i]
-        i = len(code)-1
+            blocks.append([i, stop, bs])
+        n = i if i >= 0 else n-1
+        i = n-1
+    blocks.reverse()
 
     # merge try/except/finally/decorator/else/elif blocks
     i = 1
@@ -266,7 +396,7 @@ def divide_into_blocks(code):
         else:
             i += 1
 
-    return blocks
+    return [tuple(b) for b in blocks], decorators
 
 
 
@@ -295,6 +425,98 @@ def is_valid_identifier(target):
 # Keywords from http://docs.python.org/release/2.7.2/reference/lexical_analysis.html
 _builtin_completions = __builtins__.keys() + ['and', 'del', 'from', 'not', 'while', 'as', 'elif', 'global', 'or', 'with', 'assert', 'else', 'if', 'pass', 'yield', 'break', 'except', 'import', 'print', 'class', 'exec', 'in', 'raise', 'continue', 'finally', 'is', 'return', 'def', 'for', 'lambda', 'try']
 
+_builtin_completion_set = frozenset(_builtin_completions)
+
+class CompletionIndex(object):
+    """
+    Sorted list of the names in a namespace and the builtin completions,
+    so that completing a prefix doesn't walk the whole namespace.  The
+    namespace must have an on method like sage_server.Namespace; the list
+    is rebuilt when a name is added or deleted, or, for changes that don't
+    go through the hooks (e.g., assignments to globals in functions), when
+    the size of the namespace changes.  Completions of names that are no
+    longer in the namespace are dropped.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._names = None
+        self._name_set = frozenset()
+        self._size = 0
+        namespace.on('change', None, self._changed)
+        namespace.on('del', None, self._deleted)
+
+    def _changed(self, x, y):
+        if x not in self._name_set:
+            self._names = None
+
+    def _deleted(self, x):
+        self._names = None
+
+    def names(self):
+        if self._names is None or self._size != len(self.namespace):
+            self._size = len(self.namespace)
+            self._name_set = frozenset(x for x in self.namespace.keys() if isinstance(x, basestring))
+            self._names = sorted(self._name_set.union(_builtin_completions))
+        return self._names
+
+    def completions(self, prefix):
+        """
+        Return the endings of the names that start with prefix.
+        """
+        names = self.names()
+        j = len(prefix)
+        v = []
+        for i in xrange(bisect.bisect_left(names, prefix), len(names)):
+            x = names[i]
+            if not x.startswith(prefix):
+                break
+            if x in self.namespace or x in _builtin_completion_set:
+                v.append(x[j:])
+        return v
+
+_completion_indexes = {}
+
+def completion_index(namespace):
+    """
+    Return the CompletionIndex of namespace, or None if namespace
+    doesn't support change hooks.
+    """
+    if not hasattr(namespace, 'on'):
+        return None
+    index = _completion_indexes.get(id(namespace))
+    if index is None or index.namespace is not namespace:
+        index = _completion_indexes[id(namespace)] = CompletionIndex(namespace)
+    return index
+
+# dir() of the types of objects completed on, keyed by type.
+DIR_CACHE_SIZE = 256
+_dir_cache = LRUCache(DIR_CACHE_SIZE)
+
+# set in __flags__ of the types defined by class statements, whose attributes can change
+_HEAPTYPE = 1 << 9
+
+def cached_dir(O):
+    """
+    Return dir(O) as a new list, computing the part that comes from the
+    type of O only once per type.  This is only done for builtin and
+    extension types (e.g., Cython classes) without a custom __dir__,
+    since their attributes can't change; for everything else, just use dir.
+    """
+    t = type(O)
+    if (isinstance(O, (type, types.ClassType, types.ModuleType)) or t is types.InstanceType
+            or getattr(t, '__dir__', None) is not None
+            or any(c.__flags__ & _HEAPTYPE for c in t.__mro__)
+            or hasattr(O, '__members__') or hasattr(O, '__methods__')):
+        return dir(O)
+    cached = _dir_cache.get(t)
+    if cached is None:
+        cached = dir(t)
+        _dir_cache.set(t, cached)
+    d = getattr(O, '__dict__', None)
+    if not isinstance(d, dict) or not d:
+        return list(cached)
+    return sorted(set(cached).union(d))
+
 def introspect(code, namespace, preparse=True):
     """
     INPUT:
@@ -388,11 +610,16 @@ def introspect(code, namespace, preparse=True):
                 try:
                     pattern = expr.replace("*",".*").replace("?",".")
                     reg = re.compile(pattern+"$")
-                    v = filter(reg.match, namespace.keys() + _builtin_completions)
+                    index = completion_index(namespace)
+                    v = filter(reg.match, index.names() if index is not None else namespace.keys() + _builtin_completions)
                 except:
                     pass
             else:
-                v = [x[j:] for x in (namespace.keys() + _builtin_completions) if x.startswith(expr)]
+                index = completion_index(namespace)
+                if index is not None:
+                    v = index.completions(expr)
+                else:
+                    v = [x[j:] for x in (namespace.keys() + _builtin_completions) if x.startswith(expr)]
         else:
 
             # We will try to evaluate
@@ -481,7 +708,7 @@ def introspect(code, namespace, preparse=True):
 
             elif get_completions:
                 if O is not None:
-                    v = dir(O)
+                    v = cached_dir(O)
                     if hasattr(O, 'trait_names'):
                         v += O.trait_names()
                     if not target.startswith('_'):
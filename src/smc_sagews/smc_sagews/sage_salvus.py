@@ -2078,46 +2078,294 @@ def prun(code):
 # The %fork cell decorator.
 ##############################################################
 
-def _wait_in_thread(pid, callback, filename):
-    from sage.structure.sage_object import load
-    def wait():
+# The result of async is sent back to the parent through a pipe, pickled with
+# protocol 2, when it is at most this many bytes; bigger results are saved to
+# a temporary file, so they aren't held in memory while being sent.
+ASYNC_PIPE_MAX_SIZE = 256*1024*1024
+# numpy arrays in the result with at least this many bytes are sent after the
+# pickle, straight from their memory, instead of being copied into it.
+ASYNC_BUFFER_MIN_SIZE = 64*1024
+
+def _pickle_result(result, buffers):
+    """
+    Return the protocol 2 pickle of result, in which big numpy arrays are
+    replaced by references to the contiguous arrays appended to buffers.
+    """
+    import cPickle, cStringIO
+    numpy = sys.modules.get('numpy')
+    n = len(buffers)
+    def persistent_id(obj):
+        if (numpy is not None and type(obj) is numpy.ndarray and not obj.dtype.hasobject
+                and obj.nbytes >= ASYNC_BUFFER_MIN_SIZE):
+            buffers.append(numpy.ascontiguousarray(obj))
+            return (len(buffers) - 1, obj.dtype, obj.shape)
+        return None
+    out = cStringIO.StringIO()
+    pickler = cPickle.Pickler(out, 2)
+    pickler.persistent_id = persistent_id
+    try:
+        pickler.dump(result)
+    except:
+        del buffers[n:]
+        raise
+    return out.getvalue()
+
+def _send_result(fd, result):
+    """
+    Send result to the parent process through the pipe fd; see _receive_result.
+    A dict is sent without the values that can't be pickled.
+    """
+    import struct
+    out = os.fdopen(fd, 'wb')
+    buffers = []
+    try:
         try:
-            os.waitpid(pid,0)
-            callback(load(filename))
-        except Exception as msg:
-        	callback(msg)
+            data = _pickle_result(result, buffers)
+        except Exception:
+            if not isinstance(result, dict):
+                raise
+            for key, val in result.items():
+                try:
+                    _pickle_result(val, [])
+                except Exception:
+                    sys.stderr.write("unable to pickle %s\n"%key)
+                    del result[key]
+            sys.stderr.flush()
+            data = _pickle_result(result, buffers)
+        if len(data) + sum(b.nbytes for b in buffers) > ASYNC_PIPE_MAX_SIZE:
+            from sage.misc.all import tmp_filename
+            from sage.structure.sage_object import save
+            filename = tmp_filename() + '.sobj'
+            save(result, filename)
+            out.write('f' + filename)
+        else:
+            out.write('p' + struct.pack('!QI', len(data), len(buffers)))
+            out.write(data)
+            for b in buffers:
+                out.write(struct.pack('!Q', b.nbytes))
+                out.write(b.data)
+    except Exception as msg:
+        out.write('e' + str(msg))
+    out.close()
 
-    from threading import Thread
-    t = Thread(target=wait, args=tuple([]))
-    t.start()
+def _receive_result(fd):
+    """
+    Read the result that a forked process sent with _send_result from the pipe fd.
+    """
+    import cPickle, cStringIO, struct
+    from sage.structure.sage_object import load
+    with os.fdopen(fd, 'rb') as f:
+        kind = f.read(1)
+        if kind == 'p':
+            n, k = struct.unpack('!QI', f.read(12))
+            data = f.read(n)
+            buffers = []
+            for i in range(k):
+                b = bytearray(struct.unpack('!Q', f.read(8))[0])
+                f.readinto(b)
+                buffers.append(b)
+            import numpy
+            unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+            unpickler.persistent_load = lambda pid: numpy.frombuffer(buffers[pid[0]], dtype=pid[1]).reshape(pid[2])
+            import sage.structure.sage_object
+            if hasattr(sage.structure.sage_object, 'unpickle_global'):
+                unpickler.find_global = sage.structure.sage_object.unpickle_global
+            return unpickler.load()
+        elif kind == 'f':
+            filename = f.read()
+            try:
+                return load(filename)
+            finally:
+                os.unlink(filename)
+        elif kind == 'e':
+            raise RuntimeError(f.read())
+        else:
+            raise RuntimeError("forked process terminated without sending its result")
 
-def async(f, args, kwds, callback):
+def cpu_quota():
     """
-    Run f in a forked subprocess with given args and kwds, then call the
-    callback function when f terminates.
+    Return the number of CPUs this process may use: the CPU quota of its cgroup,
+    rounded up, if there is one, and otherwise the number of CPUs.
     """
-    from sage.misc.all import tmp_filename
-    filename = tmp_filename() + '.sobj'
-    sys.stdout.flush()
-    sys.stderr.flush()
-    pid = os.fork()
-    if pid:
-        # The parent master process
+    import math, multiprocessing
+    for path, parse in [('/sys/fs/cgroup/cpu.max', lambda s: s.split()),
+                        ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', lambda s: [s, open('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read()])]:
         try:
-            _wait_in_thread(pid, callback, filename)
+            quota, period = parse(open(path).read())
+            quota, period = float(quota), float(period)
+        except (IOError, ValueError):
+            continue
+        if quota > 0 and period > 0:
+            return max(1, int(math.ceil(quota / period)))
+    return multiprocessing.cpu_count()
+
+def _exit_with_parent(ppid):
+    """
+    Make the current (forked) process get killed when its parent process ppid
+    terminates, or exit right away if that already happened.
+    """
+    import ctypes, signal
+    PR_SET_PDEATHSIG = 1
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass   # not Linux; a waiting job still exits when it reads EOF from its go-ahead pipe
+    if os.getppid() != ppid:
+        os._exit(1)
+
+class JobScheduler(object):
+    """
+    Bounds the number of jobs run by async (and so %fork cells) that compute
+    at the same time in a worksheet process.
+
+    Each job is forked when it is submitted, so it sees the state of the
+    worksheet at that time, but then waits until the worksheet process gives
+    it the go-ahead over its own pipe, which it does while fewer than
+    max_jobs jobs run; a waiting job is a sleeping copy-on-write fork.  Jobs
+    are killed when the worksheet process terminates, e.g., on restart.
+    Submitting blocks while max_waiting jobs are waiting.
+    """
+    def __init__(self, max_jobs=None, max_waiting=64):
+        self.max_jobs    = max_jobs   # None = cpu_quota()
+        self.max_waiting = max_waiting
+        self._pid = None
+
+    def _init_process(self):
+        # everything is per worksheet process, like the jobs
+        if self._pid == os.getpid():
+            return
+        import collections, threading
+        self._pid = os.getpid()
+        self.waiting  = collections.OrderedDict()  # pid --> write end of its go-ahead pipe, oldest first
+        self.running  = set()
+        self.finished = 0
+        self._cond = threading.Condition()
+
+    def _start_jobs(self):
+        # call with self._cond held
+        limit = self.max_jobs or cpu_quota()
+        while self.waiting and len(self.running) < limit:
+            pid, go = self.waiting.popitem(last=False)
+            try:
+                os.write(go, 'g')
+            except OSError:
+                pass   # it already terminated; _wait cleans up
+            os.close(go)
+            self.running.add(pid)
+            self._cond.notify_all()
+
+    def __repr__(self):
+        self._init_process()
+        return "%s running, %s waiting, %s finished (at most %s at once)"%(
+            len(self.running), len(self.waiting), self.finished, self.max_jobs or cpu_quota())
+
+    def status(self):
+        """
+        Return a dictionary with the pids of the running and waiting jobs,
+        and the number of finished ones.
+        """
+        self._init_process()
+        with self._cond:
+            return {'running':sorted(self.running), 'waiting':sorted(self.waiting), 'finished':self.finished}
+
+    def submit(self, f, args, kwds, callback):
+        """
+        Run f in a forked subprocess with given args and kwds, as soon as fewer
+        than max_jobs other jobs run, then call the callback function with the
+        result when f terminates.  Returns the pid of the subprocess.
+        """
+        import fcntl
+        self._init_process()
+        with self._cond:
+            if len(self.waiting) >= self.max_waiting:
+                salvus.stderr("%s forked jobs are waiting to run; waiting until one of them starts\n"%len(self.waiting))
+            while len(self.waiting) >= self.max_waiting:
+                self._cond.wait(1)  # with a timeout, so the user can interrupt it
+        sys.stdout.flush()
+        sys.stderr.flush()
+        salvus._flush_output_batch()
+        salvus._wait_for_blobs()
+        ppid = os.getpid()
+        # with the lock held, so the go-ahead pipes of the other jobs don't change meanwhile
+        with self._cond:
+            r, w = os.pipe()
+            go_r, go_w = os.pipe()
+            for fd in (r, go_w):
+                # so that programs run by the worksheet don't keep them open
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            pid = os.fork()
+            if pid:
+                # The parent master process
+                os.close(w)
+                os.close(go_r)
+                self.waiting[pid] = go_w
+                self._start_jobs()
+        if pid:
+            from threading import Thread
+            t = Thread(target=self._wait, args=(pid, callback, r))
+            t.start()
             return pid
-        finally:
-            if os.path.exists(filename):
-                os.unlink(filename)
-    else:
-        # The child process
+        else:
+            # The child process
+            try:
+                _exit_with_parent(ppid)
+                # close the go-ahead pipes of the other waiting jobs, so that each
+                # of them gets EOF when the worksheet process terminates
+                os.close(r)
+                os.close(go_w)
+                for fd in self.waiting.values():
+                    os.close(fd)
+                # so that processes the child runs don't keep the pipe open
+                fcntl.fcntl(w, fcntl.F_SETFD, fcntl.fcntl(w, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+                import errno
+                while True:
+                    try:
+                        go = os.read(go_r, 1)
+                        break
+                    except OSError as err:
+                        if err.errno != errno.EINTR:
+                            raise
+                os.close(go_r)
+            except:
+                os._exit(1)
+            if not go:
+                # the worksheet process terminated before we could start
+                os._exit(1)
+            try:
+                result = f(*args, **kwds)
+            except Exception as msg:
+                result = str(msg)
+            _send_result(w, result)
+            os._exit(0)
+
+    def _wait(self, pid, callback, fd):
         try:
-            result = f(*args, **kwds)
+            # read before waiting, since the child blocks until its result is read
+            result = _receive_result(fd)
         except Exception as msg:
-            result = str(msg)
-        from sage.structure.sage_object import save
-        save(result, filename)
-        os._exit(0)
+            result = msg
+        os.waitpid(pid,0)
+        # however it terminated, it no longer runs or waits
+        with self._cond:
+            go = self.waiting.pop(pid, None)
+            if go is not None:
+                os.close(go)
+            self.running.discard(pid)
+            self.finished += 1
+            self._start_jobs()
+            self._cond.notify_all()
+        callback(result)
+
+# The jobs of async and %fork; set jobs.max_jobs to change how many run at once.
+jobs = JobScheduler()
+
+def async(f, args, kwds, callback):
+    """
+    Run f in a forked subprocess with given args and kwds, then call the
+    callback function when f terminates.  At most jobs.max_jobs of these
+    subprocesses compute at once; the others wait for their turn (see JobScheduler).
+    """
+    return jobs.submit(f, args, kwds, callback)
 
 
 class Fork(object):
@@ -2140,17 +2388,21 @@ class Fork(object):
 
     To see currently running forked subprocesses, type
     fork.children(), which returns a dictionary {pid:execute_uuid}.
+    At most fork.jobs.max_jobs subprocesses (by default, the number of
+    CPUs of the project) compute at once; the others wait.  Type
+    fork.jobs.status() to see which are running and which are waiting.
     To kill a given subprocess and stop the cell waiting for input,
     type fork.kill(pid).  This is currently the only way to stop code
     running in %fork cells.
 
-    TODO/WARNING: The subprocesses spawned by fork are not killed
-    if the parent process is killed first!
+    The subprocesses spawned by fork are killed when the parent
+    process terminates, e.g., when the worksheet is restarted.
 
     NOTE: All pexpect interfaces are reset in the child process.
     """
     def __init__(self):
         self._children = {}
+        self.jobs = jobs
 
     def children(self):
         return dict(self._children)
@@ -2182,38 +2434,31 @@ class Fork(object):
 
             salvus.namespace.on('change', None, change)
             salvus.execute(s)
-            result = {}
-            from sage.structure.sage_object import dumps
-            for var in changed_vars:
-                try:
-                    result[var] = dumps(salvus.namespace[var])
-                except:
-                    result[var] = 'unable to pickle %s'%var
-            return result
-
+            # pickled while being sent back; see _send_result
+            return dict((var, salvus.namespace[var]) for var in changed_vars if var in salvus.namespace)
 
-        from sage.structure.sage_object import loads
         def g(s):
             if isinstance(s, Exception):
                 sys.stderr.write(str(s))
                 sys.stderr.flush()
             else:
                 for var, val in s.iteritems():
-                    try:
-                        salvus.namespace[var] = loads(val)
-                    except:
-                        print("unable to unpickle %s" % var)
-            salvus._conn.send_json({'event':'output', 'id':id, 'done':True})
+                    salvus.namespace[var] = val
+            salvus._send_output_mesg({'event':'output', 'id':id, 'done':True})
             if pid in self._children:
                 del self._children[pid]
 
         pid = async(f, tuple([]), {}, g)
         print("Forked subprocess %s" % pid)
+        with jobs._cond:
+            waiting = pid in jobs.waiting
+        if waiting:
+            print("It waits until fewer jobs run; forked jobs: %r" % jobs)
         self._children[pid] = id
 
     def kill(self, pid):
         if pid in self._children:
-            salvus._conn.send_json({'event':'output', 'id':self._children[pid], 'done':True})
+            salvus._send_output_mesg({'event':'output', 'id':self._children[pid], 'done':True})
             os.kill(pid, 9)
             del self._children[pid]
         else:
@@ -28,7 +28,7 @@ For debugging, this may help:
 
 # Add the path that contains this file to the Python load path, so we
 # can import other files from there.
-import os, sys, time
+import collections, logging, os, sys, time
 
 # used for clearing pylab figure
 pylab = None
@@ -43,15 +43,37 @@ MAX_STDOUT_SIZE = MAX_STDERR_SIZE = MAX_CODE_SIZE = MAX_HTML_SIZE = MAX_MD_SIZE
 
 MAX_OUTPUT = 150000
 
+# Consecutive html, md, tex, javascript and obj outputs of a cell that come less than
+# OUTPUT_BATCH_INTERVAL seconds after the last message was sent are combined into one
+# message with a list of 'parts' (at most OUTPUT_BATCH_SIZE of them), which is sent
+# with the next other output, or when the cell is done.
+OUTPUT_BATCH_INTERVAL = 0.1
+OUTPUT_BATCH_SIZE = 64
+
+# salvus.file doesn't wait for the hub to acknowledge saving each blob; up to
+# MAX_BLOBS_IN_FLIGHT blobs may be unacknowledged.  Output sent after a blob is
+# held back until that blob is acknowledged, so it never refers to a missing blob.
+MAX_BLOBS_IN_FLIGHT = 16
+
+# Number of pre-forked, fully initialized children that sit idle waiting to take the
+# next connection, so a new worksheet session doesn't pay for the fork and setup.
+# Set to 0 to only fork after a connection is accepted.
+POOL_SIZE = 2
+
 # We import the notebook interact, which we will monkey patch below,
 # first, since importing later causes trouble in sage>=5.6.
 import sagenb.notebook.interact
 
 # Standard imports.
-import json, resource, shutil, signal, socket, struct, \
-       tempfile, time, traceback, pwd
+import errno, io, json, resource, select, shutil, signal, socket, struct, \
+       tempfile, time, traceback, pwd, urllib
+
+import sage_parsing, sage_salvus, sage_jupyter
 
-import sage_parsing, sage_salvus
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 uuid = sage_salvus.uuid
 
@@ -81,18 +103,86 @@ def unicode8(s):
         except:
              return s
 
-LOGFILE = os.path.realpath(__file__)[:-3] + ".log"
+LOGFILE = os.path.splitext(os.path.realpath(__file__))[0] + ".log"
+# Messages below this level are not logged; set with the -l option.  Every message sent
+# and received is logged at the DEBUG level.
+LOG_LEVEL = logging.INFO
+# When the log file gets bigger than this many bytes, it is moved to LOGFILE + '.1'.
+LOG_MAX_SIZE = 10*1024*1024
+# Log messages are buffered, and written when one is logged this many seconds after the
+# oldest pending one, and at message boundaries (see LogWriter).
+LOG_FLUSH_INTERVAL = 0.5
 PID = os.getpid()
 from datetime import datetime
-def log(*args):
-    #print("logging to %s"%LOGFILE)
+
+class LogWriter(object):
+    """
+    Buffers log messages in memory, and appends them to LOGFILE when a message is
+    logged LOG_FLUSH_INTERVAL seconds after the oldest pending one (or right away
+    when many are pending or one is an error).  There is no thread, since this is
+    a forking server: the server loop and the sessions call flush() before they
+    block waiting for the next event or message, and processes call it before
+    os._exit.
+
+    A forked child drops whatever its parent had buffered.
+    """
+    def __init__(self, max_pending=1000):
+        self._max_pending = max_pending
+        self._pid = None
+
+    def write(self, line, flush=False):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = []
+        if not self._pending:
+            self._first = time.time()
+        self._pending.append(line)
+        if (flush or len(self._pending) >= self._max_pending
+                  or time.time() - self._first >= LOG_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        if self._pid != os.getpid() or not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        try:
+            f = open(LOGFILE, 'a')
+            try:
+                f.write(''.join(lines))
+                size = f.tell()
+            finally:
+                f.close()
+            if size > LOG_MAX_SIZE:
+                os.rename(LOGFILE, LOGFILE + '.1')
+        except:
+            pass  # an error writing log messages (ignoring)
+
+_log_writer = LogWriter()
+
+def _log(level, args):
     try:
-        debug_log = open(LOGFILE, 'a')
-        mesg = "%s (%s): %s\n"%(PID, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], ' '.join([unicode8(x) for x in args]))
-        debug_log.write(mesg)
-        debug_log.flush()
+        mesg = u"%s (%s): %s\n"%(PID, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], u' '.join([unicode8(x) for x in args]))
+        if isinstance(mesg, unicode):
+            mesg = mesg.encode('utf8')
+        _log_writer.write(mesg, flush=level >= logging.ERROR)
     except:
-        log("an error writing a log message (ignoring)")
+        pass  # an error formatting a log message (ignoring)
+
+def log(*args):
+    if LOG_LEVEL <= logging.INFO:
+        _log(logging.INFO, args)
+
+def log_debug(*args):
+    """
+    Log at the DEBUG level.  For logging in the message handling code, wrap the call
+    in "if LOG_LEVEL <= logging.DEBUG:" so nothing is computed when it's disabled.
+    """
+    if LOG_LEVEL <= logging.DEBUG:
+        _log(logging.DEBUG, args)
+
+def log_error(*args):
+    if LOG_LEVEL <= logging.ERROR:
+        _log(logging.ERROR, args)
 
 # Determine the info object, if available.  There's no good reason
 # it wouldn't be available, unless a user explicitly deleted it, but
@@ -107,16 +197,17 @@ if 'base_url' not in INFO:
     INFO['base_url'] = ''
 
 
-# Configure logging
-#logging.basicConfig()
-#log = logging.getLogger('sage_server')
-#log.setLevel(logging.INFO)
-
 # A CoffeeScript version of this function is in misc_node.coffee.
 import hashlib
 def uuidsha1(data):
     sha1sum = hashlib.sha1()
     sha1sum.update(data)
+    return uuid_from_sha1(sha1sum)
+
+def uuid_from_sha1(sha1sum):
+    """
+    Format the digest of the hashlib sha1 object sha1sum as a uuid.
+    """
     s = sha1sum.hexdigest()
     t = 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'
     r = list(t)
@@ -129,73 +220,152 @@ def uuidsha1(data):
             r[i] = hex( (int(s[j],16)&0x3) |0x8)[-1]; j += 1
     return ''.join(r)
 
+# Size of the chunks files are hashed and sent in, and initial size of the receive buffer.
+CHUNK_SIZE = 65536
+# Payloads smaller than this are copied into the same string as their header, which is
+# cheaper than an extra system call; larger ones are sent without copying.
+SMALL_MESSAGE_SIZE = 16384
+
+# Formats for encoding messages on the wire, as name -> (type character, encode, decode).
+# A client chooses one in start_session; JSON is always available and the default.
+WIRE_FORMATS = {'json' : ('j', json.dumps, json.loads)}
+if msgpack is not None:
+    WIRE_FORMATS['msgpack'] = ('m', msgpack.packb, lambda s: msgpack.unpackb(s, raw=False))
+_WIRE_TYPES = dict([(typ, name) for name, (typ, _, _) in WIRE_FORMATS.iteritems()])
+
 # A tcp connection with support for sending various types of messages, especially JSON.
+#
+# Each message is framed as a 4 byte big endian length, followed by that many bytes:
+# a one character type ('j' for JSON, 'm' for msgpack, 'b' for blob), and the payload.
+# A blob payload starts with the 36 character uuid of its content.
 class ConnectionJSON(object):
     def __init__(self, conn):
         assert not isinstance(conn, ConnectionJSON)  # avoid common mistake -- conn is supposed to be from socket.socket...
         self._conn = conn
+        self._buf = bytearray(CHUNK_SIZE)   # reused for all received messages
+        self.format = 'json'                # wire format used by send_json; see WIRE_FORMATS
 
     def close(self):
         self._conn.close()
 
-    def _send(self, s):
-        length_header = struct.pack(">L", len(s))
-        self._conn.send(length_header + s)
+    def _send(self, header, payload=''):
+        # header is the (short) message type and uuid; payload is sent without copying
+        frame = struct.pack(">L", len(header) + len(payload)) + header
+        if len(payload) < SMALL_MESSAGE_SIZE:
+            self._conn.sendall(frame + payload)
+        else:
+            self._conn.sendall(frame)
+            self._conn.sendall(payload)
 
     def send_json(self, m):
-        m = json.dumps(m)
-        log(u"sending message '", truncate_text(m, 256), u"'")
-        self._send('j' + m)
+        """
+        Send the message m using the wire format of this connection, and return
+        the length of the encoded message.
+        """
+        typ, dumps, _ = WIRE_FORMATS[self.format]
+        if typ == 'j':
+            if m.get('event') == 'output':
+                m = json_encode_obj(m)
+            m = dumps(m)
+            if LOG_LEVEL <= logging.DEBUG:
+                log_debug(u"sending message '", truncate_text(m, 256), u"'")
+        else:
+            m = dumps(m)
+            if LOG_LEVEL <= logging.DEBUG:
+                log_debug(u"sending %s message of length %s"%(self.format, len(m)))
+        self._send(typ, m)
         return len(m)
 
     def send_blob(self, blob):
         s = uuidsha1(blob)
-        self._send('b' + s + blob)
+        self._send('b' + s, blob)
         return s
 
     def send_file(self, filename):
-        log("sending file '%s'"%filename)
-        f = open(filename, 'rb')
-        data = f.read()
-        f.close()
-        return self.send_blob(data)
-
-    def _recv(self, n):
-        #print("_recv(%s)"%n)
-        for i in range(20): # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
-            try:
-                #print "blocking recv (i = %s), pid=%s"%(i, os.getpid())
-                r = self._conn.recv(n)
-                #log("n=%s; received: '%s' of len %s"%(n,r, len(r)))
-                return r
-            except socket.error as (errno, msg):
-                #print("socket.error, msg=%s"%msg)
-                if errno != 4:
-                    raise
-        raise EOFError
+        """
+        Send the file as a blob, using a constant amount of memory: the file is read
+        once in chunks to compute its hash, and again while sending it.
+        """
+        log_debug("sending file '%s'"%filename)
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        with io.open(filename, 'rb') as f:
+            sha1sum = hashlib.sha1()
+            size = 0
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                sha1sum.update(view[:n])
+                size += n
+            s = uuid_from_sha1(sha1sum)
+            header = 'b' + s
+            self._conn.sendall(struct.pack(">L", len(header) + size) + header)
+            f.seek(0)
+            while size > 0:
+                n = f.readinto(buf)
+                if not n:
+                    # the file was truncated while we were sending it; the frame can't be completed
+                    raise EOFError("file '%s' changed while sending it"%filename)
+                n = min(n, size)
+                self._conn.sendall(view[:n])
+                size -= n
+        return s
 
-    def recv(self):
-        n = self._recv(4)
-        if len(n) < 4:
-            raise EOFError
-        n = struct.unpack('>L', n)[0]   # big endian 32 bits
-        s = self._recv(n)
-        while len(s) < n:
-            t = self._recv(n - len(s))
-            if len(t) == 0:
+    def _recv_into(self, view):
+        """
+        Fill the memoryview with data from the connection.
+        """
+        while len(view) > 0:
+            for i in range(20): # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
+                try:
+                    #print "blocking recv (i = %s), pid=%s"%(i, os.getpid())
+                    n = self._conn.recv_into(view)
+                    break
+                except socket.error as (errno, msg):
+                    #print("socket.error, msg=%s"%msg)
+                    if errno != 4:
+                        raise
+            else:
+                raise EOFError
+            if n == 0:
                 raise EOFError
-            s += t
+            view = view[n:]
 
-        if s[0] == 'j':
+    def recv(self):
+        self._recv_into(memoryview(self._buf)[:4])
+        n = struct.unpack('>L', bytes(self._buf[:4]))[0]   # big endian 32 bits
+        if n == 0:
+            raise ValueError("empty message")
+        # don't hold on to the memory used by an occasional huge message
+        buf = self._buf if n <= len(self._buf) else bytearray(n)
+        view = memoryview(buf)[:n]
+        self._recv_into(view)
+
+        typ = chr(buf[0])
+        if typ in _WIRE_TYPES:
+            # messages are returned with type 'json', whatever wire format they came in
+            s = view[1:].tobytes()
             try:
-                return 'json', json.loads(s[1:])
+                return 'json', WIRE_FORMATS[_WIRE_TYPES[typ]][2](s)
             except Exception as msg:
-                log("Unable to parse JSON '%s'"%s[1:])
+                log("Unable to parse %s message '%s'"%(_WIRE_TYPES[typ], s))
                 raise
 
-        elif s[0] == 'b':
-            return 'blob', s[1:]
-        raise ValueError("unknown message type '%s'"%s[0])
+        elif typ == 'b':
+            return 'blob', view[1:].tobytes()
+        raise ValueError("unknown message type '%s'"%typ)
+
+def json_encode_obj(m):
+    """
+    In JSON, the obj of an output message (or of each of its parts) is itself a
+    JSON string; return m with that done.
+    """
+    if 'obj' in m:
+        m = dict(m, obj=json.dumps(m['obj']))
+    if 'parts' in m:
+        m = dict(m, parts=[json_encode_obj(part) for part in m['parts']])
+    return m
 
 def truncate_text(s, max_size):
     if len(s) > max_size:
@@ -238,11 +408,14 @@ class Message(object):
                 m[key] = val
         return m
 
-    def start_session(self):
-        return self._new('start_session')
+    def start_session(self, format=None):
+        m = self._new('start_session')
+        if format is not None:
+            m['format'] = format  # wire format the client would like to use; see WIRE_FORMATS
+        return m
 
-    def session_description(self, pid):
-        return self._new('session_description', {'pid':pid})
+    def session_description(self, pid, format='json'):
+        return self._new('session_description', {'pid':pid, 'format':format})
 
     def send_signal(self, pid, signal=signal.SIGINT):
         return self._new('send_signal', locals())
@@ -301,7 +474,7 @@ class Message(object):
         if coffeescript is not None: m['coffeescript'] = coffeescript
         if interact is not None: m['interact'] = interact
         if d3 is not None: m['d3'] = d3
-        if obj is not None: m['obj'] = json.dumps(obj)
+        if obj is not None: m['obj'] = obj     # JSON encoded by ConnectionJSON.send_json, if needed
         if file is not None: m['file'] = file    # = {'filename':..., 'uuid':...}
         if raw_input is not None: m['raw_input'] = raw_input
         if done is not None: m['done'] = done
@@ -412,8 +585,16 @@ class BufferedOutputStream(object):
     def isatty(self):
         return False
 
-# This will *have* to be re-done using Cython for speed.
 class Namespace(dict):
+    """
+    The global namespace of a session, with watchers called when a
+    name is set or deleted; use on(event, name, f), where name=None
+    watches all names.
+
+    Assignments through plain dict methods are as fast as for a dict:
+    the methods that call watchers are only put in place, by switching
+    the class of the namespace, while watchers for that event exist.
+    """
     def __init__(self, x):
         self._on_change = {}
         self._on_del = {}
@@ -421,65 +602,116 @@ class Namespace(dict):
 
     def on(self, event, x, f):
         if event == 'change':
-            if x not in self._on_change:
-                self._on_change[x] = []
-            self._on_change[x].append(f)
+            self._on_change.setdefault(x, []).append(f)
         elif event == 'del':
-            if x not in self._on_del:
-                self._on_del[x] = []
-            self._on_del[x].append(f)
+            self._on_del.setdefault(x, []).append(f)
+        self._set_class()
 
     def remove(self, event, x, f):
-        if event == 'change' and x in self._on_change:
-            v = self._on_change[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_change[x]
-        elif event == 'del' and x in self._on_del:
-            v = self._on_del[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
+        if event == 'change':
+            watchers = self._on_change
+        elif event == 'del':
+            watchers = self._on_del
+        else:
+            return
+        v = watchers.get(x)
+        if v is not None:
+            try:
+                v.remove(f)
+            except ValueError:
+                pass
             if len(v) == 0:
-                del self._on_del[x]
+                del watchers[x]
+        self._set_class()
 
+    def _set_class(self):
+        self.__class__ = _namespace_classes[bool(self._on_change), bool(self._on_del)]
+
+    def set(self, x, y, do_not_trigger=None):
+        dict.__setitem__(self, x, y)
+        v = self._on_change.get(x)
+        if v is not None:
+            if do_not_trigger is None:
+                do_not_trigger = []
+            for f in v:
+                if f not in do_not_trigger:
+                    f(y)
+        v = self._on_change.get(None)
+        if v is not None:
+            for f in v:
+                f(x,y)
+
+class _ChangeWatchedNamespace(Namespace):
     def __setitem__(self, x, y):
         dict.__setitem__(self, x, y)
         try:
-            if x in self._on_change:
-                for f in self._on_change[x]:
+            v = self._on_change.get(x)
+            if v is not None:
+                for f in v:
                     f(y)
-            if None in self._on_change:
-                for f in self._on_change[None]:
+            v = self._on_change.get(None)
+            if v is not None:
+                for f in v:
                     f(x, y)
         except Exception as mesg:
             print(mesg)
 
+class _DelWatchedNamespace(Namespace):
     def __delitem__(self, x):
         try:
-            if x in self._on_del:
-                for f in self._on_del[x]:
+            v = self._on_del.get(x)
+            if v is not None:
+                for f in v:
                     f()
-            if None in self._on_del:
-                for f in self._on_del[None]:
+            v = self._on_del.get(None)
+            if v is not None:
+                for f in v:
                     f(x)
         except Exception as mesg:
             print(mesg)
         dict.__delitem__(self, x)
 
-    def set(self, x, y, do_not_trigger=None):
-        dict.__setitem__(self, x, y)
-        if x in self._on_change:
-            if do_not_trigger is None:
-                do_not_trigger = []
-            for f in self._on_change[x]:
-                if f not in do_not_trigger:
-                    f(y)
-        if None in self._on_change:
-            for f in self._on_change[None]:
-                f(x,y)
+class _WatchedNamespace(_ChangeWatchedNamespace, _DelWatchedNamespace):
+    pass
+
+# class of a namespace, given whether it has change and del watchers
+_namespace_classes = {(False, False): Namespace,
+                      (True, False): _ChangeWatchedNamespace,
+                      (False, True): _DelWatchedNamespace,
+                      (True, True): _WatchedNamespace}
+
+def benchmark_namespace(n=1000000):
+    """
+    Time n assignments to a global variable in a loop run through
+    salvus.execute, with no watchers and with a watcher on all names
+    of the namespace.  Returns the number of assignments per second
+    in both cases, e.g., in a worksheet::
+
+        sage_server.benchmark_namespace()
+    """
+    salvus = namespace['salvus']
+    code = 'for _benchmark_i in xrange(%s): _benchmark_x = _benchmark_i'%n
+    def f(x, y):
+        pass
+    def rate():
+        t = time.time()
+        salvus.execute(code, preparse=False)
+        return 2*n / (time.time() - t)   # loop variable + assignment
+    # watchers of the session, e.g., for dynamic variables, are put back afterwards
+    on_change = dict((x, list(v)) for x, v in namespace._on_change.iteritems())
+    try:
+        namespace._on_change.clear()
+        namespace._set_class()
+        result = {'unwatched': rate()}
+        namespace.on('change', None, f)
+        result['watched'] = rate()
+    finally:
+        namespace._on_change.clear()
+        namespace._on_change.update(on_change)
+        namespace._set_class()
+        for x in ['_benchmark_i', '_benchmark_x']:
+            namespace.pop(x, None)
+    return result
 
 class TemporaryURL:
     def __init__(self, url, ttl):
@@ -545,6 +777,13 @@ class Salvus(object):
         self.namespace = namespace
         self.message_queue = message_queue
         self.code_decorators = [] # gets reset if there are code decorators
+        self._output_batch = []   # output messages waiting to be sent together
+        self._last_send_time = 0
+        self._blobs_in_flight = collections.deque()  # [sha1, ack] of blobs sent, oldest first
+        self._blobs_sent = self._blobs_acked = 0
+        self._blob_acks = {}      # sha1 --> ack of the blobs no longer in flight
+        self._blob_refs = collections.Counter()  # sha1 --> messages that still need its ack
+        self._held_output = collections.deque()  # (blobs that must be acked first, mesg)
         # Alias: someday remove all references to "salvus" and instead use smc.
         # For now this alias is easier to think of and use.
         namespace['smc'] = namespace['salvus'] = self   # beware of circular ref?
@@ -563,13 +802,73 @@ class Salvus(object):
         import sage_server
 
         if self._num_output_messages > sage_server.MAX_OUTPUT_MESSAGES:
+            self._flush_output_batch()
             self._output_warning_sent = True
             err = "\nToo many output messages: %s (at most %s per cell -- type 'smc?' to learn how to raise this limit): attempting to terminate..."%(self._num_output_messages , sage_server.MAX_OUTPUT_MESSAGES)
-            self._conn.send_json(message.output(stderr=err, id=self._id, once=False, done=True))
+            self._send_output_mesg(message.output(stderr=err, id=self._id, once=False, done=True))
             raise KeyboardInterrupt
 
+        if self._output_batch and self._output_batch[0]['id'] != mesg['id']:
+            self._flush_output_batch()
+
+        if self._is_batchable(mesg):
+            self._output_batch.append(mesg)
+            if (len(self._output_batch) >= sage_server.OUTPUT_BATCH_SIZE or
+                    time.time() - self._last_send_time >= sage_server.OUTPUT_BATCH_INTERVAL):
+                self._flush_output_batch()
+        elif mesg.get('delete_last') and self._output_batch:
+            # this deletes the last output message, so that one must not be part of a batch
+            last = self._output_batch.pop()
+            self._flush_output_batch()
+            self._send_output_mesg(last)
+            self._send_output_mesg(mesg)
+        else:
+            self._flush_output_batch()
+            self._send_output_mesg(mesg)
+
+    _batch_content_keys = frozenset(['html', 'md', 'tex', 'javascript', 'obj'])
+    _batchable_keys = _batch_content_keys.union(['event', 'id', 'done', 'once'])
+
+    def _is_batchable(self, mesg):
+        return (not mesg.get('done') and self._batchable_keys.issuperset(mesg)
+                and not self._batch_content_keys.isdisjoint(mesg))
+
+    def _flush_output_batch(self):
+        """
+        Send the output messages that are waiting to be batched, as one message.
+        """
+        batch = self._output_batch
+        if not batch:
+            return
+        self._output_batch = []
+        if len(batch) == 1:
+            self._send_output_mesg(batch[0])
+        else:
+            parts = [dict([(k, v) for k, v in m.iteritems() if k not in ('event', 'id', 'done')]) for m in batch]
+            self._send_output_mesg({'event':'output', 'id':batch[0]['id'], 'parts':parts, 'done':False})
+
+    def _send_output_mesg(self, mesg):
+        """
+        Send mesg once the blobs sent before it have been acknowledged.
+        All messages of this cell go through here, so they stay in order.
+        """
+        if self._held_output or self._blobs_acked < self._blobs_sent:
+            self._held_output.append((self._blobs_sent, mesg))
+            self._receive_blob_acks()
+        else:
+            self._write_output_mesg(mesg)
+
+    def _write_output_mesg(self, mesg):
+        import sage_server
+        if mesg.get('event') != 'output':
+            self._conn.send_json(mesg)
+            return
+        mesg = self._check_blobs(mesg)
         n = self._conn.send_json(mesg)
+        self._last_send_time = time.time()
         self._total_output_length += n
+        if session_start_time is not None:
+            report_first_output()
 
         if self._total_output_length > sage_server.MAX_OUTPUT:
             self._output_warning_sent = True
@@ -677,6 +976,7 @@ class Salvus(object):
 
                done         = False,
                renderer     = None,   # None, 'webgl', or 'canvas'
+               quantize     = False,  # send vertices of large meshes with 16 bits per coordinate
               ):
 
         from graphics import graphics3d_to_jsonable, json_float as f
@@ -736,28 +1036,38 @@ class Salvus(object):
         elif isinstance(frame, bool):
             fr['draw'] = frame
 
-        # convert the Sage graphics object to a JSON object that can be rendered
+        # flush output (so any text appears before 3d graphics, in case they are interleaved)
+        self._flush_stdio()
+        self._flush_output_batch()
+
+        # convert the Sage graphics object to a JSON object that can be rendered; large
+        # meshes are sent as separate binary blobs, which the scene refers to.
+        mesh_blobs = []
+        def send_mesh(data):
+            mesh_blobs.append(self._send_blob(data=data))
+            return mesh_blobs[-1]
         scene = {'opts' : opts,
-                 'obj'  : graphics3d_to_jsonable(g)}
+                 'obj'  : graphics3d_to_jsonable(g, send_blob=send_mesh, quantize=quantize)}
 
         # Store that object in the database, rather than sending it directly as an output message.
         # We do this since obj can easily be quite large/complicated, and managing it as part of the
         # document is too slow and doesn't scale.
         blob = json.dumps(scene, separators=(',', ':'))
-        uuid = self._conn.send_blob(blob)
+        uuid = self._send_blob(data=blob)
 
-        # flush output (so any text appears before 3d graphics, in case they are interleaved)
-        self._flush_stdio()
-
-        # send message pointing to the 3d 'file', which will get downloaded from database
-        self._send_output(id=self._id, file={'filename':unicode8("%s.sage3d"%uuid), 'uuid':uuid}, done=done)
+        # send message pointing to the 3d 'file', which will get downloaded from database;
+        # 'blobs' lists the other blobs it needs, so they are kept along with it.
+        file_info = {'filename':unicode8("%s.sage3d"%uuid), 'uuid':uuid}
+        if mesh_blobs:
+            file_info['blobs'] = mesh_blobs
+        self._send_output(id=self._id, file=file_info, done=done)
 
 
     def d3_graph(self, g, **kwds):
         from graphics import graph_to_d3_jsonable
         self._send_output(id=self._id, d3={"viewer":"graph", "data":graph_to_d3_jsonable(g, **kwds)})
 
-    def file(self, filename, show=True, done=False, download=False, once=False, events=None, raw=False, text=None):
+    def file(self, filename, show=True, done=False, download=False, once=False, events=None, raw=False, text=None, data=None):
         """
         Display or provide a link to the given file.  Raises a RuntimeError if this
         is not possible, e.g, if the file is too large.
@@ -797,9 +1107,14 @@ class Salvus(object):
         The uuid is based on the Sha-1 hash of the file content (it is computed using the
         function sage_server.uuidsha1).  Any two files with the same content have the
         same Sha1 hash.
+
+        If data is given, it is the content of the file (a byte string), which then
+        doesn't have to exist; filename is only used to name it.
         """
         filename = unicode8(filename)
         if raw:
+            if data is not None:
+                raise ValueError(u"data can't be given for raw files")
             info = self.project_info()
             path = os.path.abspath(filename)
             home = os.environ[u'HOME'] + u'/'
@@ -815,21 +1130,21 @@ class Salvus(object):
             else:
                 return TemporaryURL(url=url, ttl=0)
 
-        file_uuid = self._conn.send_file(filename)
-
-        mesg = None
-        while mesg is None:
-            self.message_queue.recv()
-            for i, (typ, m) in enumerate(self.message_queue.queue):
-                if typ == 'json' and m.get('event') == 'save_blob' and m.get('sha1') == file_uuid:
-                    mesg = m
-                    del self.message_queue[i]
-                    break
+        self._flush_stdio()
+        self._flush_output_batch()
+        if data is None:
+            file_uuid = self._send_blob(filename=filename)
+        else:
+            file_uuid = self._send_blob(data=data)
 
-        if 'error' in mesg:
-            raise RuntimeError("error saving blob -- %s"%mesg['error'])
+        if not show:
+            # we need the ttl from the acknowledgement
+            self._wait_for_blobs()
+            mesg = self._blob_acks.get(file_uuid, {})
+            if 'error' in mesg:
+                self._release_blob(file_uuid)
+                raise RuntimeError("error saving blob -- %s"%mesg['error'])
 
-        self._flush_stdio()
         self._send_output(id=self._id, once=once, file={'filename':filename, 'uuid':file_uuid, 'show':show, 'text':text}, events=events, done=done)
         if not show:
             info = self.project_info()
@@ -838,6 +1153,100 @@ class Salvus(object):
                 url += u'?download'
             return TemporaryURL(url=url, ttl=mesg.get('ttl',0))
 
+    def _send_blob(self, filename=None, data=None):
+        """
+        Send the file, or the string data, as a blob, without waiting for the
+        acknowledgement, except when MAX_BLOBS_IN_FLIGHT blobs are already
+        waiting for one.  The caller must then send an output message that
+        refers to the blob, which releases its acknowledgement.
+        """
+        import sage_server
+        self._wait_for_blobs(sage_server.MAX_BLOBS_IN_FLIGHT - 1)
+        if data is None:
+            uuid = self._conn.send_file(filename)
+        else:
+            uuid = self._conn.send_blob(data)
+        self._blobs_in_flight.append([uuid, None])
+        self._blobs_sent += 1
+        self._blob_refs[uuid] += 1
+        self._receive_blob_acks()
+        return uuid
+
+    def _wait_for_blobs(self, n=0):
+        """
+        Wait until at most n blobs are waiting to be acknowledged, and send the
+        output that can then be sent.
+        """
+        while len(self._blobs_in_flight) > n:
+            self._receive_blob_acks(block=True)
+
+    def _receive_blob_acks(self, block=False):
+        """
+        Match the save_blob acknowledgements that have arrived with the blobs in
+        flight; if block is True, wait for one first.  Other messages are left
+        in the message queue.
+        """
+        if not self._blobs_in_flight:
+            return
+        while True:
+            mesg = self.message_queue.get('save_blob', block=block)
+            if mesg is None:
+                break
+            block = False
+            m = mesg[1]
+            for blob in self._blobs_in_flight:
+                if blob[0] == m.get('sha1') and blob[1] is None:
+                    blob[1] = m
+                    break
+            else:
+                log("ignoring acknowledgement of unknown blob %s"%m.get('sha1'))
+        while self._blobs_in_flight and self._blobs_in_flight[0][1] is not None:
+            sha1, ack = self._blobs_in_flight.popleft()
+            self._blobs_acked += 1
+            if 'error' in ack:
+                log("error saving blob %s -- %s"%(sha1, ack['error']))
+            if self._blob_refs[sha1] > 0:
+                # keep the error, if any, of a blob sent more than once
+                if 'error' not in self._blob_acks.get(sha1, {}):
+                    self._blob_acks[sha1] = ack
+            else:
+                del self._blob_refs[sha1]
+        self._release_output()
+
+    def _release_output(self):
+        """
+        Send the held output messages whose blobs have all been acknowledged.
+        """
+        while self._held_output and self._held_output[0][0] <= self._blobs_acked:
+            self._write_output_mesg(self._held_output.popleft()[1])
+
+    def _release_blob(self, sha1):
+        """
+        Drop a reference to the acknowledgement of the blob sha1, and return
+        the acknowledgement.
+        """
+        ack = self._blob_acks.get(sha1, {})
+        self._blob_refs[sha1] -= 1
+        if self._blob_refs[sha1] <= 0:
+            del self._blob_refs[sha1]
+            self._blob_acks.pop(sha1, None)
+        return ack
+
+    def _check_blobs(self, mesg):
+        """
+        Release the acknowledgements of the blobs the output message mesg
+        refers to, which have all arrived, and return mesg, or an error
+        message instead if one of the blobs couldn't be saved.
+        """
+        f = mesg.get('file')
+        if not isinstance(f, dict) or 'uuid' not in f:
+            return mesg
+        errors = [self._release_blob(uuid).get('error') for uuid in [f['uuid']] + f.get('blobs', [])]
+        errors = [e for e in errors if e]
+        if errors:
+            mesg = message.output(stderr="error saving blob -- %s\n"%errors[0], id=mesg['id'], done=mesg.get('done', False))
+        return mesg
+
     def default_mode(self, mode=None):
         """
         Set the default mode for cell evaluation.  This is equivalent
@@ -927,42 +1336,47 @@ class Salvus(object):
             pylab.clf()
 
         #code   = sage_parsing.strip_leading_prompts(code)  # broken -- wrong on "def foo(x):\n   print(x)"
-        blocks = sage_parsing.divide_into_blocks(code)
-
+        arena = []
+        blocks = sage_parsing.divide_into_blocks(code, arena)
         try:
-            import sage.repl.interpreter as sage_repl_interpreter
-        except:
-            log("Error - unable to import sage.repl.interpreter")
-
-        for start, stop, block in blocks:
-            # if import sage.repl.interpreter fails, sag_repl_interpreter is unreferenced
             try:
-                do_pp = getattr(sage_repl_interpreter, '_do_preparse', True)
+                import sage.repl.interpreter as sage_repl_interpreter
             except:
-                do_pp = True
-            if preparse and do_pp:
-                block = sage_parsing.preparse_code(block)
-            sys.stdout.reset(); sys.stderr.reset()
-            try:
-                b = block.rstrip()
-                if b.endswith('??'):
-                    p = sage_parsing.introspect(block,
-                                   namespace=namespace, preparse=False)
-                    self.code(source = p['result'], mode = "python")
-                elif b.endswith('?'):
-                    p = sage_parsing.introspect(block, namespace=namespace, preparse=False)
-                    self.code(source = p['result'], mode = "text/x-rst")
-                else:
-                    reload_attached_files_if_mod_smc()
-                    exec compile(block+'\n', '', 'single') in namespace, locals
-                sys.stdout.flush()
-                sys.stderr.flush()
-            except:
-                sys.stdout.flush()
-                sys.stderr.write('Error in lines %s-%s\n'%(start+1, stop+1))
-                traceback.print_exc()
-                sys.stderr.flush()
-                break
+                log("Error - unable to import sage.repl.interpreter")
+
+            for start, stop, block in blocks:
+                # if import sage.repl.interpreter fails, sag_repl_interpreter is unreferenced
+                try:
+                    do_pp = getattr(sage_repl_interpreter, '_do_preparse', True)
+                except:
+                    do_pp = True
+                if preparse and do_pp:
+                    block = sage_parsing.preparse_code(block)
+                sys.stdout.reset(); sys.stderr.reset()
+                try:
+                    b = block.rstrip()
+                    if b.endswith('??'):
+                        p = sage_parsing.introspect(block,
+                                       namespace=namespace, preparse=False)
+                        self.code(source = p['result'], mode = "python")
+                    elif b.endswith('?'):
+                        p = sage_parsing.introspect(block, namespace=namespace, preparse=False)
+                        self.code(source = p['result'], mode = "text/x-rst")
+                    else:
+                        reload_attached_files_if_mod_smc()
+                        exec compile(block+'\n', '', 'single') in namespace, locals
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    self._flush_output_batch()
+                except:
+                    self._flush_output_batch()
+                    sys.stdout.flush()
+                    sys.stderr.write('Error in lines %s-%s\n'%(start+1, stop+1))
+                    traceback.print_exc()
+                    sys.stderr.flush()
+                    break
+        finally:
+            sage_parsing.free_dec_args(arena)
 
     def execute_with_code_decorators(self, code_decorators, code, preparse=True, namespace=None, locals=None):
         """
@@ -1168,6 +1582,7 @@ class Salvus(object):
         if placeholder:
             m['placeholder'] = unicode8(placeholder)
         self._send_output(raw_input=m, id=self._id)
+        self._wait_for_blobs()
         typ, mesg = self.message_queue.next_mesg()
         #log("raw_input got message typ='%s', mesg='%s'"%(typ, mesg))
         if typ == 'json' and mesg['event'] == 'sage_raw_input':
@@ -1258,7 +1673,8 @@ class Salvus(object):
 
         See the docs for the top-level javascript function for more details.
         """
-        self._conn.send_json(message.execute_javascript(code,
+        self._flush_output_batch()
+        self._send_output_mesg(message.execute_javascript(code,
             coffeescript=coffeescript, obj=json.dumps(obj,separators=(',', ':'))))
 
     def execute_coffeescript(self, *args, **kwds):
@@ -1390,6 +1806,7 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         salvus.execute(code, namespace=namespace, preparse=preparse)
 
     finally:
+        salvus._flush_output_batch()
         # there must be exactly one done message, unless salvus._done is False.
         if sys.stderr._buf:
             if sys.stdout._buf:
@@ -1398,6 +1815,7 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         else:
             sys.stdout.flush(done=salvus._done)
         (sys.stdout, sys.stderr) = streams
+        salvus._wait_for_blobs()
 
 
 def drop_privileges(id, home, transient, username):
@@ -1424,19 +1842,83 @@ def drop_privileges(id, home, transient, username):
     sage.misc.misc.DOT_SAGE = home + '/.sage/'
 
 
-class MessageQueue(list):
+_session_process_pid = None
+def init_session_process():
+    """
+    Per-process setup that every forked session needs.  This is idempotent, so
+    pre-forked pool children can do it before a connection arrives.
+    """
+    global _session_process_pid
+    if _session_process_pid == os.getpid():
+        return
+    _session_process_pid = os.getpid()
+
+    # seed the random number generator(s)
+    import sage.all; sage.all.set_random_seed()
+    import random; random.seed(sage.all.initial_seed())
+
+    # get_memory_usage is not aware of being forked...
+    import sage.misc.getusage
+    sage.misc.getusage._proc_status = "/proc/%s/status"%os.getpid()
+
+# Time at which this child accepted its connection; cleared once the first output
+# message of the session is sent and the latency is reported to the server.
+session_start_time = None
+# Write end of the pipe the children use to report events to the server process.
+_pool_report_fd = None
+
+def report_to_server(*args):
+    if _pool_report_fd is None:
+        return
+    try:
+        os.write(_pool_report_fd, ' '.join([str(x) for x in args]) + '\n')
+    except OSError:
+        pass
+
+def report_first_output():
+    global session_start_time
+    t = time.time() - session_start_time
+    session_start_time = None
+    log("time to first output: %.3f seconds"%t)
+    report_to_server('first_output', os.getpid(), '%.4f'%t)
+
+class MessageQueue(object):
+    """
+    Messages from the hub that were received but not handled yet.  They are
+    kept in order of arrival, and also in one queue per event (blobs have
+    the event 'blob'), so that waiting for a particular kind of message, e.g.,
+    a save_blob acknowledgement, doesn't depend on how many other messages
+    are waiting.
+    """
     def __init__(self, conn):
-        self.queue = []
-        self.conn  = conn
+        self.conn = conn
+        self._all = collections.deque()   # entries [typ, mesg, taken], oldest first
+        self._by_event = {}               # event --> deque of the same entries
+        self._size = 0
 
     def __repr__(self):
         return "Sage Server Message Queue"
 
-    def __getitem__(self, i):
-        return self.queue[i]
+    def __len__(self):
+        return self._size
+
+    def _event(self, typ, mesg):
+        return mesg.get('event') if typ == 'json' else typ
+
+    def _take(self, q):
+        # Remove and return the oldest entry of q that wasn't taken via the other queue.
+        while q:
+            entry = q.popleft()
+            if not entry[2]:
+                entry[2] = True
+                self._size -= 1
+                return entry
+        return None
 
-    def __delitem__(self, i):
-        del self.queue[i]
+    def _drop_taken(self, q):
+        # Entries are taken in order within each queue, so taken ones are at the front.
+        while q and q[0][2]:
+            q.popleft()
 
     def next_mesg(self):
         """
@@ -1444,10 +1926,27 @@ class MessageQueue(list):
         If the queue is empty, wait for a message to arrive
         and return it (does not place it in the queue).
         """
-        if self.queue:
-            return self.queue.pop()
-        else:
+        entry = self._take(self._all)
+        if entry is None:
             return self.conn.recv()
+        self._drop_taken(self._by_event[self._event(entry[0], entry[1])])
+        return entry[0], entry[1]
+
+    def get(self, event, block=True):
+        """
+        Remove and return the oldest message with the given event.  If there is
+        none, receive the messages that already arrived; then, if block is True,
+        wait for one, and otherwise return None.
+        """
+        while True:
+            entry = self._take(self._by_event.get(event))
+            if entry is not None:
+                self._drop_taken(self._all)
+                return entry[0], entry[1]
+            if not self.recv_ready():
+                if not block:
+                    return None
+                self.recv()
 
     def recv(self):
         """
@@ -1455,9 +1954,27 @@ class MessageQueue(list):
         Also returns the mesg.
         """
         mesg = self.conn.recv()
-        self.queue.insert(0,mesg)
+        typ, m = mesg
+        entry = [typ, m, False]
+        self._all.append(entry)
+        event = self._event(typ, m)
+        q = self._by_event.get(event)
+        if q is None:
+            q = self._by_event[event] = collections.deque()
+        q.append(entry)
+        self._size += 1
         return mesg
 
+    def recv_ready(self):
+        """
+        Enqueue the messages that can be received without waiting, and return
+        how many there were.
+        """
+        n = 0
+        while select.select([self.conn._conn], [], [], 0)[0]:
+            self.recv()
+            n += 1
+        return n
 
 
 def session(conn):
@@ -1474,21 +1991,19 @@ def session(conn):
 
     pid = os.getpid()
 
-    # seed the random number generator(s)
-    import sage.all; sage.all.set_random_seed()
-    import random; random.seed(sage.all.initial_seed())
-
-    # get_memory_usage is not aware of being forked...
-    import sage.misc.getusage
-    sage.misc.getusage._proc_status = "/proc/%s/status"%os.getpid()
+    # already done if this process was pre-forked by the worker pool
+    init_session_process()
 
     cnt = 0
     while True:
         try:
+            # write what was logged while handling the previous message
+            _log_writer.flush()
             typ, mesg = mq.next_mesg()
 
             #print('INFO:child%s: received message "%s"'%(pid, mesg))
-            log("handling message ", truncate_text(unicode8(mesg), 400))
+            if LOG_LEVEL <= logging.DEBUG:
+                log_debug("handling message ", truncate_text(unicode8(mesg), 400))
             event = mesg['event']
             if event == 'terminate_session':
                 return
@@ -1502,7 +2017,7 @@ def session(conn):
                             preparse      = mesg.get('preparse',True),
                             message_queue = mq)
                 except Exception as err:
-                    log("ERROR -- exception raised '%s' when executing '%s'"%(err, mesg['code']))
+                    log_error("ERROR -- exception raised '%s' when executing '%s'"%(err, mesg['code']))
             elif event == 'introspect':
                 import sys
                 try:
@@ -1574,7 +2089,7 @@ def jupyter_introspect(conn, id, line, preparse, jkfn):
             if msg['parent_header'].get('msg_id') != msg_id:
                 continue
 
-            log("jupyter iopub recv %s %s"%(msg_type, str(content)))
+            log_debug("jupyter iopub recv %s %s"%(msg_type, str(content)))
 
             if msg_type == 'status' and content['execution_state'] == 'idle':
                 break
@@ -1594,7 +2109,7 @@ def jupyter_introspect(conn, id, line, preparse, jkfn):
             if msg['parent_header'].get('msg_id') != msg_id:
                 continue
 
-            log("jupyter shell recv %s %s"%(msg_type, str(content)))
+            log_debug("jupyter shell recv %s %s"%(msg_type, str(content)))
 
             if msg_type == 'complete_reply' and content['status'] == 'ok':
                 # jupyter kernel returns matches like "xyz.append" and smc wants just "append"
@@ -1618,13 +2133,54 @@ def introspect(conn, id, line, preparse):
         mesg = message.introspect_source_code(id=id, source_code=z['result'], target=z['expr'])
     conn.send_json(mesg)
 
-def handle_session_term(signum, frame):
+# Read end of the pipe that becomes readable when SIGCHLD arrives in the server process.
+_sigchld_fd = None
+
+def watch_children():
+    """
+    Make SIGCHLD wake up the server loop via a self-pipe.  The handler does nothing
+    else -- in particular it doesn't call waitpid -- and forked children restore the
+    default disposition (see unwatch_children), so pexpect in a session still works.
+    """
+    global _sigchld_fd
+    import fcntl
+    r, w = os.pipe()
+    for fd in (r, w):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)
+    _sigchld_fd = r
+    return r
+
+def unwatch_children():
+    global _sigchld_fd
+    if _sigchld_fd is None:
+        return
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.close(signal.set_wakeup_fd(-1))
+    os.close(_sigchld_fd)
+    _sigchld_fd = None
+
+def reap_children():
+    """
+    Reap all children of the server that have terminated, and return their pids.
+    """
+    try:
+        while True:
+            os.read(_sigchld_fd, 4096)
+    except OSError:
+        pass
+    pids = []
     while True:
         try:
             pid, exit_status = os.waitpid(-1, os.WNOHANG)
-        except:
-            return
-        if not pid: return
+        except OSError:
+            break
+        if not pid:
+            break
+        pids.append(pid)
+    return pids
 
 secret_token = None
 secret_token_path = os.path.join(os.environ['SMC'], 'secret_token')
@@ -1674,7 +2230,7 @@ def serve_connection(conn):
         typ, mesg = conn.recv()
         log("Received message %s"%mesg)
     except Exception as err:
-        log("Error receiving message: %s (connection terminated)"%str(err))
+        log_error("Error receiving message: %s (connection terminated)"%str(err))
         raise
 
     if mesg['event'] == 'send_signal':
@@ -1689,27 +2245,129 @@ def serve_connection(conn):
         return
 
     log("Starting a session")
-    desc = message.session_description(os.getpid())
+    # The client may ask for a wire format other than JSON, which we use for all
+    # messages after the session description (the client may use it as well).
+    # In formats besides JSON, the obj of output messages is not JSON encoded.
+    format = mesg.get('format', 'json')
+    if format not in WIRE_FORMATS:
+        log("Wire format '%s' not available; using json."%format)
+        format = 'json'
+    desc = message.session_description(os.getpid(), format=format)
     log("child sending session description back: %s"%desc)
     conn.send_json(desc)
+    conn.format = format
     session(conn=conn)
 
-def serve(port, host, extra_imports=False):
+class WorkerPool(object):
+    """
+    Children forked ahead of time that have already done the per-session setup
+    and are blocked accepting on the shared listening socket.  A child that takes
+    a connection reports this to the server over a pipe, and the server forks a
+    replacement.  Children also report the time to first output of their session.
+    """
+    def __init__(self, sock, size, kernels):
+        self.sock    = sock
+        self.size    = size
+        self.kernels = kernels   # jupyter kernels that are kept ready; see sage_jupyter.KernelPool
+        self.idle   = set()
+        self.hits   = 0
+        self.misses = 0
+        self._buf   = ''
+        self._r, self._w = os.pipe()
+        self.poller = None   # epoll object of the server loop, which forked children close
+
+    def __repr__(self):
+        return "worker pool: size=%s, idle=%s, hits=%s, misses=%s"%(self.size, len(self.idle), self.hits, self.misses)
+
+    def fileno(self):
+        return self._r
+
+    def fork(self, children):
+        """
+        Fork a child that can report to the server; returns the pid of the child
+        in the server and 0 in the child.
+        """
+        pid = os.fork()
+        if not pid:
+            global PID, _pool_report_fd
+            PID = os.getpid()
+            os.close(self._r)
+            _pool_report_fd = self._w
+            if self.poller is not None:
+                self.poller.close()
+            # closes the SIGCHLD self-pipe
+            unwatch_children()
+            # don't hold on to the connections of other sessions
+            for conn in children.values():
+                if conn is not None:
+                    conn.close()
+        return pid
+
+    def refill(self, children):
+        while len(self.idle) < self.size:
+            pid = self.fork(children)
+            if pid:
+                self.idle.add(pid)
+            else:
+                try:
+                    self._serve_next_connection()
+                except:
+                    log_error("pre-forked child failed: %s"%traceback.format_exc())
+                finally:
+                    _log_writer.flush()
+                    os._exit(0)
+
+    def _serve_next_connection(self):
+        global session_start_time
+        init_session_process()
+        _log_writer.flush()
+        while True:
+            select.select([self.sock], [], [])
+            try:
+                conn, addr = self.sock.accept()
+                break
+            except socket.error:
+                # another process took the connection first
+                continue
+        session_start_time = time.time()
+        report_to_server('taken', os.getpid())
+        self.sock.close()
+        log("pre-forked child accepted a connection from", addr)
+        serve_connection(conn)
+
+    def read_reports(self, children):
+        self._buf += os.read(self._r, 4096)
+        lines = self._buf.split('\n')
+        self._buf = lines.pop()
+        for line in lines:
+            v = line.split()
+            if v[0] == 'taken':
+                pid = int(v[1])
+                if pid in self.idle:
+                    self.idle.discard(pid)
+                    children[pid] = None
+                    self.hits += 1
+                log("pre-forked child %s took a connection; %r"%(pid, self))
+            elif v[0] == 'first_output':
+                log("session %s: time to first output %s seconds; %r"%(v[1], v[2], self))
+            elif v[0] == 'kernel_taken':
+                self.kernels.taken(v[1], urllib.unquote(v[2]), v[3], int(v[4]))
+                log("session %s took a jupyter kernel %s; %r"%(v[4], v[1], self.kernels))
+            elif v[0] == 'kernel_wanted':
+                self.kernels.want(v[1], urllib.unquote(v[2]), v[3])
+
+def serve(port, host, extra_imports=False, pool_size=None):
     #log.info('opening connection on port %s', port)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # check for children that have finished every few seconds, so
-    # we don't end up with zombies.
-    s.settimeout(5)
+    # the server and the pre-forked children wait for connections using select/epoll,
+    # so accept must never block.
+    s.setblocking(False)
 
     s.bind((host, port))
     log('Sage server %s:%s'%(host, port))
 
-    # Enabling the following signal completely breaks subprocess pexpect in many cases, which is
-    # obviously totally unacceptable.
-    #signal.signal(signal.SIGCHLD, handle_session_term)
-
     def init_library():
         tm = time.time()
         log("pre-importing the sage library...")
@@ -1797,44 +2455,93 @@ def serve(port, host, extra_imports=False):
     s.listen(128)
     i = 0
 
+    sage_jupyter.report_to_server = report_to_server
+    kernels = sage_jupyter.KernelPool(log=log)
+    pool = WorkerPool(s, POOL_SIZE if pool_size is None else pool_size, kernels)
     children = {}
+
+    # Wait for connections, reports from the pre-forked children, and terminated
+    # children (via SIGCHLD), so we never poll and don't end up with zombies.
+    poller = select.epoll()
+    pool.poller = poller
+    sigchld_fd = watch_children()
+    poller.register(sigchld_fd, select.EPOLLIN)
+    poller.register(pool.fileno(), select.EPOLLIN)
+    accepting = False
+
     log("Starting server listening for connections")
     try:
         while True:
             i += 1
             #print i, time.time()-t, 'cps: ', int(i/(time.time()-t))
             # do not use log.info(...) in the server loop; threads = race conditions that hang server every so often!!
+            pool.refill(children)
+
+            # Only accept connections ourselves when no pre-forked child is waiting for one.
+            if accepting and pool.idle:
+                poller.unregister(s.fileno())
+                accepting = False
+            elif not accepting and not pool.idle:
+                poller.register(s.fileno(), select.EPOLLIN)
+                accepting = True
+
+            timeout = kernels.recycle()
+            _log_writer.flush()
             try:
-                if children:
-                    for pid in children.keys():
-                        if os.waitpid(pid, os.WNOHANG) != (0,0):
+                events = poller.poll(-1 if timeout is None else timeout)
+            except IOError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+
+            # handle reports first, so a child that took a connection and already
+            # terminated is not mistaken for an idle one.
+            events.sort(key=lambda e: e[0] != pool.fileno())
+            for fd, event in events:
+                if fd == sigchld_fd:
+                    pids = reap_children()
+                    for pid in pids:
+                        if pid in children:
                             log("subprocess %s terminated, closing connection"%pid)
-                            conn.close()
+                            if children[pid] is not None:
+                                children[pid].close()
                             del children[pid]
+                        elif pid in pool.idle:
+                            log("idle pool child %s terminated"%pid)
+                            pool.idle.discard(pid)
+                    kernels.reaped(pids)
 
-                try:
-                    conn, addr = s.accept()
-                    log("Accepted a connection from", addr)
-                except:
-                    # this will happen periodically since we did s.settimeout above, so
-                    # that we wait for children above periodically.
-                    continue
-            except socket.error, msg:
-                continue
-            child_pid = os.fork()
-            if child_pid: # parent
-                log("forked off child with pid %s to handle this connection"%child_pid)
-                children[child_pid] = conn
-            else:
-                # child
-                global PID
-                PID = os.getpid()
-                log("child process, will now serve this new connection")
-                serve_connection(conn)
+                elif fd == pool.fileno():
+                    pool.read_reports(children)
+
+                elif fd == s.fileno():
+                    try:
+                        conn, addr = s.accept()
+                        log("Accepted a connection from", addr)
+                    except socket.error:
+                        # another process took the connection first
+                        continue
+                    accepted = time.time()
+                    pool.misses += 1
+                    child_pid = pool.fork(children)
+                    if child_pid: # parent
+                        log("forked off child with pid %s to handle this connection; %r"%(child_pid, pool))
+                        children[child_pid] = conn
+                    else:
+                        # child
+                        global session_start_time
+                        session_start_time = accepted
+                        log("child process, will now serve this new connection")
+                        try:
+                            s.close()
+                            serve_connection(conn)
+                        finally:
+                            _log_writer.flush()
+                            os._exit(0)
 
         # end while
     except Exception as err:
-        log("Error taking connection: ", err)
+        log_error("Error taking connection: ", err)
         traceback.print_exc(file=sys.stdout)
         #log.error("error: %s %s", type(err), str(err))
 
@@ -1842,16 +2549,24 @@ def serve(port, host, extra_imports=False):
         log("closing socket")
         #s.shutdown(0)
         s.close()
+        kernels.shutdown()
+        _log_writer.flush()
 
-def run_server(port, host, pidfile, logfile=None):
-    global LOGFILE
+def run_server(port, host, pidfile, logfile=None, pool_size=None, log_level=None):
+    """
+    log_level is the name of a logging level, e.g., 'DEBUG' or 'WARNING' (default: LOG_LEVEL);
+    pool_size is the number of pre-forked children (default: POOL_SIZE).
+    """
+    global LOGFILE, LOG_LEVEL
     if logfile:
         LOGFILE = logfile
+    if log_level:
+        LOG_LEVEL = getattr(logging, log_level.upper())
     if pidfile:
         open(pidfile,'w').write(str(os.getpid()))
     log("run_server: port=%s, host=%s, pidfile='%s', logfile='%s'"%(port, host, pidfile, LOGFILE))
     try:
-        serve(port, host)
+        serve(port, host, pool_size=pool_size)
     finally:
         if pidfile:
             os.unlink(pidfile)
@@ -1877,6 +2592,8 @@ if __name__ == "__main__":
                         help="hostname to connect to in client mode")
     parser.add_argument("--portfile", dest="portfile", type=str, default='',
                         help="write port to this file")
+    parser.add_argument("--pool_size", dest="pool_size", type=int, default=POOL_SIZE,
+                        help="number of pre-forked children waiting for connections (default: %s)"%POOL_SIZE)
 
     args = parser.parse_args()
 
@@ -1884,11 +2601,6 @@ if __name__ == "__main__":
         print("%s: must specify pidfile in daemon mode" % sys.argv[0])
         sys.exit(1)
 
-    if args.log_level:
-        pass
-        #level = getattr(logging, args.log_level.upper())
-        #log.setLevel(level)
-
     if args.client:
         client1(port=args.port if args.port else int(open(args.portfile).read()), hostname=args.hostname)
         sys.exit(0)
@@ -1908,7 +2620,7 @@ if __name__ == "__main__":
         open(LOGFILE, 'w')  # for now we clear it on restart...
         log("setting logfile to %s"%LOGFILE)
 
-    main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile)
+    main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile, pool_size=args.pool_size, log_level=args.log_level)
     if args.daemon and args.pidfile:
         import daemon
         daemon.daemonize(args.pidfile)
@@ -6,7 +6,7 @@ def log(s):
     sys.stderr.write('sage_server: %s\n'%s)
     sys.stderr.flush()
 
-def main(action='', daemon=True):
+def main(action='', daemon=True, log_level=None, pool_size=None):
     SMC = os.environ['SMC']
     PATH = os.path.join(SMC, 'sage_server')
     if not os.path.exists(PATH):
@@ -18,10 +18,17 @@ def main(action='', daemon=True):
     logfile = file + 'log'
 
     if action == '':
-        if len(sys.argv) <= 1:
-            action = ''
-        else:
-            action = sys.argv[1]
+        import argparse
+        parser = argparse.ArgumentParser(description="Start or stop the sage server")
+        parser.add_argument("action", nargs='?', default='', help="start, stop or restart")
+        parser.add_argument("-l", dest="log_level", type=str, default=None,
+                            help="log level (default: INFO) useful options include WARNING and DEBUG")
+        parser.add_argument("--pool_size", dest="pool_size", type=int, default=None,
+                            help="number of pre-forked children waiting for connections")
+        args = parser.parse_args()
+        action = args.action
+        log_level = log_level or args.log_level
+        pool_size = args.pool_size if pool_size is None else pool_size
 
     def start():
         log("starting...")
@@ -34,7 +41,8 @@ def main(action='', daemon=True):
         log("setting logfile to %s"%logfile)
 
         import sage_server
-        run_server = lambda: sage_server.run_server(port=port, host='127.0.0.1', pidfile=pidfile, logfile=logfile)
+        run_server = lambda: sage_server.run_server(port=port, host='127.0.0.1', pidfile=pidfile, logfile=logfile,
+                                                    log_level=log_level, pool_size=pool_size)
         if daemon:
             log("daemonizing")
             from daemon import daemonize
@@ -0,0 +1,151 @@
+import re
+from unittest import TestCase
+
+from smc_sagews import sage_parsing
+
+SAMPLES = [
+    "",
+    "2+2",
+    "x = 1\ny = (2,\n  3)\nx+y",
+    "def f(x):\n    return x\n\nf(2)",
+    "@dec\ndef f(x):\n    return x",
+    "try:\n    pass\nexcept:\n    pass\nfinally:\n    pass",
+    "if a:\n  b\nelif c:\n  d\nelse:\n  e",
+    "s = 'a#b' # c\nt = \"%s\" % 5",
+    's = """multi\nline\n"""\nprint s',
+    "d = {'a':\n 1}\nz = 'it\\'s'",
+    "%time\nx = 1\ny = 2",
+    "%python x = 1\n%md # hi\n!ls -l",
+    "for i in range(3):\n  %time i+1\n  print i",
+    "def g():\n    %sh ls\n    return 1\n%time g()",
+    u"u = u'\\xe9'\n%time u",
+]
+
+def normalize(blocks):
+    # dec_args indexes depend on how many entries were registered before
+    v = []
+    for start, stop, block in blocks:
+        v.append([start, stop, re.sub(r'dec_args\[\d+\]', 'dec_args[N]', block)])
+    return v
+
+class NamespaceDict(dict):
+    # the hook interface of sage_server.Namespace used by CompletionIndex
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self._on = []
+
+    def on(self, event, x, f):
+        self._on.append((event, f))
+
+    def __setitem__(self, x, y):
+        dict.__setitem__(self, x, y)
+        for event, f in self._on:
+            if event == 'change':
+                f(x, y)
+
+    def __delitem__(self, x):
+        dict.__delitem__(self, x)
+        for event, f in self._on:
+            if event == 'del':
+                f(x)
+
+class TestStripStringLiterals(TestCase):
+    def test_round_trip(self):
+        for code in SAMPLES:
+            if '#' in code:
+                continue   # comments are dropped
+            stripped, literals, state = sage_parsing.strip_string_literals(code)
+            self.assertEqual(stripped % literals, code)
+
+class TestDivideIntoBlocks(TestCase):
+    def setUp(self):
+        sage_parsing._blocks_cache.clear()
+
+    def test_cached_blocks_are_the_same(self):
+        for code in SAMPLES:
+            arena = []
+            first = sage_parsing.divide_into_blocks(code, arena)
+            second = sage_parsing.divide_into_blocks(code, arena)
+            sage_parsing._blocks_cache.clear()
+            third = sage_parsing.divide_into_blocks(code, arena)
+            sage_parsing.free_dec_args(arena)
+            self.assertEqual(normalize(first), normalize(second))
+            self.assertEqual(normalize(first), normalize(third))
+
+    def test_cached_blocks_are_copies(self):
+        code = "x = 1\ny = 2"
+        blocks = sage_parsing.divide_into_blocks(code)
+        blocks[0][2] = 'changed'
+        self.assertEqual(sage_parsing.divide_into_blocks(code), [[0, 0, 'x = 1'], [1, 1, 'y = 2']])
+
+    def test_blocks(self):
+        self.assertEqual(sage_parsing.divide_into_blocks("if a:\n  b\nelse:\n  c\nd"),
+                         [[0, 3, 'if a:\n  b\nelse:\n  c'], [4, 4, 'd']])
+        self.assertEqual(sage_parsing.divide_into_blocks("@dec\ndef f(x):\n    return x"),
+                         [[0, 2, '@dec\ndef f(x):\n    return x']])
+
+    def test_decorator_arguments(self):
+        arena = []
+        blocks = sage_parsing.divide_into_blocks("%time\nx = 1", arena)
+        self.assertEqual(len(blocks), 1)
+        self.assertEqual(len(arena), 1)
+        self.assertEqual(blocks[0][2], 'salvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])'%arena[0])
+        self.assertEqual(sage_parsing.dec_args[arena[0]], (['time'], 'x = 1'))
+        sage_parsing.free_dec_args(arena)
+
+    def test_nested_decorator_arguments_are_literals(self):
+        arena = []
+        blocks = sage_parsing.divide_into_blocks("def f(x):\n    %time x+1", arena)
+        self.assertEqual(arena, [])
+        line = blocks[0][2].splitlines()[1]
+        prefix = '    salvus.execute_with_code_decorators(*'
+        self.assertTrue(line.startswith(prefix))
+        self.assertEqual(eval(line[len(prefix):-1]), (['time '], 'x+1'))
+
+    def test_all_entries_are_freed(self):
+        live = sage_parsing.live_dec_args()
+        for code in SAMPLES:
+            arena = []
+            sage_parsing.divide_into_blocks(code, arena)
+            sage_parsing.divide_into_blocks(code, arena)
+            sage_parsing.free_dec_args(arena)
+            self.assertEqual(arena, [])
+            self.assertEqual(sage_parsing.live_dec_args(), live)
+
+class TestCompletion(TestCase):
+    def test_completion_index(self):
+        namespace = NamespaceDict({'alpha': 1, 'alphabet': 2, 'beta': 3})
+        index = sage_parsing.CompletionIndex(namespace)
+        def brute(prefix):
+            names = namespace.keys() + sage_parsing._builtin_completions
+            return sorted(set(x[len(prefix):] for x in names if x.startswith(prefix)))
+        for prefix in ['al', 'alpha', 'b', 'x', '']:
+            self.assertEqual(index.completions(prefix), brute(prefix))
+        namespace['alps'] = 4
+        del namespace['beta']
+        dict.__setitem__(namespace, 'alto', 5)   # bypasses the hooks
+        for prefix in ['al', 'be', '']:
+            self.assertEqual(index.completions(prefix), brute(prefix))
+        # one name swapped for another, keeping the size
+        dict.__delitem__(namespace, 'alto')
+        namespace['gamma'] = 6
+        for prefix in ['al', 'ga', '']:
+            self.assertEqual(index.completions(prefix), brute(prefix))
+
+    def test_cached_dir(self):
+        class A(object):
+            x = 1
+        a = A()
+        a.y = 2
+        self.assertEqual(sage_parsing.cached_dir(a), dir(a))
+        A.z = 3
+        self.assertEqual(sage_parsing.cached_dir(a), dir(a))
+        del A.x
+        self.assertEqual(sage_parsing.cached_dir(a), dir(a))
+        A.w = 4   # same number of attributes as before
+        del A.z
+        self.assertEqual(sage_parsing.cached_dir(a), dir(a))
+        for obj in [1, 1.5, 'abc', [], {}, xrange(3), A, sage_parsing]:
+            self.assertEqual(sage_parsing.cached_dir(obj), dir(obj))
+        self.assertEqual(sage_parsing._dir_cache.get(float), dir(float))
+        self.assertEqual(sage_parsing._dir_cache.get(A), None)
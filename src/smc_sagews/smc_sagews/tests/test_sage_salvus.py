@@ -0,0 +1,82 @@
+import os, signal, threading, time
+from unittest import TestCase
+
+from smc_sagews import sage_salvus
+
+class FakeSalvus(object):
+    # what JobScheduler.submit uses of the salvus object of a worksheet
+    def stderr(self, s):
+        pass
+
+    def _flush_output_batch(self):
+        pass
+
+    def _wait_for_blobs(self):
+        pass
+
+def alive(pid):
+    try:
+        with open('/proc/%s/stat'%pid) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+class TestJobScheduler(TestCase):
+    def setUp(self):
+        self.salvus = sage_salvus.salvus
+        sage_salvus.salvus = FakeSalvus()
+
+    def tearDown(self):
+        sage_salvus.salvus = self.salvus
+
+    def run_jobs(self, jobs, fs):
+        results = {}
+        done = threading.Event()
+        def callback(i):
+            def g(result):
+                results[i] = result
+                if len(results) == len(fs):
+                    done.set()
+            return g
+        for i, f in enumerate(fs):
+            jobs.submit(f, (), {}, callback(i))
+        done.wait(30)
+        return results
+
+    def test_jobs_run(self):
+        jobs = sage_salvus.JobScheduler(max_jobs=2)
+        results = self.run_jobs(jobs, [lambda: 1, lambda: 2, lambda: 3])
+        self.assertEqual(results, {0:1, 1:2, 2:3})
+        self.assertEqual(jobs.status(), {'running':[], 'waiting':[], 'finished':3})
+
+    def test_slot_freed_when_job_dies(self):
+        jobs = sage_salvus.JobScheduler(max_jobs=1)
+        results = self.run_jobs(jobs, [lambda: os.kill(os.getpid(), signal.SIGKILL), lambda: 2])
+        self.assertTrue(isinstance(results[0], Exception))
+        self.assertEqual(results[1], 2)
+        self.assertEqual(jobs.status()['finished'], 2)
+
+    def test_restart_kills_jobs(self):
+        r, w = os.pipe()
+        worksheet = os.fork()
+        if not worksheet:
+            # a worksheet process running one job, with another one waiting
+            try:
+                os.close(r)
+                jobs = sage_salvus.JobScheduler(max_jobs=1)
+                pids = [jobs.submit(time.sleep, (60,), {}, lambda result: None) for i in range(2)]
+                os.write(w, ' '.join(str(pid) for pid in pids) + '\n')
+                time.sleep(60)
+            finally:
+                os._exit(0)
+        os.close(w)
+        with os.fdopen(r) as f:
+            pids = [int(pid) for pid in f.readline().split()]
+        self.assertEqual(len(pids), 2)
+        # restarting the worksheet kills its process
+        os.kill(worksheet, signal.SIGKILL)
+        os.waitpid(worksheet, 0)
+        t = time.time()
+        while any(alive(pid) for pid in pids) and time.time() - t < 10:
+            time.sleep(0.05)
+        self.assertEqual([pid for pid in pids if alive(pid)], [])